@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measures the throughput and CPU time of piping command output through | cat while stdout is a StdSim
+
+Usage: python benchmarks/proc_reader_benchmark.py [megabytes]
+
+Output captured from the pipe process is read by utils.ProcReader. Besides the time to pipe the
+output, this reports the CPU time used while a pipe process which has closed its output keeps
+running for a while, which should be close to zero.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import cmd2  # noqa: E402
+from cmd2 import utils  # noqa: E402
+
+CHUNK = b'x' * 1023 + b'\n'
+
+
+class BenchmarkApp(cmd2.Cmd):
+    """An application with a command which prints a lot of output"""
+
+    def do_blast(self, statement):
+        """Print the given number of megabytes"""
+        chunk = CHUNK * 64
+        for _ in range(int(statement.args) * 16):
+            self.stdout.buffer.write(chunk)
+
+
+def run(app, line):
+    """Run a command and return the wall and CPU time it took"""
+    wall_start = time.perf_counter()
+    cpu_start = time.process_time()
+    app.onecmd_plus_hooks(line, add_to_history=False)
+    return time.perf_counter() - wall_start, time.process_time() - cpu_start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('megabytes', nargs='?', type=int, default=1024, help='megabytes to pipe (default: 1024)')
+    args = parser.parse_args()
+
+    app = BenchmarkApp(allow_cli_args=False)
+    with open(os.devnull, 'w') as devnull:
+        # Output passes through the StdSim to /dev/null without being stored
+        app.stdout = utils.StdSim(devnull, echo=True)
+        app.stdout.pause_storage = True
+
+        wall, cpu = run(app, 'blast {} | cat'.format(args.megabytes))
+        print('piped {} MB in {:.2f}s ({:.0f} MB/s) using {:.2f}s of CPU time'.format(args.megabytes, wall,
+                                                                                      args.megabytes / wall, cpu))
+
+        sleeper = 'exec "{}" -c "import os, time; os.close(1); time.sleep(2)"'.format(sys.executable)
+        wall, cpu = run(app, 'blast 0 | {}'.format(sleeper))
+        print('waited {:.2f}s for a pipe process with closed output using {:.2f}s of CPU time'.format(wall, cpu))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding=utf-8
+"""
+Measures how many lines per second cmd2 runs from a script, with and without the batch mode of runcmds_plus_hooks()
+
+Usage: python benchmarks/run_script_benchmark.py [number of lines]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir))
+
+import cmd2  # noqa: E402
+
+
+class BenchmarkApp(cmd2.Cmd):
+    """An application with commands which do almost nothing, so only cmd2's own overhead is measured"""
+
+    def do_nop(self, _):
+        """Do nothing"""
+        pass
+
+    def do_say(self, statement):
+        """Print the arguments"""
+        self.poutput(statement)
+
+
+def run(lines, *, batch, redirect_to=None):
+    """Run lines as a script and return how many lines per second were run"""
+    app = BenchmarkApp(allow_cli_args=False)
+    with open(os.devnull, 'w') as devnull:
+        app.stdout = devnull
+        start = time.perf_counter()
+        app.runcmds_plus_hooks(lines, batch=batch)
+        elapsed = time.perf_counter() - start
+
+    if redirect_to is not None:
+        os.remove(redirect_to)
+    return len(lines) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('lines', nargs='?', type=int, default=100000, help='number of lines in each script')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        out_file = os.path.join(tmpdir, 'out.txt')
+        scripts = [
+            ('no redirection', ['nop {}'.format(i) for i in range(args.lines)], None),
+            ('every line >> file', ['say {} >> {}'.format(i, out_file) for i in range(args.lines)], out_file),
+        ]
+
+        print('{:<20} {:>14} {:>14}'.format('script', 'lines/sec', 'batch lines/sec'))
+        for name, lines, redirect_to in scripts:
+            plain = run(lines, batch=False, redirect_to=redirect_to)
+            batch = run(lines, batch=True, redirect_to=redirect_to)
+            print('{:<20} {:>14,.0f} {:>14,.0f}'.format(name, plain, batch))
+
+
+if __name__ == '__main__':
+    main()
@@ -34,24 +34,30 @@ import cmd
 import glob
 import inspect
 import os
-import pickle
 import re
 import sys
 import threading
+import time
+import weakref
 from code import InteractiveConsole
 from collections import namedtuple
 from contextlib import redirect_stdout
-from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Type, Union
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, TextIO, Tuple, Type, Union
+
+import attr
 
 from . import ansi
 from . import constants
+from . import filters
+from . import metrics
 from . import plugin
 from . import utils
 from .argparse_custom import Cmd2ArgumentParser, CompletionItem
 from .clipboard import can_clip, get_paste_buffer, write_to_paste_buffer
+from .coprocess import ShellCoprocess
 from .decorators import with_argparser
-from .history import History, HistoryItem
-from .parsing import StatementParser, Statement, Macro, MacroArg, shlex_split
+from .history import History, HistoryItem, HistoryJournal, MappedHistory, RingHistory, SharedHistoryJournal
+from .parsing import StatementParser, Statement, Macro, MacroArg, MultilineLexer, shlex_split
 from .rl_utils import rl_type, RlType, rl_get_point, rl_set_prompt, vt100_support, rl_make_safe_prompt
 
 # Set up readline
@@ -90,6 +96,50 @@ except ImportError:  # pragma: no cover
     ipython_available = False
 
 
+def _cpu_time() -> float:
+    """Return the CPU time used by this process and its finished child processes, like ones run by shell"""
+    times = os.times()
+    return time.process_time() + times.children_user + times.children_system
+
+
+def _history_time(value: str) -> float:
+    """Convert the TIME argument of the history command to seconds since the epoch
+
+    :param value: a local date, a local date and time, or an age like 30m which is subtracted from now
+    :raises argparse.ArgumentTypeError if value isn't in one of these formats
+    """
+    import datetime
+
+    match = re.fullmatch(r'(\d+(?:\.\d+)?)([smhdw])', value.strip())
+    if match:
+        seconds = float(match.group(1)) * _HISTORY_TIME_UNITS[match.group(2)]
+        return time.time() - seconds
+
+    for fmt in ['%Y-%m-%d', '%Y-%m-%d %H:%M', '%Y-%m-%d %H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%dT%H:%M:%S']:
+        try:
+            return time.mktime(datetime.datetime.strptime(value.strip(), fmt).timetuple())
+        except ValueError:
+            pass
+    raise argparse.ArgumentTypeError('invalid time: {!r}'.format(value))
+
+
+# Number of seconds in each unit of the ages accepted by _history_time()
+_HISTORY_TIME_UNITS = {'s': 1, 'm': 60, 'h': 60 * 60, 'd': 24 * 60 * 60, 'w': 7 * 24 * 60 * 60}
+
+
+def _readline_lines(items: Iterable[HistoryItem]) -> Iterable[str]:
+    """Generate the lines readline's history should contain for a sequence of HistoryItems"""
+    last = None
+    for item in items:
+        # Break the command into its individual lines
+        for line in item.raw.splitlines():
+            # readline only adds a single entry for multiple sequential identical lines
+            # so we emulate that behavior here
+            if line != last:
+                yield line
+                last = line
+
+
 class _SavedReadlineSettings:
     """readline settings that are backed up when switching between readline environments"""
     def __init__(self):
@@ -121,6 +171,106 @@ class EmptyStatement(Exception):
 # Contains data about a disabled command which is used to restore its original functions when the command is enabled
 DisabledCommand = namedtuple('DisabledCommand', ['command_function', 'help_function', 'completer_function'])
 
+# Prefixes of the names of the functions which _FunctionRegistry keeps track of
+_FUNCTION_PREFIXES = (constants.COMMAND_FUNC_PREFIX, constants.HELP_FUNC_PREFIX, constants.COMPLETER_FUNC_PREFIX)
+
+
+class _FunctionRegistry:
+    """Keeps track of the command, help, and completer functions of a Cmd instance
+
+    The functions a class defines are found with dir() once per class. The names of the functions are cached
+    until an attribute of the class or one of its bases changes or an attribute with one of the prefixes is
+    assigned to or deleted from the instance. Changes are found by comparing the namespaces with snapshots of
+    them, which is done in C and doesn't call anything for values which are the same objects.
+    """
+    # Maps each class to the snapshot of its namespaces when it was scanned and the function names it has
+    _class_functions = weakref.WeakKeyDictionary()
+
+    def __init__(self, instance: Any) -> None:
+        """Initialize an instance of _FunctionRegistry
+
+        :param instance: the Cmd instance whose functions are tracked
+        """
+        self._cls = type(instance)
+
+        # This is the namespace of the instance. The instance itself isn't kept since it holds this registry.
+        self._instance_dict = vars(instance)
+
+        # Maps prefixes to the sorted names and set of names of the functions with them
+        self._cache = {}
+        self._class_snapshot = None
+        self._instance_snapshot = None
+
+    def names(self, prefix: str) -> List[str]:
+        """Get the sorted names of the functions with a prefix, without the prefix. The list must not be modified."""
+        return self._lookup(prefix)[0]
+
+    def contains(self, prefix: str, name: str) -> bool:
+        """Return whether there is a function with a prefix and name"""
+        return name in self._lookup(prefix)[1]
+
+    @staticmethod
+    def _snapshot(cls: type) -> Tuple[Tuple[type, ...], Tuple[Dict[str, Any], ...]]:
+        """Copy the namespaces of a class and its bases"""
+        return cls.__mro__, tuple(dict(vars(klass)) for klass in cls.__mro__)
+
+    @staticmethod
+    def _unchanged(cls: type, snapshot: Optional[Tuple[Tuple[type, ...], Tuple[Dict[str, Any], ...]]]) -> bool:
+        """Return whether the namespaces of a class and its bases are the same as in a snapshot"""
+        if snapshot is None or cls.__mro__ != snapshot[0]:
+            return False
+        try:
+            return all(vars(klass) == namespace for klass, namespace in zip(snapshot[0], snapshot[1]))
+        except Exception:
+            # A value which was replaced has an __eq__ which doesn't return a bool
+            return False
+
+    def _lookup(self, prefix: str) -> Tuple[List[str], frozenset]:
+        """Get the sorted names and set of names of the functions with a prefix"""
+        # Functions can also be added to, replaced in, or deleted from the class or the instance at runtime
+        if not self._unchanged(self._cls, self._class_snapshot):
+            self._cache.clear()
+            self._class_snapshot = self._snapshot(self._cls)
+
+        instance_snapshot = {attr_name: value for attr_name, value in self._instance_dict.items()
+                             if attr_name.startswith(_FUNCTION_PREFIXES)}
+        if instance_snapshot != self._instance_snapshot:
+            self._cache.clear()
+            self._instance_snapshot = instance_snapshot
+
+        result = self._cache.get(prefix)
+        if result is None:
+            names = set(self._functions_of_class(self._cls, self._class_snapshot)[prefix])
+            for attr_name, value in instance_snapshot.items():
+                if attr_name.startswith(prefix):
+                    if callable(value):
+                        names.add(attr_name[len(prefix):])
+                    else:
+                        names.discard(attr_name[len(prefix):])
+            result = self._cache[prefix] = (sorted(names), frozenset(names))
+        return result
+
+    @classmethod
+    def _functions_of_class(cls, klass: type,
+                            snapshot: Tuple[Tuple[type, ...], Tuple[Dict[str, Any], ...]]) -> Dict[str, frozenset]:
+        """Get the names of the functions a class has for each prefix
+
+        :param klass: the class being scanned
+        :param snapshot: the current snapshot of its namespaces
+        """
+        cached = cls._class_functions.get(klass)
+        if cached is not None and cls._unchanged(klass, cached[0]):
+            return cached[1]
+
+        functions = {prefix: set() for prefix in _FUNCTION_PREFIXES}
+        for attr_name in dir(klass):
+            for prefix in _FUNCTION_PREFIXES:
+                if attr_name.startswith(prefix) and callable(getattr(klass, attr_name, None)):
+                    functions[prefix].add(attr_name[len(prefix):])
+        functions = {prefix: frozenset(names) for prefix, names in functions.items()}
+        cls._class_functions[klass] = (snapshot, functions)
+        return functions
+
 
 class Cmd(cmd.Cmd):
     """An easy but powerful framework for writing line-oriented command interpreters.
@@ -145,7 +295,9 @@ class Cmd(cmd.Cmd):
                  startup_script: str = '', use_ipython: bool = False,
                  allow_cli_args: bool = True, transcript_files: Optional[List[str]] = None,
                  allow_redirection: bool = True, multiline_commands: Optional[List[str]] = None,
-                 terminators: Optional[List[str]] = None, shortcuts: Optional[Dict[str, str]] = None) -> None:
+                 terminators: Optional[List[str]] = None, shortcuts: Optional[Dict[str, str]] = None,
+                 memory_mapped_history: bool = False, history_max_items: int = 0,
+                 readline_history_preload: int = 0, shared_history: bool = False) -> None:
         """An easy but powerful framework for writing line-oriented command interpreters, extends Python's cmd package.
 
         :param completekey: readline name of a completion key, default to Tab
@@ -168,6 +320,20 @@ class Cmd(cmd.Cmd):
                             terminators to be treated as literals by the parser, then set this to an empty list.
         :param shortcuts: dictionary containing shortcuts for commands. If not supplied, then defaults to
                           constants.DEFAULT_SHORTCUTS.
+        :param memory_mapped_history: if True, history is kept in a memory-mapped temporary file instead of in
+                                      memory. HistoryItems are only created when they are retrieved. This is
+                                      useful for long running applications with a lot of history.
+        :param history_max_items: if greater than 0, history is kept in a ring buffer holding at most this many
+                                  commands. The oldest commands are dropped as new ones are added, and commands
+                                  keep their history numbers across sessions. This can't be combined with
+                                  memory_mapped_history.
+        :param readline_history_preload: if greater than 0, only this many of the most recent persisted commands
+                                         are added to readline's history before the first prompt. The older ones
+                                         are added by a background thread once cmdloop() displays its first
+                                         prompt so large histories don't delay it.
+        :param shared_history: if True, several processes can use the same persistent_history_file at the same time.
+                               Writes are made while holding a lock on the file, and the history command shows the
+                               commands other processes have run since it was last used.
         """
         # If use_ipython is False, make sure the ipy command isn't available in this instance
         if not use_ipython:
@@ -187,6 +353,7 @@ class Cmd(cmd.Cmd):
         # To prevent a user from altering these with the py/ipy commands, remove locals_in_py from the
         # settable dictionary during your applications's __init__ method.
         self.default_to_shell = False  # Attempt to run unrecognized commands as shell commands
+        self.persistent_shell = False  # Run shell commands in one long-running shell instead of a new one each time
         self.quit_on_sigint = False  # Quit the loop on interrupt instead of just resetting prompt
         self.allow_redirection = allow_redirection  # Security setting to prevent redirection of stdout
 
@@ -231,6 +398,12 @@ class Cmd(cmd.Cmd):
 
         # Initialize history
         self._persistent_history_length = persistent_history_length
+        if memory_mapped_history and history_max_items > 0:
+            raise ValueError('memory_mapped_history and history_max_items can not be used together')
+        self._memory_mapped_history = memory_mapped_history
+        self._history_max_items = history_max_items
+        self._readline_history_preload = readline_history_preload
+        self._shared_history = shared_history
         self._initialize_history(persistent_history_file)
 
         # Commands to exclude from the history command
@@ -271,10 +444,28 @@ class Cmd(cmd.Cmd):
         # Context manager used to protect critical sections in the main thread from stopping due to a KeyboardInterrupt
         self.sigint_protection = utils.ContextFlag()
 
+        # Terminal attributes of stdout saved by cmdloop(), or by a command run outside of it, as a
+        # (file descriptor, attributes) tuple. Restored after each command if a command left the terminal
+        # in a different state.
+        self._terminal_state = None
+
         # If the current command created a process to pipe to, then this will be a ProcReader object.
         # Otherwise it will be None. Its used to know when a pipe process can be killed and/or waited upon.
         self._cur_pipe_proc_reader = None
 
+        # The long-running shell used by do_shell() when persistent_shell is True
+        self._shell_coprocess = None
+
+        # Filters which command output can be piped through in-process with |>, keyed by name
+        self.pipe_filters = dict(filters.BUILTIN_FILTERS)
+
+        # True while runcmds_plus_hooks() is running commands in batch mode
+        self._in_batch = False
+
+        # In batch mode, a (redirection token, path, file) tuple for the file the last command redirected its
+        # output to. The file is kept open in case the next command redirects to it the same way.
+        self._batch_output = None
+
         # Used by complete() for readline tab completion
         self.completion_matches = []
 
@@ -386,6 +577,20 @@ class Cmd(cmd.Cmd):
         # being printed by a command.
         self.terminal_lock = threading.RLock()
 
+        # Adds the persisted commands which weren't preloaded to readline's history
+        self._readline_backfill_thread = None
+
+        # Latency histograms of the phases of onecmd_plus_hooks(). Used by the stats command.
+        self.metrics = metrics.CommandMetrics()
+
+        # Used by the profile command. While _profiling is True, onecmd() runs commands with a cProfile.Profile
+        # and adds its results to _profile_stats, which maps command names to pstats.Stats objects.
+        # _profile_runs counts how many runs of each command have been added.
+        self._profiling = False
+        self._profile_stats = dict()
+        self._profile_runs = dict()
+        self._active_profiler = None
+
         # Commands that have been disabled from use. This is to support commands that are only available
         # during specific states of the application. This dictionary's keys are the command names and its
         # values are DisabledCommand objects.
@@ -606,15 +811,15 @@ class Cmd(cmd.Cmd):
         tmp_line = line[:endidx]
         tmp_endidx = endidx
 
-        # Parse the line into tokens
+        # Parse the line into tokens which are further split on punctuation characters
         while True:
             try:
-                initial_tokens = shlex_split(tmp_line[:tmp_endidx])
+                raw_tokens = self.statement_parser.split_line(tmp_line[:tmp_endidx])
 
                 # If the cursor is at an empty token outside of a quoted string,
                 # then that is the token being completed. Add it to the list.
                 if not unclosed_quote and begidx == tmp_endidx:
-                    initial_tokens.append('')
+                    raw_tokens.append('')
                 break
             except ValueError as ex:
                 # Make sure the exception was due to an unclosed quote and
@@ -632,9 +837,6 @@ class Cmd(cmd.Cmd):
                     # Return empty lists since this means the line is malformed.
                     return [], []
 
-        # Further split tokens on punctuation characters
-        raw_tokens = self.statement_parser.split_on_punctuation(initial_tokens)
-
         # Save the unquoted tokens
         tokens = [utils.strip_quotes(cur_token) for cur_token in raw_tokens]
 
@@ -1220,7 +1422,7 @@ class Cmd(cmd.Cmd):
             compfunc = self.path_complete
 
         # Check if a command was entered
-        elif command in self.get_all_commands():
+        elif self._is_command(command):
             # Get the completer function for this command
             compfunc = getattr(self, constants.COMPLETER_FUNC_PREFIX + command, None)
 
@@ -1350,15 +1552,14 @@ class Cmd(cmd.Cmd):
                 # from text and update the indexes. This only applies if we are at the the beginning of the line.
                 shortcut_to_restore = ''
                 if begidx == 0:
-                    for (shortcut, _) in self.statement_parser.shortcuts:
-                        if text.startswith(shortcut):
-                            # Save the shortcut to restore later
-                            shortcut_to_restore = shortcut
+                    shortcut_match = self.statement_parser.match_shortcut(text)
+                    if shortcut_match is not None:
+                        # Save the shortcut to restore later
+                        shortcut_to_restore = shortcut_match[0]
 
-                            # Adjust text and where it begins
-                            text = text[len(shortcut_to_restore):]
-                            begidx += len(shortcut_to_restore)
-                            break
+                        # Adjust text and where it begins
+                        text = text[len(shortcut_to_restore):]
+                        begidx += len(shortcut_to_restore)
 
                 # If begidx is greater than 0, then we are no longer completing the first token (command name)
                 if begidx > 0:
@@ -1415,14 +1616,37 @@ class Cmd(cmd.Cmd):
         """Read-only property to access the aliases stored in the StatementParser"""
         return self.statement_parser.aliases
 
+    def _get_function_registry(self) -> _FunctionRegistry:
+        """Get the registry of this instance's command, help, and completer functions"""
+        registry = self.__dict__.get('_function_registry')
+        if registry is None or registry._cls is not type(self) or registry._instance_dict is not self.__dict__:
+            registry = self._function_registry = _FunctionRegistry(self)
+        return registry
+
+    def _function_names(self, prefix: str) -> List[str]:
+        """Get the sorted names of the functions with a prefix, without the prefix. The list must not be modified.
+
+        :param prefix: COMMAND_FUNC_PREFIX, HELP_FUNC_PREFIX, or COMPLETER_FUNC_PREFIX
+        """
+        # Respect a get_names() which was overridden to hide functions
+        if type(self).get_names is not Cmd.get_names:
+            return [name[len(prefix):] for name in self.get_names()
+                    if name.startswith(prefix) and callable(getattr(self, name))]
+        return self._get_function_registry().names(prefix)
+
+    def _is_command(self, command: str) -> bool:
+        """Return whether a command exists"""
+        if type(self).get_names is not Cmd.get_names:
+            return command in self._function_names(constants.COMMAND_FUNC_PREFIX)
+        return self._get_function_registry().contains(constants.COMMAND_FUNC_PREFIX, command)
+
     def get_names(self):
         """Return an alphabetized list of names comprising the attributes of the cmd2 class instance."""
         return dir(self)
 
     def get_all_commands(self) -> List[str]:
         """Return a list of all commands"""
-        return [name[len(constants.COMMAND_FUNC_PREFIX):] for name in self.get_names()
-                if name.startswith(constants.COMMAND_FUNC_PREFIX) and callable(getattr(self, name))]
+        return list(self._function_names(constants.COMMAND_FUNC_PREFIX))
 
     def get_visible_commands(self) -> List[str]:
         """Return a list of commands that have not been hidden or disabled"""
@@ -1450,8 +1674,7 @@ class Cmd(cmd.Cmd):
 
     def get_help_topics(self) -> List[str]:
         """Return a list of help topics"""
-        all_topics = [name[len(constants.HELP_FUNC_PREFIX):] for name in self.get_names()
-                      if name.startswith(constants.HELP_FUNC_PREFIX) and callable(getattr(self, name))]
+        all_topics = self._function_names(constants.HELP_FUNC_PREFIX)
 
         # Filter out hidden and disabled commands
         return [topic for topic in all_topics
@@ -1507,6 +1730,9 @@ class Cmd(cmd.Cmd):
         """
         import datetime
 
+        # Measures how long each phase takes if metrics are enabled
+        timer = self.metrics.start()
+
         stop = False
         try:
             statement = self._input_line_to_statement(line)
@@ -1517,17 +1743,22 @@ class Cmd(cmd.Cmd):
             self.pexcept("Invalid syntax: {}".format(ex))
             return stop
 
+        if timer is not None:
+            timer.lap(metrics.PHASE_PARSE)
+
+        # cmdloop() saves the terminal state once for all of its commands. When called
+        # directly, save it for this command so it can be restored when the command is done.
+        own_terminal_state = self._terminal_state is None and not self._in_batch
+        if own_terminal_state:
+            self._save_terminal_state()
+
         # now that we have a statement, run it with all the hooks
         try:
             # call the postparsing hooks
-            data = plugin.PostparsingData(False, statement)
-            for func in self._postparsing_hooks:
-                data = func(data)
-                if data.stop:
-                    break
-            # unpack the data object
-            statement = data.statement
-            stop = data.stop
+            if self._postparsing_hooks:
+                stop, statement = self._run_postparsing_hooks(statement)
+            if timer is not None:
+                timer.lap(metrics.PHASE_POSTPARSING)
             if stop:
                 # we should not run the command, but
                 # we need to run the finalization hooks
@@ -1549,36 +1780,39 @@ class Cmd(cmd.Cmd):
                     redir_error, saved_state = self._redirect_output(statement)
                     self._cur_pipe_proc_reader = saved_state.pipe_proc_reader
 
+                if timer is not None:
+                    timer.lap(metrics.PHASE_REDIRECT)
+
                 # Do not continue if an error occurred while trying to redirect
                 if not redir_error:
                     # See if we need to update self._redirecting
                     if not already_redirecting:
-                        self._redirecting = saved_state.redirecting
+                        self._redirecting = saved_state.redirecting or saved_state.pipe_filter is not None
 
                     timestart = datetime.datetime.now()
 
                     # precommand hooks
-                    data = plugin.PrecommandData(statement)
-                    for func in self._precmd_hooks:
-                        data = func(data)
-                    statement = data.statement
+                    if self._precmd_hooks:
+                        statement = self._run_precmd_hooks(statement)
 
                     # call precmd() for compatibility with cmd.Cmd
                     statement = self.precmd(statement)
+                    if timer is not None:
+                        timer.lap(metrics.PHASE_PRECMD)
 
                     # go run the command function
                     stop = self.onecmd(statement, add_to_history=add_to_history)
+                    if timer is not None:
+                        timer.lap(metrics.PHASE_COMMAND)
 
-                    # postcommand hooks
-                    data = plugin.PostcommandData(stop, statement)
-                    for func in self._postcmd_hooks:
-                        data = func(data)
-
-                    # retrieve the final value of stop, ignoring any statement modification from the hooks
-                    stop = data.stop
+                    # postcommand hooks, which return the final value of stop and ignore any statement modification
+                    if self._postcmd_hooks:
+                        stop = self._run_postcmd_hooks(stop, statement)
 
                     # call postcmd() for compatibility with cmd.Cmd
                     stop = self.postcmd(stop, statement)
+                    if timer is not None:
+                        timer.lap(metrics.PHASE_POSTCMD)
 
                     if self.timing:
                         self.pfeedback('Elapsed: {}'.format(datetime.datetime.now() - timestart))
@@ -1595,55 +1829,116 @@ class Cmd(cmd.Cmd):
                         # Stop saving command's stdout before command finalization hooks run
                         self.stdout.pause_storage = True
 
+                if timer is not None:
+                    timer.lap(metrics.PHASE_RESTORE)
+
         except EmptyStatement:
             # don't do anything, but do allow command finalization hooks to run
             pass
         except Exception as ex:
             self.pexcept(ex)
         finally:
-            return self._run_cmdfinalization_hooks(stop, statement)
+            stop = self._run_cmdfinalization_hooks(stop, statement)
+            if own_terminal_state:
+                self._terminal_state = None
+            if timer is not None:
+                timer.lap(metrics.PHASE_FINALIZATION)
+                self.metrics.record(statement.command, timer)
+            return stop
 
     def _run_cmdfinalization_hooks(self, stop: bool, statement: Optional[Statement]) -> bool:
         """Run the command finalization hooks"""
 
-        with self.sigint_protection:
-            if not sys.platform.startswith('win') and self.stdout.isatty():
+        if self._terminal_state is not None and not self._in_batch:
+            with self.sigint_protection:
                 # Before the next command runs, fix any terminal problems like those
                 # caused by certain binary characters having been printed to it.
-                import subprocess
-                proc = subprocess.Popen(['stty', 'sane'])
-                proc.communicate()
+                self._restore_terminal_state()
+
+        if not self._cmdfinalization_hooks:
+            return stop
 
         try:
+            # retrieve the final value of stop, ignoring any
+            # modifications to the statement
             data = plugin.CommandFinalizationData(stop, statement)
             for func in self._cmdfinalization_hooks:
                 data = func(data)
-            # retrieve the final value of stop, ignoring any
-            # modifications to the statement
             return data.stop
         except Exception as ex:
             self.pexcept(ex)
 
-    def runcmds_plus_hooks(self, cmds: List[Union[HistoryItem, str]], *, add_to_history: bool = True) -> bool:
+    def _save_terminal_state(self) -> None:
+        """Save the terminal attributes of stdout so _restore_terminal_state() can put them back"""
+        self._terminal_state = None
+        if sys.platform.startswith('win'):
+            return
+
+        import termios
+        try:
+            fd = self.stdout.fileno()
+            if os.isatty(fd):
+                self._terminal_state = (fd, termios.tcgetattr(fd))
+        except (AttributeError, OSError, ValueError, termios.error):
+            pass
+
+    def _restore_terminal_state(self) -> None:
+        """Put back the terminal attributes saved by _save_terminal_state() if they have been changed"""
+        import termios
+        fd, saved_attrs = self._terminal_state
+        try:
+            if termios.tcgetattr(fd) != saved_attrs:
+                termios.tcsetattr(fd, termios.TCSADRAIN, saved_attrs)
+        except termios.error:
+            # The terminal is no longer available
+            self._terminal_state = None
+
+    def runcmds_plus_hooks(self, cmds: List[Union[HistoryItem, str]], *, add_to_history: bool = True,
+                           batch: bool = False) -> bool:
         """
         Used when commands are being run in an automated fashion like text scripts or history replays.
         The prompt and command line for each command will be printed if echo is True.
 
+        In batch mode, a file that a command redirects its output to is kept open for the next command if that
+        command redirects to the same file the same way. The terminal is restored once after the last command
+        instead of after every command.
+
         :param cmds: commands to run
         :param add_to_history: If True, then add these commands to history. Defaults to True.
+        :param batch: If True, then run the commands in batch mode. Defaults to False.
         :return: True if running of commands should stop
         """
-        for line in cmds:
-            if isinstance(line, HistoryItem):
-                line = line.raw
+        if not batch or self._in_batch:
+            for line in cmds:
+                if isinstance(line, HistoryItem):
+                    line = line.raw
 
-            if self.echo:
-                self.poutput('{}{}'.format(self.prompt, line))
+                if self.echo:
+                    self.poutput('{}{}'.format(self.prompt, line))
 
-            if self.onecmd_plus_hooks(line, add_to_history=add_to_history):
-                return True
+                if self.onecmd_plus_hooks(line, add_to_history=add_to_history):
+                    return True
 
-        return False
+            return False
+
+        own_terminal_state = self._terminal_state is None
+        if own_terminal_state:
+            self._save_terminal_state()
+
+        self._in_batch = True
+        saved_batch_output = self._batch_output
+        self._batch_output = None
+        try:
+            return self.runcmds_plus_hooks(cmds, add_to_history=add_to_history)
+        finally:
+            with self.sigint_protection:
+                self._close_batch_output()
+                self._batch_output = saved_batch_output
+                self._in_batch = False
+                if self._terminal_state is not None:
+                    self._restore_terminal_state()
+                if own_terminal_state:
+                    self._terminal_state = None
 
     def _complete_statement(self, line: str) -> Statement:
         """Keep accepting lines of input until the command is complete.
@@ -1656,23 +1951,31 @@ class Cmd(cmd.Cmd):
         :param line: the line being parsed
         :return: the completed Statement
         """
+        # Once we know this is a multiline command, the lexer tokenizes each new line as it is
+        # entered so the accumulated input only gets parsed again once it is complete
+        lexer = None
+
         while True:
-            try:
-                statement = self.statement_parser.parse(line)
-                if statement.multiline_command and statement.terminator:
-                    # we have a completed multiline command, we are done
-                    break
-                if not statement.multiline_command:
-                    # it's not a multiline command, but we parsed it ok
-                    # so we are done
-                    break
-            except ValueError:
-                # we have unclosed quotation marks, lets parse only the command
-                # and see if it's a multiline
-                statement = self.statement_parser.parse_command_only(line)
-                if not statement.multiline_command:
-                    # not a multiline command, so raise the exception
-                    raise
+            if lexer is None or lexer.complete:
+                try:
+                    statement = self.statement_parser.parse(line)
+                    if statement.multiline_command and statement.terminator:
+                        # we have a completed multiline command, we are done
+                        break
+                    if not statement.multiline_command:
+                        # it's not a multiline command, but we parsed it ok
+                        # so we are done
+                        break
+                except ValueError:
+                    # we have unclosed quotation marks, lets parse only the command
+                    # and see if it's a multiline
+                    statement = self.statement_parser.parse_command_only(line)
+                    if not statement.multiline_command:
+                        # not a multiline command, so raise the exception
+                        raise
+
+                if lexer is None:
+                    lexer = MultilineLexer(self.statement_parser, line)
 
             # if we get here we must have:
             #   - a multiline command with no terminator
@@ -1692,6 +1995,7 @@ class Cmd(cmd.Cmd):
                     nextline = '\n'
                     self.poutput(nextline)
                 line = '{}{}'.format(self._multiline_in_progress, nextline)
+                lexer.add_line(nextline)
             except KeyboardInterrupt as ex:
                 if self.quit_on_sigint:
                     raise ex
@@ -1738,16 +2042,17 @@ class Cmd(cmd.Cmd):
         if orig_line != statement.raw:
             # Build a Statement that contains the resolved macro line
             # but the originally typed line for its raw member.
-            statement = Statement(statement.args,
-                                  raw=orig_line,
-                                  command=statement.command,
-                                  arg_list=statement.arg_list,
-                                  multiline_command=statement.multiline_command,
-                                  terminator=statement.terminator,
-                                  suffix=statement.suffix,
-                                  pipe_to=statement.pipe_to,
-                                  output=statement.output,
-                                  output_to=statement.output_to)
+            statement = Statement._create(statement.args,
+                                          raw=orig_line,
+                                          command=statement.command,
+                                          arg_list=statement.arg_list,
+                                          multiline_command=statement.multiline_command,
+                                          terminator=statement.terminator,
+                                          suffix=statement.suffix,
+                                          filters=statement.filters,
+                                          pipe_to=statement.pipe_to,
+                                          output=statement.output,
+                                          output_to=statement.output_to)
         return statement
 
     def _resolve_macro(self, statement: Statement) -> Optional[str]:
@@ -1772,28 +2077,19 @@ class Cmd(cmd.Cmd):
             )
             return None
 
-        # Resolve the arguments in reverse and read their values from statement.argv since those
-        # are unquoted. Macro args should have been quoted when the macro was created.
-        resolved = macro.value
-        reverse_arg_list = sorted(macro.arg_list, key=lambda ma: ma.start_index, reverse=True)
-
-        for arg in reverse_arg_list:
-            if arg.is_escaped:
-                to_replace = '{{' + arg.number_str + '}}'
-                replacement = '{' + arg.number_str + '}'
-            else:
-                to_replace = '{' + arg.number_str + '}'
-                replacement = statement.argv[int(arg.number_str)]
-
-            parts = resolved.rsplit(to_replace, maxsplit=1)
-            resolved = parts[0] + replacement + parts[1]
+        # Fill in the arguments from statement.argv since those are unquoted.
+        # Macro args should have been quoted when the macro was created.
+        argv = statement.argv
+        resolved = [argv[part] if isinstance(part, int) else part for part in macro.template]
 
         # Append extra arguments and use statement.arg_list since these arguments need their quotes preserved
         for arg in statement.arg_list[macro.minimum_arg_count:]:
-            resolved += ' ' + arg
+            resolved.append(' ')
+            resolved.append(arg)
 
         # Restore any terminator, suffix, redirection, etc.
-        return resolved + statement.post_command
+        resolved.append(statement.post_command)
+        return ''.join(resolved)
 
     def _redirect_output(self, statement: Statement) -> Tuple[bool, utils.RedirectionSavedState]:
         """Handles output redirection for >, >>, and |.
@@ -1809,9 +2105,22 @@ class Cmd(cmd.Cmd):
         # Initialize the saved state
         saved_state = utils.RedirectionSavedState(self.stdout, sys.stdout, self._cur_pipe_proc_reader)
 
+        # The file kept open by the last command of a batch, if this command redirects to it too
+        batch_output = self._take_batch_output(statement)
+
         if not self.allow_redirection:
             return redir_error, saved_state
 
+        # Prepare the filters before redirecting anything, so one with invalid arguments stops the command right away
+        line_filters = []
+        for filter_line in statement.filters:
+            line_filter = self._prepare_pipe_filter(filter_line)
+            if line_filter is None:
+                if batch_output is not None:
+                    batch_output.close()
+                return True, saved_state
+            line_filters.append(line_filter)
+
         if statement.pipe_to:
             # Create a pipe with read and write sides
             read_fd, write_fd = os.pipe()
@@ -1831,25 +2140,22 @@ class Cmd(cmd.Cmd):
                 start_new_session = True
 
             # For any stream that is a StdSim, we will use a pipe so we can capture its output
-            proc = subprocess.Popen(statement.pipe_to,
-                                    stdin=subproc_stdin,
-                                    stdout=subprocess.PIPE if isinstance(self.stdout, utils.StdSim) else self.stdout,
-                                    stderr=subprocess.PIPE if isinstance(sys.stderr, utils.StdSim) else sys.stderr,
-                                    creationflags=creationflags,
-                                    start_new_session=start_new_session,
-                                    shell=True)
-
-            # Popen was called with shell=True so the user can chain pipe commands and redirect their output
-            # like: !ls -l | grep user | wc -l > out.txt. But this makes it difficult to know if the pipe process
-            # started OK, since the shell itself always starts. Therefore, we will wait a short time and check
-            # if the pipe process is still running.
-            try:
-                proc.wait(0.2)
-            except subprocess.TimeoutExpired:
-                pass
-
-            # Check if the pipe process already exited
-            if proc.returncode is not None:
+            proc = utils.popen_shell_command(statement.pipe_to,
+                                             stdin=subproc_stdin,
+                                             stdout=subprocess.PIPE if isinstance(self.stdout, utils.StdSim) else self.stdout,
+                                             stderr=subprocess.PIPE if isinstance(sys.stderr, utils.StdSim) else sys.stderr,
+                                             creationflags=creationflags,
+                                             start_new_session=start_new_session)
+
+            # The command is run by a shell unless it is a program and its arguments, so the user can chain pipe
+            # commands and redirect their output like: !ls -l | grep user | wc -l > out.txt. But this makes it
+            # difficult to know if the pipe process started OK, since the shell itself always starts. Rather than
+            # waiting to see if the shell exits, only check if it already has. If the command is a program and its
+            # arguments but the program couldn't be found, the shell was left to report it and its exit code is
+            # reported once _restore_output() collects it. Other exit codes may be the program's own.
+            pipe_args = utils.split_simple_command(statement.pipe_to)
+            saved_state.pipe_program_missing = pipe_args is not None and utils.find_program(pipe_args[0]) is None
+            if proc.poll() is not None:
                 self.perror('Pipe process exited with code {} before command could run'.format(proc.returncode))
                 subproc_stdin.close()
                 new_stdout.close()
@@ -1873,10 +2179,18 @@ class Cmd(cmd.Cmd):
                 if statement.output == constants.REDIRECTION_APPEND:
                     mode = 'a'
                 try:
-                    new_stdout = open(utils.strip_quotes(statement.output_to), mode)
+                    if batch_output is not None:
+                        new_stdout = batch_output
+                        if mode == 'w':
+                            new_stdout.seek(0)
+                            new_stdout.truncate()
+                    else:
+                        new_stdout = open(utils.strip_quotes(statement.output_to), mode)
                     saved_state.redirecting = True
                     sys.stdout = self.stdout = new_stdout
                 except OSError as ex:
+                    if batch_output is not None:
+                        batch_output.close()
                     self.pexcept('Failed to redirect because - {}'.format(ex))
                     redir_error = True
             else:
@@ -1889,8 +2203,38 @@ class Cmd(cmd.Cmd):
                     self.stdout.write(get_paste_buffer())
                     self.stdout.flush()
 
+        if line_filters and not redir_error:
+            # The filters write to wherever output would have gone without them
+            saved_state.pipe_filter = filters.FilterPipeline(line_filters, self.stdout)
+            sys.stdout = self.stdout = saved_state.pipe_filter.input
+
         return redir_error, saved_state
 
+    def _prepare_pipe_filter(self, filter_line: str) -> Optional[filters.LineFilter]:
+        """Find the filter a command line after |> runs and parse its arguments
+
+        :param filter_line: the name of the filter followed by its arguments
+        :return: the filter with its arguments applied or None if the filter wasn't found or its arguments were invalid
+        """
+        argv = [utils.strip_quotes(token) for token in shlex_split(filter_line)]
+        if not argv:
+            self.perror('Missing filter after {}'.format(constants.REDIRECTION_FILTER))
+            return None
+
+        pipe_filter = self.pipe_filters.get(argv[0])
+        if pipe_filter is None:
+            self.perror("'{}' is not a filter. Filters: {}".format(argv[0], ', '.join(sorted(self.pipe_filters))))
+            if argv[0] in self.get_all_commands():
+                # Commands read their arguments, not the output of another command, so they can't be filters
+                self.perror("Commands can't follow {}".format(constants.REDIRECTION_FILTER))
+            return None
+
+        try:
+            return pipe_filter.prepare(argv[1:])
+        except SystemExit:
+            # argparse printed the error or help text
+            return None
+
     def _restore_output(self, statement: Statement, saved_state: utils.RedirectionSavedState) -> None:
         """Handles restoring state after output redirection as well as
         the actual pipe operation if present.
@@ -1898,17 +2242,31 @@ class Cmd(cmd.Cmd):
         :param statement: Statement object which contains the parsed input from the user
         :param saved_state: contains information needed to restore state data
         """
+        if saved_state.pipe_filter is not None:
+            error = saved_state.pipe_filter.wait()
+
+            # Go back to the output the filters wrote to
+            self.stdout = saved_state.pipe_filter.output
+            sys.stdout = self.stdout if saved_state.redirecting else saved_state.saved_sys_stdout
+            if error is not None:
+                self.perror('Filter failed: {}'.format(error))
+
         if saved_state.redirecting:
             # If we redirected output to the clipboard
             if statement.output and not statement.output_to:
                 self.stdout.seek(0)
                 write_to_paste_buffer(self.stdout.read())
 
-            try:
-                # Close the file or pipe that stdout was redirected to
-                self.stdout.close()
-            except BrokenPipeError:
-                pass
+            if self._in_batch and statement.output_to:
+                # Keep the file open in case the next command redirects to it too
+                self.stdout.flush()
+                self._batch_output = (statement.output, utils.strip_quotes(statement.output_to), self.stdout)
+            else:
+                try:
+                    # Close the file or pipe that stdout was redirected to
+                    self.stdout.close()
+                except BrokenPipeError:
+                    pass
 
             # Restore the stdout values
             self.stdout = saved_state.saved_self_stdout
@@ -1916,11 +2274,47 @@ class Cmd(cmd.Cmd):
 
             # Check if we need to wait for the process being piped to
             if self._cur_pipe_proc_reader is not None:
-                self._cur_pipe_proc_reader.wait()
+                returncode = self._cur_pipe_proc_reader.wait()
+                if returncode != 0 and saved_state.pipe_program_missing:
+                    self.perror('Pipe process exited with code {}'.format(returncode))
 
         # Restore _cur_pipe_proc_reader. This always is done, regardless of whether this command redirected.
         self._cur_pipe_proc_reader = saved_state.saved_pipe_proc_reader
 
+    def _take_batch_output(self, statement: Statement) -> Optional[TextIO]:
+        """Get the file kept open by the last command of a batch if a statement redirects to it the same way.
+        Otherwise the file is closed.
+
+        :param statement: the statement about to run
+        :return: the file or None
+        """
+        if self._batch_output is None:
+            return None
+
+        output, path, fobj = self._batch_output
+        self._batch_output = None
+
+        if self.allow_redirection and statement.output == output and statement.output_to and \
+                utils.strip_quotes(statement.output_to) == path:
+            # Make sure the path still refers to the open file
+            try:
+                open_stat = os.fstat(fobj.fileno())
+                path_stat = os.stat(path)
+            except OSError:
+                pass
+            else:
+                if (open_stat.st_dev, open_stat.st_ino) == (path_stat.st_dev, path_stat.st_ino):
+                    return fobj
+
+        fobj.close()
+        return None
+
+    def _close_batch_output(self) -> None:
+        """Close the file kept open by the last command of a batch"""
+        if self._batch_output is not None:
+            self._batch_output[2].close()
+            self._batch_output = None
+
     def cmd_func(self, command: str) -> Optional[Callable]:
         """
         Get the function for a command
@@ -1954,15 +2348,20 @@ class Cmd(cmd.Cmd):
         if not isinstance(statement, Statement):
             statement = self._input_line_to_statement(statement)
 
+        # Commands run by another command are included in that command's profile
+        if self._profiling and self._active_profiler is None and statement.command and \
+                statement.command != 'profile':
+            return self._profile_onecmd(statement, add_to_history=add_to_history)
+
         func = self.cmd_func(statement.command)
         if func:
             # Check to see if this command should be stored in history
             if statement.command not in self.exclude_from_history and \
                     statement.command not in self.disabled_commands and add_to_history:
 
-                self.history.append(statement)
-
-            stop = func(statement)
+                stop = self._run_and_add_to_history(statement, func)
+            else:
+                stop = func(statement)
 
         else:
             stop = self.default(statement)
@@ -1972,17 +2371,42 @@ class Cmd(cmd.Cmd):
 
         return stop
 
+    def _profile_onecmd(self, statement: Statement, *, add_to_history: bool) -> bool:
+        """Run onecmd() with a profiler and add its results to the stats for the command"""
+        import cProfile
+        import pstats
+
+        self._active_profiler = cProfile.Profile()
+        try:
+            self._active_profiler.enable()
+            try:
+                return self.onecmd(statement, add_to_history=add_to_history)
+            finally:
+                self._active_profiler.disable()
+        finally:
+            profiler = self._active_profiler
+            self._active_profiler = None
+
+            command = statement.command
+            if command in self._profile_stats:
+                self._profile_stats[command].add(profiler)
+            else:
+                self._profile_stats[command] = pstats.Stats(profiler)
+            self._profile_runs[command] = self._profile_runs.get(command, 0) + 1
+
     def default(self, statement: Statement) -> Optional[bool]:
         """Executed when the command given isn't a recognized command implemented by a do_* method.
 
         :param statement: Statement object with parsed input
         """
         if self.default_to_shell:
-            if 'shell' not in self.exclude_from_history:
-                self.history.append(statement)
-
             # noinspection PyTypeChecker
-            return self.do_shell(statement.command_and_args)
+            def run_shell(shell_statement: Statement) -> Optional[bool]:
+                return self.do_shell(shell_statement.command_and_args)
+
+            if 'shell' not in self.exclude_from_history:
+                return self._run_and_add_to_history(statement, run_shell)
+            return run_shell(statement)
         else:
             err_msg = self.default_error.format(statement.command)
 
@@ -2141,7 +2565,7 @@ class Cmd(cmd.Cmd):
             self.perror("Invalid alias name: {}".format(errmsg))
             return
 
-        if args.name in self.get_all_commands():
+        if self._is_command(args.name):
             self.perror("Alias cannot have the same name as a command")
             return
 
@@ -2150,8 +2574,7 @@ class Cmd(cmd.Cmd):
             return
 
         # Unquote redirection and terminator tokens
-        tokens_to_unquote = constants.REDIRECTION_TOKENS
-        tokens_to_unquote.extend(self.statement_parser.terminators)
+        tokens_to_unquote = list(constants.REDIRECTION_TOKENS) + list(self.statement_parser.terminators)
         utils.unquote_specific_tokens(args.command_args, tokens_to_unquote)
 
         # Build the alias value string
@@ -2271,7 +2694,7 @@ class Cmd(cmd.Cmd):
             self.perror("Invalid macro name: {}".format(errmsg))
             return
 
-        if args.name in self.get_all_commands():
+        if self._is_command(args.name):
             self.perror("Macro cannot have the same name as a command")
             return
 
@@ -2280,8 +2703,7 @@ class Cmd(cmd.Cmd):
             return
 
         # Unquote redirection and terminator tokens
-        tokens_to_unquote = constants.REDIRECTION_TOKENS
-        tokens_to_unquote.extend(self.statement_parser.terminators)
+        tokens_to_unquote = list(constants.REDIRECTION_TOKENS) + list(self.statement_parser.terminators)
         utils.unquote_specific_tokens(args.command_args, tokens_to_unquote)
 
         # Build the macro value string
@@ -2544,6 +2966,11 @@ class Cmd(cmd.Cmd):
         # Get a sorted list of visible command names
         visible_commands = sorted(self.get_visible_commands(), key=self.default_sort_key)
 
+        # Prevent commands from showing as both a command and help topic in the output
+        topic_set = set(help_topics)
+        visible_command_set = set(visible_commands)
+        help_topics = [topic for topic in help_topics if topic not in visible_command_set]
+
         cmds_doc = []
         cmds_undoc = []
         cmds_cats = {}
@@ -2552,10 +2979,7 @@ class Cmd(cmd.Cmd):
             func = self.cmd_func(command)
             has_help_func = False
 
-            if command in help_topics:
-                # Prevent the command from showing as both a command and help topic in the output
-                help_topics.remove(command)
-
+            if command in topic_set:
                 # Non-argparse commands can have help_functions for their documentation
                 if not hasattr(func, constants.CMD_ATTR_ARGPARSER):
                     has_help_func = True
@@ -2608,7 +3032,7 @@ class Cmd(cmd.Cmd):
                     self.stdout.write('{:{ruler}<{width}}\n'.format('', ruler=self.ruler, width=80))
 
                 # Try to get the documentation string for each command
-                topics = self.get_help_topics()
+                topics = set(self.get_help_topics())
 
                 for command in cmds:
                     cmd_func = self.cmd_func(command)
@@ -2868,11 +3292,20 @@ class Cmd(cmd.Cmd):
         # Prevent KeyboardInterrupts while in the shell process. The shell process will
         # still receive the SIGINT since it is in the same process group as us.
         with self.sigint_protection:
+            if self.persistent_shell and not sys.platform.startswith('win'):
+                if self._shell_coprocess is None:
+                    self._shell_coprocess = ShellCoprocess()
+                self._shell_coprocess.run(expanded_command, self.stdout, sys.stderr)
+                return
+
+            if self._shell_coprocess is not None:
+                self._shell_coprocess.close()
+                self._shell_coprocess = None
+
             # For any stream that is a StdSim, we will use a pipe so we can capture its output
-            proc = subprocess.Popen(expanded_command,
-                                    stdout=subprocess.PIPE if isinstance(self.stdout, utils.StdSim) else self.stdout,
-                                    stderr=subprocess.PIPE if isinstance(sys.stderr, utils.StdSim) else sys.stderr,
-                                    shell=True)
+            proc = utils.popen_shell_command(expanded_command,
+                                             stdout=subprocess.PIPE if isinstance(self.stdout, utils.StdSim) else self.stdout,
+                                             stderr=subprocess.PIPE if isinstance(sys.stderr, utils.StdSim) else sys.stderr)
 
             proc_reader = utils.ProcReader(proc, self.stdout, sys.stderr)
             proc_reader.wait()
@@ -3222,6 +3655,9 @@ class Cmd(cmd.Cmd):
                                       help='output commands and results to a transcript file,\nimplies -s',
                                       completer_method=path_complete)
     history_action_group.add_argument('-c', '--clear', action='store_true', help='clear all history')
+    history_parser.add_argument('-b', '--batch', action='store_true',
+                                help='run the items selected with -r or -e in batch mode,\n'
+                                     'see the -b option of run_script')
 
     history_format_group = history_parser.add_argument_group(title='formatting')
     history_format_group.add_argument('-s', '--script', action='store_true',
@@ -3236,6 +3672,26 @@ class Cmd(cmd.Cmd):
     history_format_group.add_argument('-a', '--all', action='store_true',
                                       help='display all commands, including ones persisted from\n'
                                            'previous sessions')
+    history_format_group.add_argument('-T', '--timing', action='store_true',
+                                      help='display when each command started, its elapsed and CPU\n'
+                                           'time, and whether it succeeded')
+
+    history_timing_group = history_parser.add_argument_group(title='filtering and sorting by how commands ran')
+    history_timing_group.add_argument('--since', metavar='TIME', type=_history_time,
+                                      help='only commands started at or after TIME, which is a\n'
+                                           'date like 2019-10-30, a date and time like\n'
+                                           '"2019-10-30 14:00", or an age like 90s, 30m, 12h, 7d\n'
+                                           'or 2w')
+    history_timing_group.add_argument('--until', metavar='TIME', type=_history_time,
+                                      help='only commands started before TIME')
+    history_timing_group.add_argument('--slower-than', metavar='SECONDS', type=float,
+                                      help='only commands which took at least SECONDS')
+    history_timing_group.add_argument('--failed', action='store_true',
+                                      help='only commands which raised an exception')
+    history_timing_group.add_argument('--sort', choices=['elapsed', 'cpu'],
+                                      help='sort by elapsed or CPU time, slowest first')
+    history_timing_group.add_argument('--limit', metavar='N', type=int,
+                                      help='only the first N commands after filtering and sorting')
 
     history_arg_help = ("empty               all history items\n"
                         "a                   one history item by number\n"
@@ -3250,33 +3706,25 @@ class Cmd(cmd.Cmd):
         View, run, edit, save, or clear previously entered commands
         :return: True if running of commands should stop
         """
-
-        # -v must be used alone with no other options
-        if args.verbose:
-            if args.clear or args.edit or args.output_file or args.run or args.transcript \
-                    or args.expanded or args.script:
-                self.poutput("-v can not be used with any other options")
-                self.poutput(self.history_parser.format_usage())
-                return
-
-        # -s and -x can only be used if none of these options are present: [-c -r -e -o -t]
-        if (args.script or args.expanded) \
-                and (args.clear or args.edit or args.output_file or args.run or args.transcript):
-            self.poutput("-s and -x can not be used with -c, -r, -e, -o, or -t")
-            self.poutput(self.history_parser.format_usage())
+        if not self._check_history_options(args):
             return
 
         if args.clear:
             # Clear command and readline history
             self.history.clear()
 
-            if self.persistent_history_file:
-                os.remove(self.persistent_history_file)
+            if self._history_journal is not None:
+                self._history_journal.clear()
 
             if rl_type != RlType.NONE:
-                readline.clear_history()
+                with self.terminal_lock:
+                    self._readline_backfill_items = None
+                    readline.clear_history()
             return
 
+        # Show the commands other processes have run when history is shared
+        self._merge_shared_history()
+
         # If an argument was supplied, then retrieve partial contents of the history
         cowardly_refuse_to_run = False
         if args.arg:
@@ -3305,12 +3753,14 @@ class Cmd(cmd.Cmd):
             # Get a copy of the history so it doesn't get mutated while we are using it
             history = self.history.span(':', args.all)
 
+        history = self._filter_history_by_timing(args, history)
+
         if args.run:
             if cowardly_refuse_to_run:
                 self.perror("Cowardly refusing to run all previously entered commands.")
                 self.perror("If this is what you want to do, specify '1:' as the range of history.")
             else:
-                return self.runcmds_plus_hooks(history)
+                return self.runcmds_plus_hooks(history, batch=args.batch)
         elif args.edit:
             import tempfile
             fd, fname = tempfile.mkstemp(suffix='.txt', text=True)
@@ -3323,7 +3773,7 @@ class Cmd(cmd.Cmd):
             try:
                 self._run_editor(fname)
                 # noinspection PyTypeChecker
-                self.do_run_script(utils.quote_string(fname))
+                self.do_run_script(('--batch ' if args.batch else '') + utils.quote_string(fname))
             finally:
                 os.remove(fname)
         elif args.output_file:
@@ -3344,21 +3794,81 @@ class Cmd(cmd.Cmd):
         else:
             # Display the history items retrieved
             for hi in history:
-                self.poutput(hi.pr(script=args.script, expanded=args.expanded, verbose=args.verbose))
+                self.poutput(hi.pr(script=args.script, expanded=args.expanded, verbose=args.verbose,
+                                   timing=args.timing))
+
+    def _check_history_options(self, args: argparse.Namespace) -> bool:
+        """Print the usage of the history command if options which can't be used together were given
+
+        :param args: the parsed arguments of the history command
+        :return: True if the options can be used together
+        """
+        # -v must be used alone with no other options
+        if args.verbose:
+            if args.clear or args.edit or args.output_file or args.run or args.transcript \
+                    or args.expanded or args.script or args.batch:
+                self.poutput("-v can not be used with any other options")
+                self.poutput(self.history_parser.format_usage())
+                return False
+
+        # -b can only be used if the items are run
+        if args.batch and not (args.run or args.edit):
+            self.poutput("-b can only be used with -r or -e")
+            self.poutput(self.history_parser.format_usage())
+            return False
+
+        # -s and -x can only be used if none of these options are present: [-c -r -e -o -t]
+        if (args.script or args.expanded) \
+                and (args.clear or args.edit or args.output_file or args.run or args.transcript):
+            self.poutput("-s and -x can not be used with -c, -r, -e, -o, or -t")
+            self.poutput(self.history_parser.format_usage())
+            return False
+
+        return True
+
+    @staticmethod
+    def _filter_history_by_timing(args: argparse.Namespace, history: List[HistoryItem]) -> List[HistoryItem]:
+        """Narrow down and order history items by how their commands ran
+
+        :param args: the parsed arguments of the history command
+        :param history: the history items selected so far
+        :return: the items which pass the --since, --until, --slower-than, and --failed filters, ordered by --sort
+                 and limited to --limit items
+        """
+        if args.since is not None:
+            history = [item for item in history if item.start_time is not None and item.start_time >= args.since]
+        if args.until is not None:
+            history = [item for item in history if item.start_time is not None and item.start_time < args.until]
+        if args.slower_than is not None:
+            history = [item for item in history if item.elapsed is not None and item.elapsed >= args.slower_than]
+        if args.failed:
+            history = [item for item in history if item.succeeded is False]
+        if args.sort:
+            name = 'elapsed' if args.sort == 'elapsed' else 'cpu_time'
+
+            # Commands which weren't timed go last
+            history = sorted(history, key=lambda item: (getattr(item, name) is None, -(getattr(item, name) or 0)))
+        if args.limit is not None:
+            history = history[:max(args.limit, 0)]
+        return history
 
     def _initialize_history(self, hist_file):
         """Initialize history using history related attributes
 
-        This function can determine whether history is saved in the prior text-based
-        format (one line of input is stored as one line in the file), or the new-as-
-        of-version 0.9.13 pickle based format.
+        History is persisted in a journal which has one record per command. Each command is
+        written to it as soon as it finishes running. See HistoryJournal for details.
 
-        History created by versions <= 0.9.12 is in readline format, i.e. plain text files.
+        This function can also read the pickle based format used by versions 0.9.13 through
+        0.9.19. History created by versions <= 0.9.12 is in readline format, i.e. plain text
+        files, and is not read.
 
-        Initializing history does not effect history files on disk, versions >= 0.9.13 always
-        write history in the pickle format.
+        Initializing history does not effect history files on disk. Files in an older format are
+        converted to the journal format the first time history is written.
         """
-        self.history = History()
+        self.history = self._new_history()
+        self._history_journal = None
+        self._readline_backfill_items = None
+
         # with no persistent history, nothing else in this method is relevant
         if not hist_file:
             self.persistent_history_file = hist_file
@@ -3382,56 +3892,200 @@ class Cmd(cmd.Cmd):
             self.pexcept(msg)
             return
 
-        # first we try and unpickle the history file
-        history = History()
-
+        journal = SharedHistoryJournal(hist_file) if self._shared_history else HistoryJournal(hist_file)
         try:
-            with open(hist_file, 'rb') as fobj:
-                history = pickle.load(fobj)
-        except (AttributeError, EOFError, FileNotFoundError, ImportError, IndexError, KeyError, ValueError,
-                pickle.UnpicklingError):
-            # If any of these errors occur when attempting to unpickle, just use an empty history
-            pass
+            items = journal.load(self._persistent_history_length)
         except OSError as ex:
             msg = "Can not read persistent history file '{}': {}"
             self.pexcept(msg.format(hist_file, ex))
             return
 
+        history = self._new_history(items)
         self.history = history
         self.history.start_session()
         self.persistent_history_file = hist_file
+        self._history_journal = journal
 
         # populate readline history
         if rl_type != RlType.NONE:
-            last = None
-            for item in history:
-                # Break the command into its individual lines
-                for line in item.raw.splitlines():
-                    # readline only adds a single entry for multiple sequential identical lines
-                    # so we emulate that behavior here
-                    if line != last:
-                        readline.add_history(line)
-                        last = line
-
-        # register a function to write history at save
-        # if the history file is in plain text format from 0.9.12 or lower
-        # this will fail, and the history in the plain text file will be lost
+            # skip any items which didn't fit in a RingHistory
+            items = items[len(items) - len(history):]
+
+            # Leave all but the most recent items for the background thread started by cmdloop()
+            preload = self._readline_history_preload
+            if 0 < preload < len(items):
+                self._readline_backfill_items = items[:-preload]
+                items = items[-preload:]
+
+            for line in _readline_lines(items):
+                readline.add_history(line)
+
+        # register a function to compact the history file at exit
         import atexit
         atexit.register(self._persist_history)
 
-    def _persist_history(self):
-        """write history out to the history file"""
-        if not self.persistent_history_file:
+    def _backfill_readline_history(self) -> None:
+        """Add the persisted commands which weren't preloaded by _initialize_history() to the start of readline's
+        history. cmdloop() runs this in a background thread which holds terminal_lock while changing readline's
+        history, so it waits for the main thread to be at a prompt.
+        """
+        items = self._readline_backfill_items
+        if not items:
+            return
+
+        # Split the commands before taking the lock since this is the slow part
+        older = list(_readline_lines(items))
+
+        with self.terminal_lock:
+            # history was cleared or the lines were already added
+            if self._readline_backfill_items is not items:
+                return
+            self._readline_backfill_items = None
+
+            # readline can only append to its history, so rebuild it with the older lines first
+            current = [readline.get_history_item(i) for i in range(1, readline.get_current_history_length() + 1)]
+            readline.clear_history()
+            for line in older:
+                readline.add_history(line)
+
+            # readline only adds a single entry for multiple sequential identical lines
+            if current and older and current[0] == older[-1]:
+                current = current[1:]
+            for line in current:
+                readline.add_history(line)
+
+            # Move readline's position to the end of its history in case a prompt is being displayed
+            if rl_type == RlType.GNU:
+                readline_lib.using_history()
+
+    def _new_history(self, items: Iterable[HistoryItem] = ()) -> History:
+        """Create a History of the type this application was configured to use
+
+        :param items: persisted HistoryItems to add to it. Only a RingHistory keeps their numbers.
+        :return: the new History
+        """
+        if self._history_max_items > 0:
+            return RingHistory(items, max_items=self._history_max_items)
+
+        items = [item if item.idx == idx else attr.evolve(item, idx=idx) for idx, item in enumerate(items, start=1)]
+        return MappedHistory(items) if self._memory_mapped_history else History(items)
+
+    def _run_and_add_to_history(self, statement: Statement,
+                                func: Callable[[Statement], Optional[bool]]) -> Optional[bool]:
+        """Add a statement to history and run its command. Once the command finishes, record when it started,
+        how long it took, and whether it raised an exception.
+
+        :param statement: the statement being run
+        :param func: the function which runs the command
+        :return: what func returned
+        """
+        item = self.history.append(statement, start_time=time.time())
+        wall_start = time.perf_counter()
+        cpu_start = _cpu_time()
+        succeeded = False
+        try:
+            stop = func(statement)
+            succeeded = True
+        finally:
+            item = attr.evolve(item,
+                               elapsed=time.perf_counter() - wall_start,
+                               cpu_time=_cpu_time() - cpu_start,
+                               succeeded=succeeded)
+            self.history.update(item)
+            self._add_to_history_file(item)
+        return stop
+
+    def _add_to_history_file(self, item: HistoryItem) -> None:
+        """Write a history item to the persistent history file"""
+        if self._history_journal is None:
             return
 
-        self.history.truncate(self._persistent_history_length)
         try:
-            with open(self.persistent_history_file, 'wb') as fobj:
-                pickle.dump(self.history, fobj)
+            if self._shared_history:
+                # The shared file is compacted from its own contents, which don't include the item yet
+                if self._history_journal.needs_rewrite or self._history_needs_compacting(1):
+                    self._compact_history()
+                self._history_journal.append(item)
+            elif self._history_journal.needs_rewrite or self._history_needs_compacting(1):
+                self._compact_history()
+            else:
+                self._history_journal.append(item)
         except OSError as ex:
+            # Stop trying to write history so this error isn't printed after every command
+            self._history_journal = None
             msg = "Can not write persistent history file '{}': {}"
             self.pexcept(msg.format(self.persistent_history_file, ex))
 
+    def _history_needs_compacting(self, new_records: int = 0) -> bool:
+        """Return whether the history file has grown enough to be compacted
+
+        :param new_records: number of records about to be added to the file
+        """
+        record_count = self._history_journal.record_count + new_records
+        return record_count > 2 * max(self._persistent_history_length, 0)
+
+    def _compact_history(self) -> None:
+        """Rewrite the history file with only the most recent persistent_history_length commands
+
+        :raises OSError if the file can't be written
+        """
+        if self._shared_history:
+            # Keep the most recent commands of all the processes using the file
+            self._history_journal.compact(self._persistent_history_length)
+            return
+
+        if self._persistent_history_length > 0:
+            items = self.history[-self._persistent_history_length:]
+        else:
+            items = []
+
+        # Commands which are still running get written when they finish
+        self._history_journal.rewrite(item for item in items if item.finished)
+
+    def _merge_shared_history(self) -> None:
+        """Add the commands other processes have written to the shared history file since it was last read
+
+        They are added after the commands already in history so the numbers of those don't change.
+        """
+        if not self._shared_history or self._history_journal is None:
+            return
+
+        try:
+            items = self._history_journal.read_new()
+        except OSError as ex:
+            msg = "Can not read persistent history file '{}': {}"
+            self.pexcept(msg.format(self.persistent_history_file, ex))
+            return
+
+        for item in items:
+            new_item = self.history.append(item.statement, start_time=item.start_time)
+            self.history.update(attr.evolve(item, idx=new_item.idx))
+
+        if rl_type != RlType.NONE:
+            lines = list(_readline_lines(items))
+
+            # readline only adds a single entry for multiple sequential identical lines
+            if lines and lines[0] == readline.get_history_item(readline.get_current_history_length()):
+                lines = lines[1:]
+            for line in lines:
+                readline.add_history(line)
+
+    def _persist_history(self):
+        """compact the history file if needed
+
+        Commands are written to the file as they are run, so this only rewrites it when it has
+        grown too large or is still in an older format.
+        """
+        if not self.persistent_history_file or self._history_journal is None:
+            return
+
+        if self._history_journal.needs_rewrite or self._history_needs_compacting():
+            try:
+                self._compact_history()
+            except OSError as ex:
+                msg = "Can not write persistent history file '{}': {}"
+                self.pexcept(msg.format(self.persistent_history_file, ex))
+
     def _generate_transcript(self, history: List[Union[HistoryItem, str]], transcript_file: str) -> None:
         """
         Generate a transcript file from a given history of commands
@@ -3515,6 +4169,335 @@ class Cmd(cmd.Cmd):
             msg = '{} {} saved to transcript file {!r}'
             self.pfeedback(msg.format(commands_run, plural, transcript_file))
 
+    # -----  Profile subcommand functions -----
+
+    def _get_profiled_commands(self) -> List[str]:
+        """Return a list of the commands which have profile stats"""
+        return list(self._profile_stats)
+
+    def _selected_profile_stats(self, names: List[str]) -> List[str]:
+        """Return the sorted names of the profiled commands that were asked for, or all of them if none were"""
+        if not names:
+            return sorted(self._profile_stats, key=self.default_sort_key)
+
+        selected = []
+        for cur_name in utils.remove_duplicates(names):
+            if cur_name in self._profile_stats:
+                selected.append(cur_name)
+            else:
+                self.perror("No profile stats for command '{}'".format(cur_name))
+        return selected
+
+    def _profile_on(self, args: argparse.Namespace) -> None:
+        """Start profiling commands"""
+        self._profiling = True
+        self.poutput("Profiling enabled")
+
+    def _profile_off(self, args: argparse.Namespace) -> None:
+        """Stop profiling commands"""
+        self._profiling = False
+        self.poutput("Profiling disabled")
+
+    def _profile_run(self, args: argparse.Namespace) -> Optional[bool]:
+        """Profile one command line"""
+        # Unquote redirection and terminator tokens
+        tokens_to_unquote = list(constants.REDIRECTION_TOKENS) + list(self.statement_parser.terminators)
+        utils.unquote_specific_tokens(args.command_args, tokens_to_unquote)
+
+        line = args.command
+        if args.command_args:
+            line += ' ' + ' '.join(args.command_args)
+
+        saved_profiling = self._profiling
+        self._profiling = True
+        try:
+            return self.onecmd_plus_hooks(line, add_to_history=False)
+        finally:
+            self._profiling = saved_profiling
+
+    def _profile_report(self, args: argparse.Namespace) -> None:
+        """Print profile stats"""
+        import io
+
+        if not self._profile_stats:
+            self.poutput("No commands have been profiled")
+            return
+
+        for cur_name in self._selected_profile_stats(args.name):
+            stats = self._profile_stats[cur_name]
+            stats.stream = io.StringIO()
+            stats.sort_stats(args.sort).print_stats(args.limit)
+
+            runs = self._profile_runs[cur_name]
+            self.poutput("Profile of {} ({} {})".format(cur_name, runs, 'run' if runs == 1 else 'runs'))
+            self.poutput(stats.stream.getvalue().strip('\n'))
+            self.poutput('')
+
+    def _profile_dump(self, args: argparse.Namespace) -> None:
+        """Save profile stats to pstats files"""
+        directory = os.path.expanduser(args.directory)
+        try:
+            os.makedirs(directory, exist_ok=True)
+            for cur_name in self._selected_profile_stats(args.name):
+                filename = os.path.join(directory, cur_name + '.prof')
+                self._profile_stats[cur_name].dump_stats(filename)
+                self.poutput("Profile of {} saved to {}".format(cur_name, filename))
+        except OSError as ex:
+            self.pexcept("Failed to save profile stats: {}".format(ex))
+
+    def _profile_clear(self, args: argparse.Namespace) -> None:
+        """Delete profile stats"""
+        if not args.name:
+            self._profile_stats.clear()
+            self._profile_runs.clear()
+            self.poutput("All profile stats deleted")
+        else:
+            for cur_name in self._selected_profile_stats(args.name):
+                del self._profile_stats[cur_name]
+                del self._profile_runs[cur_name]
+                self.poutput("Profile stats for '{}' deleted".format(cur_name))
+
+    # Top-level parser for profile
+    profile_description = ("Profile commands with cProfile\n"
+                           "\n"
+                           "The stats of each command are added together across all of the times it is\n"
+                           "profiled. Commands run by another command, like those in a script, are part\n"
+                           "of that command's profile.")
+    profile_parser = Cmd2ArgumentParser(description=profile_description)
+
+    # Add subcommands to profile
+    profile_subparsers = profile_parser.add_subparsers(dest='subcommand')
+    profile_subparsers.required = True
+
+    # profile -> on
+    profile_on_help = "profile every command that is run"
+    profile_on_parser = profile_subparsers.add_parser('on', help=profile_on_help,
+                                                      description="Profile every command that is run")
+    profile_on_parser.set_defaults(func=_profile_on)
+
+    # profile -> off
+    profile_off_help = "stop profiling commands"
+    profile_off_parser = profile_subparsers.add_parser('off', help=profile_off_help,
+                                                       description="Stop profiling commands")
+    profile_off_parser.set_defaults(func=_profile_off)
+
+    # profile -> run
+    profile_run_help = "profile one command"
+    profile_run_epilog = ("Notes:\n"
+                          "  If you want the command to use redirection, pipes, or terminators, then\n"
+                          "  quote them.\n"
+                          "\n"
+                          "Examples:\n"
+                          "  profile run history -a\n"
+                          "  profile run history -a \">\" history.txt\n")
+    profile_run_parser = profile_subparsers.add_parser('run', help=profile_run_help,
+                                                       description="Run a command line and profile it",
+                                                       epilog=profile_run_epilog)
+    profile_run_parser.add_argument('command', help='command to profile',
+                                    choices_method=_get_commands_aliases_and_macros_for_completion)
+    profile_run_parser.add_argument('command_args', nargs=argparse.REMAINDER, help='arguments to pass to command',
+                                    completer_method=path_complete)
+    profile_run_parser.set_defaults(func=_profile_run)
+
+    # profile -> report
+    profile_report_help = "print profile stats"
+    profile_report_description = ("Print the functions which took the most time in profiled commands\n"
+                                  "\n"
+                                  "Without arguments, all profiled commands will be reported.")
+    profile_report_parser = profile_subparsers.add_parser('report', help=profile_report_help,
+                                                          description=profile_report_description)
+    profile_report_parser.add_argument('-n', '--limit', type=int, default=20,
+                                       help='number of functions to print for each command (default: 20)')
+    profile_report_parser.add_argument('-s', '--sort', choices=['cumulative', 'tottime', 'calls', 'name'],
+                                       default='cumulative', help='how to order the functions (default: cumulative)')
+    profile_report_parser.add_argument('name', nargs=argparse.ZERO_OR_MORE, help='command to report',
+                                       choices_method=_get_profiled_commands)
+    profile_report_parser.set_defaults(func=_profile_report)
+
+    # profile -> dump
+    profile_dump_help = "save profile stats to pstats files"
+    profile_dump_description = ("Save the stats of each profiled command to a file named <command>.prof\n"
+                                "which can be loaded with the pstats module\n"
+                                "\n"
+                                "Without command names, all profiled commands will be saved.")
+    profile_dump_parser = profile_subparsers.add_parser('dump', help=profile_dump_help,
+                                                        description=profile_dump_description)
+    profile_dump_parser.add_argument('directory', help='directory to save the files in',
+                                     completer_method=path_complete)
+    profile_dump_parser.add_argument('name', nargs=argparse.ZERO_OR_MORE, help='command to save',
+                                     choices_method=_get_profiled_commands)
+    profile_dump_parser.set_defaults(func=_profile_dump)
+
+    # profile -> clear
+    profile_clear_help = "delete profile stats"
+    profile_clear_description = ("Delete the stats of profiled commands\n"
+                                 "\n"
+                                 "Without arguments, the stats of all commands will be deleted.")
+    profile_clear_parser = profile_subparsers.add_parser('clear', help=profile_clear_help,
+                                                         description=profile_clear_description)
+    profile_clear_parser.add_argument('name', nargs=argparse.ZERO_OR_MORE, help='command to delete stats for',
+                                      choices_method=_get_profiled_commands)
+    profile_clear_parser.set_defaults(func=_profile_clear)
+
+    # Preserve quotes since we are passing strings to other commands
+    @with_argparser(profile_parser, preserve_quotes=True)
+    def do_profile(self, args: argparse.Namespace) -> Optional[bool]:
+        """Profile commands with cProfile"""
+        # Call whatever subcommand function was selected
+        func = getattr(args, 'func')
+        return func(self, args)
+
+    # -----  Stats subcommand functions -----
+
+    def _get_metrics_commands(self) -> List[str]:
+        """Return a list of the commands which have metrics"""
+        return self.metrics.commands()
+
+    def _stats_on(self, args: argparse.Namespace) -> None:
+        """Start recording metrics"""
+        self.metrics.enabled = True
+        self.poutput("Metrics enabled")
+
+    def _stats_off(self, args: argparse.Namespace) -> None:
+        """Stop recording metrics"""
+        self.metrics.enabled = False
+        self.poutput("Metrics disabled")
+
+    def _stats_show(self, args: argparse.Namespace) -> None:
+        """Print latency percentiles"""
+        if not self.metrics.commands():
+            self.poutput("No metrics have been recorded")
+            return
+
+        phases = args.phase or metrics.PHASES
+        if args.combined:
+            names = [None]
+        elif args.name:
+            names = []
+            for cur_name in utils.remove_duplicates(args.name):
+                if cur_name in self.metrics.commands():
+                    names.append(cur_name)
+                else:
+                    self.perror("No metrics for command '{}'".format(cur_name))
+        else:
+            names = sorted(self.metrics.commands(), key=self.default_sort_key)
+
+        rows = []
+        for cur_name in names:
+            for phase in phases:
+                histogram = self.metrics.histogram(phase, cur_name)
+                if histogram.count:
+                    times = [histogram.percentile(50), histogram.percentile(90), histogram.percentile(99),
+                             histogram.max]
+                    rows.append(['(all)' if cur_name is None else cur_name, phase, str(histogram.count)]
+                                + ['{:.3f}'.format(seconds * 1000) for seconds in times])
+        if not rows:
+            return
+
+        header = ['Command', 'Phase', 'Count', 'p50 ms', 'p90 ms', 'p99 ms', 'max ms']
+        widths = [max(len(row[col]) for row in [header] + rows) for col in range(len(header))]
+        for row in [header] + rows:
+            # Left align the names and right align the numbers
+            cells = [cell.ljust(width) if col < 2 else cell.rjust(width)
+                     for col, (cell, width) in enumerate(zip(row, widths))]
+            self.poutput('  '.join(cells))
+
+    def _stats_export(self, args: argparse.Namespace) -> None:
+        """Save metrics to a JSON file"""
+        filename = os.path.expanduser(args.file)
+        try:
+            self.metrics.export(filename)
+        except OSError as ex:
+            self.pexcept("Failed to export metrics: {}".format(ex))
+        else:
+            self.poutput("Metrics saved to {}".format(filename))
+
+    def _stats_clear(self, args: argparse.Namespace) -> None:
+        """Delete metrics"""
+        if not args.name:
+            self.metrics.clear()
+            self.poutput("All metrics deleted")
+        else:
+            for cur_name in utils.remove_duplicates(args.name):
+                if cur_name in self.metrics.commands():
+                    self.metrics.clear([cur_name])
+                    self.poutput("Metrics for '{}' deleted".format(cur_name))
+                else:
+                    self.perror("No metrics for command '{}'".format(cur_name))
+
+    # Top-level parser for stats
+    stats_description = ("Show how long commands take\n"
+                         "\n"
+                         "While metrics are enabled, the time taken by each phase of running a command\n"
+                         "is recorded in a latency histogram for that command. The phases are:\n"
+                         "\n"
+                         "  parse         parsing the command line and expanding aliases and macros\n"
+                         "  postparsing   postparsing hooks\n"
+                         "  redirect      setting up output redirection and pipes\n"
+                         "  precmd        precommand hooks and precmd()\n"
+                         "  command       the command function\n"
+                         "  postcmd       postcommand hooks and postcmd()\n"
+                         "  restore       restoring output after redirection\n"
+                         "  finalization  command finalization hooks\n"
+                         "  total         all of the above")
+    stats_parser = Cmd2ArgumentParser(description=stats_description)
+
+    # Add subcommands to stats
+    stats_subparsers = stats_parser.add_subparsers(dest='subcommand')
+    stats_subparsers.required = True
+
+    # stats -> on
+    stats_on_help = "start recording metrics"
+    stats_on_parser = stats_subparsers.add_parser('on', help=stats_on_help, description="Start recording metrics")
+    stats_on_parser.set_defaults(func=_stats_on)
+
+    # stats -> off
+    stats_off_help = "stop recording metrics"
+    stats_off_parser = stats_subparsers.add_parser('off', help=stats_off_help, description="Stop recording metrics")
+    stats_off_parser.set_defaults(func=_stats_off)
+
+    # stats -> show
+    stats_show_help = "print latency percentiles"
+    stats_show_description = ("Print the count, percentiles, and maximum of the latency of each phase of\n"
+                              "commands in milliseconds\n"
+                              "\n"
+                              "Without arguments, all commands and phases will be shown.")
+    stats_show_parser = stats_subparsers.add_parser('show', help=stats_show_help, description=stats_show_description)
+    stats_show_parser.add_argument('-p', '--phase', action='append', choices=metrics.PHASES,
+                                   help='phase to show (can be used more than once)')
+    stats_show_parser.add_argument('-c', '--combined', action='store_true',
+                                   help='show the phases of all commands combined')
+    stats_show_parser.add_argument('name', nargs=argparse.ZERO_OR_MORE, help='command to show',
+                                   choices_method=_get_metrics_commands)
+    stats_show_parser.set_defaults(func=_stats_show)
+
+    # stats -> export
+    stats_export_help = "save metrics to a JSON file"
+    stats_export_description = ("Save the count, total, mean, minimum, maximum, and percentile latencies in\n"
+                                "seconds of each phase of each command to a JSON file")
+    stats_export_parser = stats_subparsers.add_parser('export', help=stats_export_help,
+                                                      description=stats_export_description)
+    stats_export_parser.add_argument('file', help='file to save the metrics in', completer_method=path_complete)
+    stats_export_parser.set_defaults(func=_stats_export)
+
+    # stats -> clear
+    stats_clear_help = "delete metrics"
+    stats_clear_description = ("Delete the metrics of commands\n"
+                               "\n"
+                               "Without arguments, the metrics of all commands will be deleted.")
+    stats_clear_parser = stats_subparsers.add_parser('clear', help=stats_clear_help,
+                                                     description=stats_clear_description)
+    stats_clear_parser.add_argument('name', nargs=argparse.ZERO_OR_MORE, help='command to delete metrics for',
+                                    choices_method=_get_metrics_commands)
+    stats_clear_parser.set_defaults(func=_stats_clear)
+
+    @with_argparser(stats_parser)
+    def do_stats(self, args: argparse.Namespace) -> None:
+        """Show how long commands take"""
+        # Call whatever subcommand function was selected
+        func = getattr(args, 'func')
+        func(self, args)
+
     edit_description = ("Run a text editor and optionally open a file with it\n"
                         "\n"
                         "The editor used is determined by a settable parameter. To set it:\n"
@@ -3566,6 +4549,10 @@ class Cmd(cmd.Cmd):
     run_script_parser.add_argument('-t', '--transcript', metavar='TRANSCRIPT_FILE',
                                    help='record the output of the script as a transcript file',
                                    completer_method=path_complete)
+    run_script_parser.add_argument('-b', '--batch', action='store_true',
+                                   help='share one open file between commands which redirect\n'
+                                        'to the same file the same way and restore the terminal\n'
+                                        'once after the last command')
     run_script_parser.add_argument('script_path', help="path to the script file", completer_method=path_complete)
 
     @with_argparser(run_script_parser)
@@ -3619,7 +4606,7 @@ class Cmd(cmd.Cmd):
             if args.transcript:
                 self._generate_transcript(script_commands, os.path.expanduser(args.transcript))
             else:
-                return self.runcmds_plus_hooks(script_commands)
+                return self.runcmds_plus_hooks(script_commands, batch=args.batch)
 
         finally:
             with self.sigint_protection:
@@ -3910,9 +4897,7 @@ class Cmd(cmd.Cmd):
                                  of the command being disabled.
                                  ex: message_to_print = "{} is currently disabled".format(COMMAND_NAME)
         """
-        all_commands = self.get_all_commands()
-
-        for cmd_name in all_commands:
+        for cmd_name in self.get_all_commands():
             func = self.cmd_func(cmd_name)
             if getattr(func, constants.CMD_ATTR_HELP_CATEGORY, None) == category:
                 self.disable_command(cmd_name, message_to_print)
@@ -3951,6 +4936,15 @@ class Cmd(cmd.Cmd):
         # Grab terminal lock before the prompt has been drawn by readline
         self.terminal_lock.acquire()
 
+        # Save the state of the terminal so it can be restored after each command
+        saved_terminal_state = self._terminal_state
+        self._save_terminal_state()
+
+        # Finish populating readline's history once the first prompt is displayed
+        if self._readline_backfill_items and self._readline_backfill_thread is None:
+            self._readline_backfill_thread = threading.Thread(target=self._backfill_readline_history, daemon=True)
+            self._readline_backfill_thread.start()
+
         # Always run the preloop first
         for func in self._preloop_hooks:
             func()
@@ -3980,6 +4974,8 @@ class Cmd(cmd.Cmd):
         # This will also zero the lock count in case cmdloop() is called again
         self.terminal_lock.release()
 
+        self._terminal_state = saved_terminal_state
+
         # Restore the original signal handler
         signal.signal(signal.SIGINT, original_sigint_handler)
 
@@ -3999,6 +4995,32 @@ class Cmd(cmd.Cmd):
         self._postcmd_hooks = []
         self._cmdfinalization_hooks = []
 
+    # onecmd_plus_hooks() only calls these when hooks of their type are registered, so commands don't create
+    # data objects for hooks that don't exist. They read the hook lists each time, so hooks added to the lists
+    # directly are run too.
+    def _run_postparsing_hooks(self, statement: Statement) -> Tuple[bool, Statement]:
+        """Run the postparsing hooks and return the final value of stop and the statement"""
+        data = plugin.PostparsingData(False, statement)
+        for func in self._postparsing_hooks:
+            data = func(data)
+            if data.stop:
+                break
+        return data.stop, data.statement
+
+    def _run_precmd_hooks(self, statement: Statement) -> Statement:
+        """Run the precommand hooks and return the statement"""
+        data = plugin.PrecommandData(statement)
+        for func in self._precmd_hooks:
+            data = func(data)
+        return data.statement
+
+    def _run_postcmd_hooks(self, stop: bool, statement: Statement) -> bool:
+        """Run the postcommand hooks and return the final value of stop"""
+        data = plugin.PostcommandData(stop, statement)
+        for func in self._postcmd_hooks:
+            data = func(data)
+        return data.stop
+
     @classmethod
     def _validate_callable_param_count(cls, func: Callable, count: int) -> None:
         """Ensure a function has the given number of parameters."""
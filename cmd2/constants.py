@@ -10,6 +10,9 @@ REDIRECTION_OUTPUT = '>'
 REDIRECTION_APPEND = '>>'
 REDIRECTION_CHARS = [REDIRECTION_PIPE, REDIRECTION_OUTPUT]
 REDIRECTION_TOKENS = [REDIRECTION_PIPE, REDIRECTION_OUTPUT, REDIRECTION_APPEND]
+
+# Pipes output through in-process filters. It is tokenized as REDIRECTION_PIPE followed by REDIRECTION_OUTPUT.
+REDIRECTION_FILTER = '|>'
 COMMENT_CHAR = '#'
 MULTILINE_TERMINATOR = ';'
 
@@ -0,0 +1,192 @@
+# coding=utf-8
+"""
+A long-running shell which runs shell commands one at a time
+"""
+import io
+import os
+import re
+import selectors
+import shlex
+import subprocess
+from typing import Optional, TextIO, Union
+
+from .utils import StdSim
+
+# Runs a command in a subshell and then prints a line with the token and the exit code of the command to stdout
+# and to stderr. A newline is printed before that line in case the output of the command didn't end with one.
+_COMMAND_SCRIPT = ('( cd -- {cwd} && eval {command} )\n'
+                   '__cmd2_status=$?\n'
+                   'printf "\\n%s %d\\n" {token} "$__cmd2_status"\n'
+                   'printf "\\n%s %d\\n" {token} "$__cmd2_status" >&2\n')
+
+
+class ShellCoprocess:
+    """Runs shell commands in one long-running POSIX shell instead of starting a new shell for each of them
+
+    Each command runs in a subshell started in the current working directory. Like with a new shell, exit, cd, and
+    variables set by a command don't affect the next one. The shell is started again if it died or if os.environ
+    changed since it was started.
+
+    The shell reads commands from a pipe it opens as a script file, which leaves the stdin of this process as its
+    stdin. Its stdout and stderr are pipes. The output of a command is copied from them until a line with a token,
+    which is random for each command, and the exit code of the command is read from both. Since commands write to
+    pipes, they don't see a terminal even if the output ends up in one.
+    """
+    # The most bytes read from a pipe at once
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, shell: str = '/bin/sh') -> None:
+        """
+        ShellCoprocess initializer
+        :param shell: path of the POSIX shell to run commands with
+        """
+        self.shell = shell
+        self._proc = None
+        self._env = None
+        self._commands = None
+
+    @property
+    def pid(self) -> Optional[int]:
+        """The process id of the shell or None if it isn't running"""
+        return self._proc.pid if self.running else None
+
+    @property
+    def running(self) -> bool:
+        """Whether the shell is running"""
+        return self._proc is not None and self._proc.poll() is None
+
+    def start(self) -> None:
+        """Start the shell, stopping it first if it is running"""
+        self.close()
+
+        read_fd, write_fd = os.pipe()
+        try:
+            self._env = dict(os.environ)
+            self._proc = subprocess.Popen([self.shell, '/dev/fd/{}'.format(read_fd)], stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE, pass_fds=(read_fd,), env=self._env)
+        except OSError:
+            os.close(write_fd)
+            raise
+        finally:
+            os.close(read_fd)
+        self._commands = io.open(write_fd, 'wb')
+
+        # Let Ctrl-C stop a command without stopping the shell. Subshells reset the trap so commands still get it.
+        self._send('trap : INT\n')
+
+    def close(self) -> None:
+        """Stop the shell if it is running"""
+        if self._proc is None:
+            return
+
+        try:
+            # The shell exits once it reads the end of its script
+            self._commands.close()
+        except BrokenPipeError:
+            pass
+        self._proc.stdout.close()
+        self._proc.stderr.close()
+        self._proc.wait()
+        self._proc = None
+
+    def run(self, command: str, stdout: Union[StdSim, TextIO], stderr: Union[StdSim, TextIO]) -> int:
+        """Run a command and copy its output to streams
+
+        :param command: the command line to run
+        :param stdout: the stream to write the stdout of the command to
+        :param stderr: the stream to write the stderr of the command to
+        :return: the exit code of the command or, if the shell died while running it, the exit code of the shell
+        """
+        if not self.running or os.environ != self._env:
+            self.start()
+
+        token = os.urandom(16).hex()
+        script = _COMMAND_SCRIPT.format(cwd=shlex.quote(os.getcwd()), command=shlex.quote(command), token=token)
+        try:
+            self._send(script)
+        except BrokenPipeError:
+            # The shell died after it was checked
+            self.start()
+            self._send(script)
+
+        marker = re.compile(b'\n' + token.encode() + b' (\\d+)\n')
+        partial_marker = token.encode() + b' '
+        streams = {self._proc.stdout: (stdout, bytearray()), self._proc.stderr: (stderr, bytearray())}
+        exit_code = None
+
+        try:
+            with selectors.DefaultSelector() as selector:
+                for pipe in streams:
+                    selector.register(pipe, selectors.EVENT_READ)
+
+                while selector.get_map():
+                    for key, _ in selector.select():
+                        write_stream, buf = streams[key.fileobj]
+                        data = os.read(key.fd, self.READ_SIZE)
+                        if not data:
+                            # The shell died
+                            selector.unregister(key.fileobj)
+                            self._write_bytes(write_stream, buf)
+                            continue
+
+                        buf += data
+                        match = marker.search(buf)
+                        if match:
+                            selector.unregister(key.fileobj)
+                            exit_code = int(match.group(1))
+                            self._write_bytes(write_stream, buf[:match.start()] + buf[match.end():])
+                            continue
+
+                        # Hold back a last line which could be the start of the marker
+                        end = self._partial_marker_start(buf, partial_marker)
+                        self._write_bytes(write_stream, buf[:end])
+                        del buf[:end]
+        except BaseException:
+            # Stop the shell since the rest of the output of the command would be read as output of the next one
+            self._proc.kill()
+            self.close()
+            raise
+
+        if exit_code is None:
+            exit_code = self._proc.wait()
+            self.close()
+        return exit_code
+
+    @staticmethod
+    def _partial_marker_start(buf: bytearray, partial_marker: bytes) -> int:
+        """Return where the marker starts if the end of buf could be the first part of it, otherwise len(buf)
+
+        :param buf: output read from the shell
+        :param partial_marker: the token and the space after it
+        """
+        # Besides the newline before it, the marker is the token, a space, an exit code of up to 3 digits and a newline
+        line_start = buf.rfind(b'\n', max(0, len(buf) - len(partial_marker) - 4))
+        if line_start >= 0:
+            last_line = bytes(buf[line_start + 1:])
+            if len(last_line) <= len(partial_marker):
+                if partial_marker.startswith(last_line):
+                    return line_start
+            elif last_line.startswith(partial_marker) and last_line[len(partial_marker):].isdigit():
+                return line_start
+        return len(buf)
+
+    def _send(self, script: str) -> None:
+        """Send lines of script to the shell"""
+        self._commands.write(os.fsencode(script))
+        self._commands.flush()
+
+    @staticmethod
+    def _write_bytes(stream: Union[StdSim, TextIO], to_write: Union[bytes, bytearray]) -> None:
+        """
+        Write bytes to a stream and flush it so output shows up as the command writes it
+        :param stream: the stream being written to
+        :param to_write: the bytes being written
+        """
+        if not to_write:
+            return
+        try:
+            stream.buffer.write(bytes(to_write))
+            stream.flush()
+        except BrokenPipeError:
+            # This occurs if output is being piped to a process that closed
+            pass
@@ -0,0 +1,234 @@
+# coding=utf-8
+"""
+Filters which process the output of a command in-process when it is piped to them with |>
+"""
+import argparse
+import collections
+import functools
+import io
+import os
+import re
+import threading
+from typing import Callable, Iterable, Iterator, List, Optional, TextIO, Union
+
+from .argparse_custom import Cmd2ArgumentParser
+from .utils import StdSim
+
+# A filter with its arguments applied. It takes an iterator of lines and returns an iterable of lines to output.
+LineFilter = Callable[[Iterator[str]], Iterable[str]]
+
+
+class PipeFilter:
+    """A filter which the output of a command can be piped through in-process with |>
+
+    The function of a filter is called with its parsed arguments and an iterator of the lines of output, each of which
+    ends with a newline except maybe the last. It returns an iterable of the lines to output. Making it a generator
+    lets output stream through it instead of being collected first.
+    """
+
+    def __init__(self, parser: argparse.ArgumentParser,
+                 func: Callable[[argparse.Namespace, Iterator[str]], Iterable[str]]) -> None:
+        """
+        PipeFilter initializer
+        :param parser: parses the arguments of the filter, its prog is the name of the filter
+        :param func: the function which filters lines
+        """
+        self.parser = parser
+        self.func = func
+
+    def prepare(self, argv: List[str]) -> LineFilter:
+        """Parse the arguments of the filter
+
+        :param argv: the arguments which follow the name of the filter, with quotes removed
+        :return: a function which filters lines with those arguments
+        :raises SystemExit: if the arguments are invalid or help was requested, after argparse printed why
+        """
+        args = self.parser.parse_args(argv)
+        return functools.partial(self.func, args)
+
+
+class FilterPipeline:
+    """Runs filters over what is written to a pipe and writes what they return to a stream
+
+    The filters run in a thread which reads lines from the pipe until the writing side is closed. If the filters finish
+    before all of the input was read, like head does, the pipe is closed and writing to it raises BrokenPipeError.
+    """
+
+    def __init__(self, line_filters: List[LineFilter], output: Union[StdSim, TextIO]) -> None:
+        """
+        FilterPipeline initializer
+        :param line_filters: the filters to run, in the order the lines go through them
+        :param output: the stream to write the filtered lines to
+        """
+        read_fd, write_fd = os.pipe()
+        self._reader = io.open(read_fd, 'r')
+
+        # The stream the command writes its output to
+        self.input = io.open(write_fd, 'w')
+        self.output = output
+
+        # The exception raised by a filter, if any
+        self.error = None
+
+        self._thread = threading.Thread(name='filter_pipeline', target=self._run, args=[line_filters])
+        self._thread.start()
+
+    def wait(self) -> Optional[Exception]:
+        """Close the input and wait for the filters to finish
+
+        :return: the exception raised by a filter or None if they all succeeded
+        """
+        try:
+            self.input.close()
+        except BrokenPipeError:
+            # The filters stopped reading before all of the output was written
+            pass
+
+        self._thread.join()
+        return self.error
+
+    def _run(self, line_filters: List[LineFilter]) -> None:
+        """Thread function which passes the input through the filters"""
+        try:
+            lines = iter(self._reader)
+            for line_filter in line_filters:
+                lines = line_filter(lines)
+            for line in lines:
+                self.output.write(line)
+            self.output.flush()
+        except BrokenPipeError:
+            # This occurs if output is being piped to a process that closed
+            pass
+        except Exception as ex:
+            self.error = ex
+        finally:
+            self._reader.close()
+
+
+def _ensure_newline(line: str) -> str:
+    """Add a newline to the last line of input if it has none"""
+    return line if line.endswith('\n') else line + '\n'
+
+
+def _grep(args: argparse.Namespace, lines: Iterator[str]) -> Iterator[str]:
+    """Output the lines which match a pattern"""
+    search = re.compile(args.pattern, re.IGNORECASE if args.ignore_case else 0).search
+
+    count = 0
+    for number, line in enumerate(lines, start=1):
+        if (search(line.rstrip('\n')) is None) == args.invert_match:
+            count += 1
+            if not args.count:
+                yield '{}:{}'.format(number, line) if args.line_number else line
+
+    if args.count:
+        yield '{}\n'.format(count)
+
+
+def _head(args: argparse.Namespace, lines: Iterator[str]) -> Iterator[str]:
+    """Output the first lines"""
+    for number, line in enumerate(lines):
+        if number >= args.lines:
+            break
+        yield line
+
+
+def _tail(args: argparse.Namespace, lines: Iterator[str]) -> Iterator[str]:
+    """Output the last lines"""
+    if args.lines > 0:
+        yield from collections.deque(lines, maxlen=args.lines)
+    else:
+        # Read everything anyway, like the command would
+        collections.deque(lines, maxlen=0)
+
+
+def _wc(args: argparse.Namespace, lines: Iterator[str]) -> Iterator[str]:
+    """Output the number of lines, words, and characters"""
+    line_count = word_count = char_count = 0
+    for line in lines:
+        if line.endswith('\n'):
+            line_count += 1
+        word_count += len(line.split())
+        char_count += len(line)
+
+    show_all = not (args.lines or args.words or args.chars)
+    counts = [count for count, show in ((line_count, args.lines), (word_count, args.words), (char_count, args.chars))
+              if show or show_all]
+    yield ' '.join(str(count) for count in counts) + '\n'
+
+
+def _numeric_key(line: str) -> float:
+    """Sort key of sort -n, which is the number at the start of a line or 0 if there isn't one"""
+    match = re.match(r'\s*[-+]?(\d+\.?\d*|\.\d+)', line)
+    return float(match.group()) if match else 0.0
+
+
+def _sort(args: argparse.Namespace, lines: Iterator[str]) -> Iterator[str]:
+    """Output the lines in sorted order"""
+    all_lines = [_ensure_newline(line) for line in lines]
+    if args.numeric_sort:
+        key = _numeric_key
+    elif args.ignore_case:
+        key = str.casefold
+    else:
+        key = None
+    all_lines.sort(key=key, reverse=args.reverse)
+
+    if args.unique:
+        # Lines are unique if they differ by the key being sorted on
+        last_key = object()
+        for line in all_lines:
+            line_key = line if key is None else key(line)
+            if line_key != last_key:
+                last_key = line_key
+                yield line
+    else:
+        yield from all_lines
+
+
+def _pattern(value: str) -> str:
+    """Check that an argument is a valid regular expression"""
+    try:
+        re.compile(value)
+    except re.error as ex:
+        raise argparse.ArgumentTypeError("invalid regular expression: {}".format(ex))
+    return value
+
+
+def _filter_parser(name: str, description: str) -> Cmd2ArgumentParser:
+    """Create the parser of a built-in filter"""
+    return Cmd2ArgumentParser(prog=name, description=description)
+
+
+grep_parser = _filter_parser('grep', 'Output the lines which match a Python regular expression')
+grep_parser.add_argument('-c', '--count', action='store_true', help='output only the number of matching lines')
+grep_parser.add_argument('-i', '--ignore-case', action='store_true', help='ignore case when matching')
+grep_parser.add_argument('-n', '--line-number', action='store_true', help='prefix lines with their line numbers')
+grep_parser.add_argument('-v', '--invert-match', action='store_true', help='output the lines which do not match')
+grep_parser.add_argument('pattern', type=_pattern, help='the Python regular expression to search for')
+
+head_parser = _filter_parser('head', 'Output the first lines')
+head_parser.add_argument('-n', '--lines', type=int, default=10, help='number of lines to output (default: 10)')
+
+tail_parser = _filter_parser('tail', 'Output the last lines')
+tail_parser.add_argument('-n', '--lines', type=int, default=10, help='number of lines to output (default: 10)')
+
+wc_parser = _filter_parser('wc', 'Output the number of lines, words, and characters')
+wc_parser.add_argument('-l', '--lines', action='store_true', help='output the number of lines')
+wc_parser.add_argument('-w', '--words', action='store_true', help='output the number of words')
+wc_parser.add_argument('-c', '--chars', action='store_true', help='output the number of characters')
+
+sort_parser = _filter_parser('sort', 'Output the lines in sorted order')
+sort_parser.add_argument('-f', '--ignore-case', action='store_true', help='ignore case when sorting')
+sort_parser.add_argument('-n', '--numeric-sort', action='store_true', help='sort by the number each line starts with')
+sort_parser.add_argument('-r', '--reverse', action='store_true', help='sort in reverse order')
+sort_parser.add_argument('-u', '--unique', action='store_true', help='output only the first of equal lines')
+
+# The filters every cmd2 application has
+BUILTIN_FILTERS = {
+    'grep': PipeFilter(grep_parser, _grep),
+    'head': PipeFilter(head_parser, _head),
+    'tail': PipeFilter(tail_parser, _tail),
+    'wc': PipeFilter(wc_parser, _wc),
+    'sort': PipeFilter(sort_parser, _sort),
+}
@@ -3,9 +3,39 @@
 History management classes
 """
 
+import array
+import collections.abc
+import json
+import math
+import mmap
+import os
+import pickle
 import re
+import struct
+import tempfile
+import time
+import unicodedata
 
-from typing import List, Union
+from typing import Any, Callable, Iterable, List, Optional, Pattern, Tuple, Union
+
+# The private modules of re are used to find the literal text a regular expression requires. If they aren't
+# available, regular expression searches check every item.
+try:
+    # Python 3.11 and later
+    from re import _constants as sre_constants, _parser as sre_parse
+except ImportError:  # pragma: no cover
+    try:
+        import sre_constants
+        import sre_parse
+    except ImportError:
+        sre_constants = sre_parse = None
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # Windows
+    fcntl = None
+    import msvcrt
 
 import attr
 
@@ -22,6 +52,13 @@ class HistoryItem():
     statement = attr.ib(default=None, validator=attr.validators.instance_of(Statement))
     idx = attr.ib(default=None, validator=attr.validators.instance_of(int))
 
+    # How the command ran. These are None if it hasn't finished or ran before they were recorded.
+    # start_time is in seconds since the epoch. elapsed and cpu_time are in seconds.
+    start_time = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(float)))
+    elapsed = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(float)))
+    cpu_time = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(float)))
+    succeeded = attr.ib(default=None, validator=attr.validators.optional(attr.validators.instance_of(bool)))
+
     def __str__(self):
         """A convenient human readable representation of the history item"""
         return self.statement.raw
@@ -36,20 +73,39 @@ class HistoryItem():
         """Return the command as run which includes shortcuts and aliases resolved plus any changes made in hooks"""
         return self.statement.expanded_command_line
 
-    def pr(self, script=False, expanded=False, verbose=False) -> str:
+    @property
+    def finished(self) -> bool:
+        """Return whether the command was started and has finished running"""
+        return self.start_time is None or self.elapsed is not None
+
+    def timing_summary(self) -> str:
+        """Return the start time, elapsed time, CPU time, and status of the command as fixed width columns"""
+        if self.start_time is None:
+            start = '-'
+        else:
+            start = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.start_time))
+        elapsed = '-' if self.elapsed is None else '{:.3f}s'.format(self.elapsed)
+        cpu_time = '-' if self.cpu_time is None else '{:.3f}s'.format(self.cpu_time)
+        status = {None: '-', True: 'ok', False: 'failed'}[self.succeeded]
+        return '{:<19}  {:>9}  {:>9}  {:<6}'.format(start, elapsed, cpu_time, status)
+
+    def pr(self, script=False, expanded=False, verbose=False, timing=False) -> str:
         """Represent a HistoryItem in a pretty fashion suitable for printing.
 
         If you pass verbose=True, script and expanded will be ignored
 
+        :param timing: if True, include when the command started, how long it took, and whether it succeeded.
+                       This is ignored when script is True.
         :return: pretty print string version of a HistoryItem
         """
+        prefix = self.timing_summary() + '  ' if timing else ''
         if verbose:
             raw = self.raw.rstrip()
             expanded = self.expanded.rstrip()
 
-            ret_str = self._listformat.format(self.idx, raw)
+            ret_str = self._listformat.format(self.idx, prefix + raw)
             if raw != expanded:
-                ret_str += '\n' + self._ex_listformat.format(self.idx, expanded)
+                ret_str += '\n' + self._ex_listformat.format(self.idx, ' ' * len(prefix) + expanded)
         else:
             if expanded:
                 ret_str = self.expanded.rstrip()
@@ -66,11 +122,120 @@ class HistoryItem():
 
             # Display a numbered list if not writing to a script
             if not script:
-                ret_str = self._listformat.format(self.idx, ret_str)
+                ret_str = self._listformat.format(self.idx, prefix + ret_str)
 
         return ret_str
 
 
+class _TrigramIndex:
+    """Maps every three character substring of the normalized text of history items to the items containing it
+
+    This narrows a search to the items which could contain a given string before the much slower
+    exact check is done on each of them. Items are identified by keys which increase as they are added,
+    like their zero-based position in History.
+    """
+    def __init__(self) -> None:
+        # Keys of the items containing each trigram, in ascending order
+        self._postings = dict()
+
+        # Keys of items whose text is changed by Unicode normalization. The index holds normalized text, so
+        # it can't rule these out for regular expressions, which are matched against the original text.
+        self._not_normalized = []
+
+        # Number of items which have been added
+        self.count = 0
+
+    def add(self, key: int, raw: str, expanded: str) -> None:
+        """Add the next item to the index
+
+        :param key: the key of the item, which must be greater than the key of every item already added
+        :param raw: the raw text of the item
+        :param expanded: the expanded text of the item
+        """
+        self.count += 1
+
+        trigrams = set()
+        normalized_text = True
+        for text in {raw, expanded}:
+            normalized = unicodedata.normalize('NFC', text)
+            normalized_text = normalized_text and normalized == text
+            folded = normalized.casefold()
+            trigrams |= {folded[i:i + 3] for i in range(len(folded) - 2)}
+
+        if not normalized_text:
+            self._not_normalized.append(key)
+
+        postings = self._postings
+        for trigram in trigrams:
+            posting = postings.get(trigram)
+            if posting is None:
+                postings[trigram] = [key]
+            else:
+                posting.append(key)
+
+    def candidates(self, literals: Iterable[str]) -> Optional[List[int]]:
+        """Find the items which might contain every one of the given strings in their raw or expanded text
+
+        :param literals: normalized and casefolded strings
+        :return: the sorted keys of the items, or None if none of the strings are long enough to
+                 narrow down the items
+        """
+        trigrams = {literal[i:i + 3] for literal in literals for i in range(len(literal) - 2)}
+        if not trigrams:
+            return None
+
+        postings = []
+        for trigram in trigrams:
+            posting = self._postings.get(trigram)
+            if posting is None:
+                return self._not_normalized[:]
+            postings.append(posting)
+
+        # Start with the rarest trigram to keep the set of candidates small
+        postings.sort(key=len)
+        positions = set(postings[0])
+        for posting in postings[1:]:
+            if not positions:
+                break
+            positions.intersection_update(posting)
+
+        positions.update(self._not_normalized)
+        return sorted(positions)
+
+
+def _regex_literals(regex: Pattern) -> List[str]:
+    """Find strings which any text matching a regular expression must contain
+
+    Only runs of literal characters at the top level of the expression are found, which is enough
+    for the typical history search. Nothing is returned for case insensitive expressions.
+
+    :param regex: a compiled regular expression
+    :return: the casefolded strings
+    """
+    if sre_parse is None or regex.flags & (re.IGNORECASE | re.LOCALE) or not isinstance(regex.pattern, str):
+        return []
+
+    literals = []
+    run = []
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+        if parsed.state.flags & re.IGNORECASE:
+            return []
+
+        for op, value in parsed:
+            if op is sre_constants.LITERAL:
+                run.append(chr(value))
+            elif run:
+                literals.append(''.join(run).casefold())
+                run = []
+    except Exception:  # pragma: no cover
+        # The private parser failed or works differently in this version of Python
+        return []
+    if run:
+        literals.append(''.join(run).casefold())
+    return literals
+
+
 class History(list):
     """A list of HistoryItems that knows how to respond to user requests.
 
@@ -86,6 +251,9 @@ class History(list):
         super().__init__(seq)
         self.session_start_index = 0
 
+        # Speeds up searches. It is built by the first search and kept up to date as items are appended.
+        self._trigram_index = None
+
     def start_session(self) -> None:
         """Start a new session, thereby setting the next index as the first index in the new session."""
         self.session_start_index = len(self)
@@ -98,17 +266,88 @@ class History(list):
             result -= 1
         return result
 
-    def append(self, new: Statement) -> None:
+    def append(self, new: Statement, *, start_time: Optional[float] = None) -> HistoryItem:
         """Append a HistoryItem to end of the History list.
 
         :param new: command line to convert to HistoryItem and add to the end of the History list
+        :param start_time: when the command started running, in seconds since the epoch
+        :return: the new HistoryItem
         """
-        history_item = HistoryItem(new, len(self) + 1)
+        history_item = HistoryItem(new, len(self) + 1, start_time=start_time)
         super().append(history_item)
+        self._index_item(history_item.raw, history_item.expanded)
+        return history_item
+
+    def update(self, item: HistoryItem) -> bool:
+        """Replace the item which has the same number as the given one, e.g. to record how its command ran
+
+        :param item: the new version of the item
+        :return: False if the item is no longer in the history
+        """
+        pos = self._zero_based_index(item.idx)
+        if not 0 <= pos < len(self):
+            return False
+
+        current = self[pos]
+        if current.idx != item.idx or current.raw != item.raw:
+            return False
+        self._replace(pos, item)
+        return True
+
+    def _replace(self, pos: int, item: HistoryItem) -> None:
+        """Replace the item at a position with a version of it which has the same text
+
+        :param pos: zero-based position of the item
+        :param item: the new version of the item
+        """
+        list.__setitem__(self, pos, item)
+
+    # The list methods which change items other than by appending one with append() make the trigram index
+    # out of date, so they drop it and the next search builds it again
+    def __delitem__(self, index: Union[int, slice]) -> None:
+        super().__delitem__(index)
+        self._trigram_index = None
+
+    def __setitem__(self, index: Union[int, slice], value: Any) -> None:
+        super().__setitem__(index, value)
+        self._trigram_index = None
+
+    def __iadd__(self, other: Iterable[HistoryItem]) -> 'History':
+        self._trigram_index = None
+        return super().__iadd__(other)
+
+    def __imul__(self, count: int) -> 'History':
+        self._trigram_index = None
+        return super().__imul__(count)
+
+    def extend(self, items: Iterable[HistoryItem]) -> None:
+        super().extend(items)
+        self._trigram_index = None
+
+    def insert(self, index: int, item: HistoryItem) -> None:
+        super().insert(index, item)
+        self._trigram_index = None
+
+    def pop(self, index: int = -1) -> HistoryItem:
+        self._trigram_index = None
+        return super().pop(index)
+
+    def remove(self, item: HistoryItem) -> None:
+        super().remove(item)
+        self._trigram_index = None
+
+    def reverse(self) -> None:
+        super().reverse()
+        self._trigram_index = None
+
+    def sort(self, *, key: Optional[Callable[[HistoryItem], Any]] = None, reverse: bool = False) -> None:
+        super().sort(key=key, reverse=reverse)
+        self._trigram_index = None
 
     def clear(self) -> None:
         """Remove all items from the History list."""
         super().clear()
+        self._trigram_index = None
         self.start_session()
 
     def get(self, index: Union[int, str]) -> HistoryItem:
@@ -120,10 +359,7 @@ class History(list):
         index = int(index)
         if index == 0:
             raise IndexError('The first command in history is command 1.')
-        elif index < 0:
-            return self[index]
-        else:
-            return self[index - 1]
+        return self[self._zero_based_index(index)]
 
     # This regular expression parses input for the span() method. There are five parts:
     #
@@ -203,6 +439,9 @@ class History(list):
                 # if the ending is smaller than -1, make it one larger so it includes
                 # the element (python native indices exclude the last referenced element)
                 end += 1
+            else:
+                # the zero based index of the next element, which excludes it from the slice
+                end = self._zero_based_index(end + 1)
 
         if start is not None and end is not None:
             # we have both start and end, return a slice of history
@@ -217,7 +456,7 @@ class History(list):
                 result = self[self.session_start_index:end]
         elif start is not None:
             # there was no separator so it's either a positive or negative integer
-            result = [self[start]]
+            result = [self.get(results.group('start'))]
         else:
             # we just have a separator, return the whole list
             if include_persisted:
@@ -233,15 +472,13 @@ class History(list):
         :param include_persisted: if True, then search full history including persisted history
         :return: a list of history items, or an empty list if the string was not found
         """
-        def isin(history_item):
+        sloppy = utils.norm_fold(search)
+
+        def isin(text):
             """filter function for string search of history"""
-            sloppy = utils.norm_fold(search)
-            inraw = sloppy in utils.norm_fold(history_item.raw)
-            inexpanded = sloppy in utils.norm_fold(history_item.expanded)
-            return inraw or inexpanded
+            return sloppy in utils.norm_fold(text)
 
-        search_list = self if include_persisted else self[self.session_start_index:]
-        return [item for item in search_list if isin(item)]
+        return self._search(isin, include_persisted, [sloppy])
 
     def regex_search(self, regex: str, include_persisted: bool = False) -> List[HistoryItem]:
         """Find history items which match a given regular expression
@@ -255,12 +492,64 @@ class History(list):
             regex = regex[1:-1]
         finder = re.compile(regex, re.DOTALL | re.MULTILINE)
 
-        def isin(hi):
-            """filter function for doing a regular expression search of history"""
-            return finder.search(hi.raw) or finder.search(hi.expanded)
+        return self._search(finder.search, include_persisted, _regex_literals(finder))
+
+    def _search(self, isin: Callable[[str], Any], include_persisted: bool,
+                literals: Iterable[str] = ()) -> List[HistoryItem]:
+        """Find history items whose raw or expanded text satisfies a filter function
+
+        :param isin: filter function which is passed the text of a history item
+        :param include_persisted: if True, then search full history including persisted history
+        :param literals: normalized and casefolded strings which the text must contain for isin to be
+                         satisfied. The trigram index uses these to skip items which can't match.
+        :return: a list of history items
+        """
+        start = 0 if include_persisted else self.session_start_index
+
+        positions = None
+        literals = list(literals)
+        if any(len(literal) >= 3 for literal in literals):
+            positions = self._candidates(literals)
+        if positions is None:
+            positions = range(start, len(self))
+
+        results = []
+        for pos in positions:
+            if pos < start:
+                continue
+            raw, expanded = self._text(pos)
+            if isin(raw) or isin(expanded):
+                results.append(self[pos])
+        return results
 
-        search_list = self if include_persisted else self[self.session_start_index:]
-        return [itm for itm in search_list if isin(itm)]
+    def _text(self, pos: int) -> Tuple[str, str]:
+        """Return the raw and expanded text of an item
+
+        :param pos: zero-based position of the item
+        """
+        item = list.__getitem__(self, pos)
+        return item.raw, item.expanded
+
+    def _candidates(self, literals: List[str]) -> Optional[List[int]]:
+        """Use the trigram index to find the items which might contain all of the given strings
+
+        :param literals: normalized and casefolded strings
+        :return: the sorted zero-based positions of the items or None if the strings can't narrow them down
+        """
+        if self._trigram_index is None or self._trigram_index.count != len(self):
+            self._trigram_index = _TrigramIndex()
+            for pos in range(len(self)):
+                self._trigram_index.add(pos, *self._text(pos))
+        return self._trigram_index.candidates(literals)
+
+    def _index_item(self, raw: str, expanded: str) -> None:
+        """Add the last item to the trigram index if the index has been built"""
+        if self._trigram_index is not None:
+            if self._trigram_index.count == len(self) - 1:
+                self._trigram_index.add(len(self) - 1, raw, expanded)
+            else:
+                # History was changed in a way the index doesn't know about
+                self._trigram_index = None
 
     def truncate(self, max_length: int) -> None:
         """Truncate the length of the history, dropping the oldest items if necessary
@@ -275,3 +564,1001 @@ class History(list):
         elif len(self) > max_length:
             last_element = len(self) - max_length
             del self[0:last_element]
+
+
+class _CustomStorageHistory(History):
+    """Base class for History classes which store their items somewhere other than the list they inherit from
+
+    Every list method is overridden, since those of list would see the empty list this inherits from. Subclasses
+    must implement __len__(), __delitem__(), _item(), _replace(), _append_item(), _rebuild(), append(), and clear().
+    Methods which would move items around, like sort() and insert() before the end, rebuild the storage.
+    """
+    # These only use __len__(), __getitem__(), __iter__(), and __delitem__()
+    __contains__ = collections.abc.Sequence.__contains__
+    __reversed__ = collections.abc.Sequence.__reversed__
+    index = collections.abc.Sequence.index
+    count = collections.abc.Sequence.count
+    pop = collections.abc.MutableSequence.pop
+    remove = collections.abc.MutableSequence.remove
+
+    def __iter__(self):
+        for pos in range(len(self)):
+            yield self._item(pos)
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[HistoryItem, List[HistoryItem]]:
+        if isinstance(index, slice):
+            return [self._item(pos) for pos in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('list index out of range')
+        return self._item(index)
+
+    def __setitem__(self, index: Union[int, slice], value: Any) -> None:
+        items = list(self)
+        items[index] = value
+        self._rebuild(items)
+
+    def __repr__(self) -> str:
+        return repr(list(self))
+
+    def __eq__(self, other: Any) -> bool:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) == list(other)
+
+    def __ne__(self, other: Any) -> bool:
+        if not isinstance(other, list):
+            return NotImplemented
+        return not self == other
+
+    def __lt__(self, other: Any) -> bool:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) < list(other)
+
+    def __le__(self, other: Any) -> bool:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) <= list(other)
+
+    def __gt__(self, other: Any) -> bool:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) > list(other)
+
+    def __ge__(self, other: Any) -> bool:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) >= list(other)
+
+    def __add__(self, other: Any) -> List[HistoryItem]:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(self) + list(other)
+
+    def __radd__(self, other: Any) -> List[HistoryItem]:
+        if not isinstance(other, list):
+            return NotImplemented
+        return list(other) + list(self)
+
+    def __iadd__(self, other: Iterable[HistoryItem]) -> '_CustomStorageHistory':
+        self.extend(other)
+        return self
+
+    def __mul__(self, count: int) -> List[HistoryItem]:
+        return list(self) * count
+
+    __rmul__ = __mul__
+
+    def __imul__(self, count: int) -> '_CustomStorageHistory':
+        self._rebuild(list(self) * count)
+        return self
+
+    def copy(self) -> List[HistoryItem]:
+        """Return the items in a list"""
+        return list(self)
+
+    def extend(self, items: Iterable[HistoryItem]) -> None:
+        """Add HistoryItems to the end"""
+        # Read all of the items first in case they come from this history
+        for item in list(items):
+            self._append_item(item)
+
+    def insert(self, index: int, item: HistoryItem) -> None:
+        """Insert a HistoryItem before a position"""
+        if index >= len(self):
+            self._append_item(item)
+        else:
+            items = list(self)
+            items.insert(index, item)
+            self._rebuild(items)
+
+    def reverse(self) -> None:
+        """Reverse the order of the items"""
+        self._rebuild(list(reversed(list(self))))
+
+    def sort(self, *, key: Optional[Callable[[HistoryItem], Any]] = None, reverse: bool = False) -> None:
+        """Sort the items"""
+        self._rebuild(sorted(self, key=key, reverse=reverse))
+
+    def _append_item(self, item: HistoryItem) -> None:
+        """Add a HistoryItem to the end as it is given
+
+        :param item: the item being added
+        """
+        raise NotImplementedError
+
+    def _rebuild(self, items: List[HistoryItem]) -> None:
+        """Replace the items, keeping the session start position
+
+        :param items: the new items
+        """
+        raise NotImplementedError
+
+    def _item(self, pos: int) -> HistoryItem:
+        """Return the HistoryItem at a position
+
+        :param pos: zero-based position of the item, which is known to be valid
+        """
+        raise NotImplementedError
+
+    def _replace(self, pos: int, item: HistoryItem) -> None:
+        raise NotImplementedError
+
+    def _text(self, pos: int) -> Tuple[str, str]:
+        """Return the raw and expanded text of an item
+
+        :param pos: zero-based position of the item
+        """
+        item = self._item(pos)
+        return item.raw, item.expanded
+
+
+class MappedHistory(_CustomStorageHistory):
+    """A History which keeps its items in a memory-mapped temporary file instead of in memory.
+
+    Only the offset of each item's record is held in memory. A HistoryItem and its Statement are
+    created each time the item is retrieved, and searches read the text of each item directly from
+    the file so that only the matching items get created.
+
+    Each record is a header with the item's index and the byte lengths of its raw text, expanded
+    text, and JSON encoded Statement. That is followed by how the command ran, which has a fixed size
+    so it can be updated in place, and then by those three values.
+
+    Removing items leaves their records in the file. Once those take up more than the records still in
+    use and more than COMPACT_MIN_BYTES, the records in use are copied to a new file.
+    """
+    COMPACT_MIN_BYTES = 1024 * 1024
+
+    _record_header = struct.Struct('<QIII')
+
+    # start_time, elapsed, cpu_time, and succeeded. NaN and -1 stand for None.
+    _run_info = struct.Struct('<dddb')
+
+    def __init__(self, seq=()) -> None:
+        self._file = tempfile.TemporaryFile()
+        self._mmap = None
+        self._size = 0
+
+        # Bytes of the file taken up by the records of the items
+        self._used_size = 0
+        self._offsets = array.array('Q')
+        super().__init__()
+        for item in seq:
+            self._write(item)
+
+    def __len__(self) -> int:
+        return len(self._offsets)
+
+    def __delitem__(self, index: Union[int, slice]) -> None:
+        positions = range(len(self))[index]
+        if isinstance(positions, int):
+            positions = [positions]
+        removed_size = sum(self._record_size(pos) for pos in positions)
+
+        # The records stay in the file, but are no longer reachable
+        del self._offsets[index]
+        self._used_size -= removed_size
+        self._trigram_index = None
+
+        unused_size = self._size - self._used_size
+        if not self._offsets:
+            self._reset_file()
+        elif unused_size > max(self._used_size, self.COMPACT_MIN_BYTES):
+            self._compact()
+
+    def append(self, new: Statement, *, start_time: Optional[float] = None) -> HistoryItem:
+        """Append a HistoryItem to end of the History list.
+
+        :param new: command line to convert to HistoryItem and add to the end of the History list
+        :param start_time: when the command started running, in seconds since the epoch
+        :return: the new HistoryItem
+        """
+        history_item = HistoryItem(new, len(self) + 1, start_time=start_time)
+        self._write(history_item)
+        return history_item
+
+    def clear(self) -> None:
+        """Remove all items from the History list."""
+        self._reset_file()
+        self.start_session()
+
+    def close(self) -> None:
+        """Release the memory map and delete its file. The history can't be used afterwards."""
+        self._close_mmap()
+        self._file.close()
+
+    def _close_mmap(self) -> None:
+        """Release the memory map so it will be recreated the next time it is needed"""
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _reset_file(self) -> None:
+        """Remove all records from the file"""
+        self._close_mmap()
+        self._file.seek(0)
+        self._file.truncate()
+        self._size = 0
+        self._used_size = 0
+        self._offsets = array.array('Q')
+        self._trigram_index = None
+
+    def _compact(self) -> None:
+        """Copy the records in use to a new file so the space of the others is freed"""
+        new_file = tempfile.TemporaryFile()
+        offsets = array.array('Q')
+        size = 0
+        for pos, offset in enumerate(self._offsets):
+            record_size = self._record_size(pos)
+            new_file.write(self._mmap[offset:offset + record_size])
+            offsets.append(size)
+            size += record_size
+
+        self.close()
+        self._file = new_file
+        self._offsets = offsets
+        self._size = self._used_size = size
+
+    def _append_item(self, item: HistoryItem) -> None:
+        self._write(item)
+
+    def _rebuild(self, items: List[HistoryItem]) -> None:
+        session_start_index = self.session_start_index
+        self._reset_file()
+        for item in items:
+            self._write(item)
+        self.session_start_index = session_start_index
+
+    def _write(self, item: HistoryItem) -> None:
+        """Write a record for an item to the end of the file"""
+        raw_text = item.raw
+        expanded_text = item.expanded
+        raw = raw_text.encode('utf-8')
+        expanded = expanded_text.encode('utf-8')
+        encoded = _encode_statement(item.statement)
+
+        self._file.seek(self._size)
+        self._file.write(self._record_header.pack(item.idx, len(raw), len(expanded), len(encoded)))
+        self._file.write(self._pack_run_info(item))
+        self._file.write(raw)
+        self._file.write(expanded)
+        self._file.write(encoded)
+
+        record_size = self._record_header.size + self._run_info.size + len(raw) + len(expanded) + len(encoded)
+        self._offsets.append(self._size)
+        self._size += record_size
+        self._used_size += record_size
+        self._index_item(raw_text, expanded_text)
+
+    def _replace(self, pos: int, item: HistoryItem) -> None:
+        # Only the run info can differ, so it is overwritten in place
+        self._file.seek(self._offsets[pos] + self._record_header.size)
+        self._file.write(self._pack_run_info(item))
+        self._file.flush()
+
+    @classmethod
+    def _pack_run_info(cls, item: HistoryItem) -> bytes:
+        """Convert how an item's command ran to bytes"""
+        nan = float('nan')
+        return cls._run_info.pack(nan if item.start_time is None else item.start_time,
+                                  nan if item.elapsed is None else item.elapsed,
+                                  nan if item.cpu_time is None else item.cpu_time,
+                                  -1 if item.succeeded is None else int(item.succeeded))
+
+    def _record(self, pos: int) -> Tuple[int, int, int, int, int]:
+        """Find the record for an item
+
+        :param pos: zero-based position of the item
+        :return: the item's index, the offset where its raw text begins, and the lengths of its raw text,
+                 expanded text, and encoded Statement
+        """
+        # The memory map only covers the file as it was when the map was created
+        if self._mmap is None or len(self._mmap) < self._size:
+            self._close_mmap()
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        offset = self._offsets[pos]
+        idx, raw_len, expanded_len, encoded_len = self._record_header.unpack_from(self._mmap, offset)
+        return idx, offset + self._record_header.size + self._run_info.size, raw_len, expanded_len, encoded_len
+
+    def _record_size(self, pos: int) -> int:
+        """Get the number of bytes the record for an item takes up
+
+        :param pos: zero-based position of the item
+        """
+        _, start, raw_len, expanded_len, encoded_len = self._record(pos)
+        return start - self._offsets[pos] + raw_len + expanded_len + encoded_len
+
+    def _text(self, pos: int) -> Tuple[str, str]:
+        """Read the raw and expanded text of an item without creating it
+
+        :param pos: zero-based position of the item
+        """
+        _, start, raw_len, expanded_len, _ = self._record(pos)
+        raw = self._mmap[start:start + raw_len].decode('utf-8')
+        start += raw_len
+        expanded = self._mmap[start:start + expanded_len].decode('utf-8')
+        return raw, expanded
+
+    def _item(self, pos: int) -> HistoryItem:
+        """Create the HistoryItem at a position
+
+        :param pos: zero-based position of the item
+        """
+        idx, start, raw_len, expanded_len, encoded_len = self._record(pos)
+        start_time, elapsed, cpu_time, succeeded = self._run_info.unpack_from(self._mmap, start - self._run_info.size)
+        start += raw_len + expanded_len
+        fields = json.loads(self._mmap[start:start + encoded_len].decode('utf-8'))
+        return HistoryItem(Statement._create(fields.pop('args'), **fields), idx,
+                           start_time=None if math.isnan(start_time) else start_time,
+                           elapsed=None if math.isnan(elapsed) else elapsed,
+                           cpu_time=None if math.isnan(cpu_time) else cpu_time,
+                           succeeded=None if succeeded < 0 else bool(succeeded))
+
+
+class RingHistory(_CustomStorageHistory):
+    """A History which holds at most a fixed number of items in a ring buffer
+
+    Once it is full, appending an item drops the oldest one in constant time. Items are numbered
+    starting with the first one ever appended, so the number of an item doesn't change when older
+    ones are dropped. get() and span() use these numbers. Numbers of dropped items aren't valid.
+
+    Items can only be removed from either end. Items which are added or moved by list methods like
+    extend(), insert(), and sort() are renumbered so the numbers stay consecutive.
+    """
+    def __init__(self, seq=(), *, max_items: int) -> None:
+        """Initialize an instance of RingHistory
+
+        :param seq: HistoryItems to start with. The first one keeps its number and the rest are numbered after it.
+        :param max_items: the maximum number of items to hold
+        :raises ValueError if max_items is less than 1
+        """
+        if max_items < 1:
+            raise ValueError('max_items must be at least 1')
+        self.max_items = max_items
+        self._ring = [None] * max_items
+
+        # Position in the ring of the oldest item
+        self._head = 0
+        self._count = 0
+
+        # Number the next appended item will get
+        self._next_idx = 1
+
+        # Number of the first item in the current session
+        self._session_start_idx = 1
+
+        # Number of the first item the trigram index was built with
+        self._index_start_idx = 1
+
+        super().__init__()
+        for pos, item in enumerate(seq):
+            if pos == 0 and item.idx > 1:
+                self._next_idx = item.idx
+            if item.idx != self._next_idx:
+                item = attr.evolve(item, idx=self._next_idx)
+            self._add(item)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __delitem__(self, index: Union[int, slice]) -> None:
+        positions = range(self._count)[index]
+        if isinstance(positions, int):
+            positions = range(positions, positions + 1)
+        if not positions:
+            return
+        if positions.step != 1 or (positions.start != 0 and positions.stop != self._count):
+            raise ValueError('only the oldest or newest items can be removed from a RingHistory')
+
+        if positions.start == 0:
+            self._drop(len(positions))
+        else:
+            # The numbers of the removed items are given to the next items appended
+            for pos in reversed(positions):
+                self._ring[(self._head + pos) % self.max_items] = None
+            self._count -= len(positions)
+            self._next_idx -= len(positions)
+            self._trigram_index = None
+
+    @property
+    def first_idx(self) -> int:
+        """Number of the oldest item, or the number the next item will get if there are no items"""
+        return self._next_idx - self._count
+
+    @property
+    def session_start_index(self) -> int:
+        """Zero-based position of the first item in the current session"""
+        return max(self._session_start_idx - self.first_idx, 0)
+
+    @session_start_index.setter
+    def session_start_index(self, value: int) -> None:
+        self._session_start_idx = self.first_idx + value
+
+    def _zero_based_index(self, onebased: Union[int, str]) -> int:
+        """Convert an item number to a zero-based position. Numbers of dropped items become 0."""
+        result = int(onebased)
+        if result > 0:
+            result = max(result - self.first_idx, 0)
+        return result
+
+    def append(self, new: Statement, *, start_time: Optional[float] = None) -> HistoryItem:
+        """Append a HistoryItem to end of the History list, dropping the oldest item if it is full.
+
+        :param new: command line to convert to HistoryItem and add to the end of the History list
+        :param start_time: when the command started running, in seconds since the epoch
+        :return: the new HistoryItem
+        """
+        history_item = HistoryItem(new, self._next_idx, start_time=start_time)
+        self._add(history_item)
+        self._index_item(history_item.raw, history_item.expanded)
+        return history_item
+
+    def clear(self) -> None:
+        """Remove all items from the History list. Numbering starts over at 1."""
+        self._ring = [None] * self.max_items
+        self._head = 0
+        self._count = 0
+        self._next_idx = 1
+        self._trigram_index = None
+        self.start_session()
+
+    def get(self, index: Union[int, str]) -> HistoryItem:
+        """Get an item by its number
+
+        :param index: number of the item or a negative index counting back from the last item
+        :return: a single HistoryItem
+        """
+        index = int(index)
+        if 0 < index < self.first_idx:
+            raise IndexError('Command {} is no longer in the history.'.format(index))
+        return super().get(index)
+
+    def truncate(self, max_length: int) -> None:
+        """Drop the oldest items if there are more than max_length. Numbering continues from where it was.
+
+        :param max_length: the maximum length of the history, if negative, all history
+                           items will be deleted
+        """
+        self._drop(self._count - max(max_length, 0))
+
+    def _add(self, item: HistoryItem) -> None:
+        """Add an item to the ring"""
+        if self._count == self.max_items:
+            # Overwrite the oldest item
+            self._ring[self._head] = item
+            self._head = (self._head + 1) % self.max_items
+        else:
+            self._ring[(self._head + self._count) % self.max_items] = item
+            self._count += 1
+        self._next_idx = item.idx + 1
+
+    def _drop(self, count: int) -> None:
+        """Drop the oldest items
+
+        :param count: the number of items to drop
+        """
+        for _ in range(min(count, self._count)):
+            self._ring[self._head] = None
+            self._head = (self._head + 1) % self.max_items
+            self._count -= 1
+
+    def _item(self, pos: int) -> HistoryItem:
+        return self._ring[(self._head + pos) % self.max_items]
+
+    def _replace(self, pos: int, item: HistoryItem) -> None:
+        self._ring[(self._head + pos) % self.max_items] = item
+
+    def _append_item(self, item: HistoryItem) -> None:
+        if item.idx != self._next_idx:
+            item = attr.evolve(item, idx=self._next_idx)
+        self._add(item)
+        self._index_item(item.raw, item.expanded)
+
+    def _rebuild(self, items: List[HistoryItem]) -> None:
+        # Numbering starts where it did before
+        first_idx = self.first_idx
+        session_start_index = self.session_start_index
+        self._ring = [None] * self.max_items
+        self._head = 0
+        self._count = 0
+        self._next_idx = first_idx
+        self._trigram_index = None
+        for item in items:
+            self._append_item(item)
+        self.session_start_index = session_start_index
+
+    def _candidates(self, literals: List[str]) -> Optional[List[int]]:
+        """Use the trigram index to find the items which might contain all of the given strings
+
+        The index is keyed by item number, so it stays valid as items are dropped.
+
+        :param literals: normalized and casefolded strings
+        :return: the sorted zero-based positions of the items or None if the strings can't narrow them down
+        """
+        first_idx = self.first_idx
+        if self._trigram_index is None or self._trigram_index.count != self._next_idx - self._index_start_idx:
+            self._trigram_index = _TrigramIndex()
+            self._index_start_idx = first_idx
+            for pos in range(self._count):
+                self._trigram_index.add(first_idx + pos, *self._text(pos))
+
+        keys = self._trigram_index.candidates(literals)
+        if keys is None:
+            return None
+        return [key - first_idx for key in keys if key >= first_idx]
+
+    def _index_item(self, raw: str, expanded: str) -> None:
+        """Add the last item to the trigram index if the index has been built"""
+        if self._trigram_index is None:
+            return
+
+        # Once the index holds more dropped items than held ones, it is rebuilt by the next search
+        up_to_date = self._trigram_index.count == self._next_idx - 1 - self._index_start_idx
+        if up_to_date and self.first_idx - self._index_start_idx <= self.max_items:
+            self._trigram_index.add(self._next_idx - 1, raw, expanded)
+        else:
+            self._trigram_index = None
+
+
+# The Statement attributes which are saved when history is written to a file
+_STATEMENT_FIELDS = [field.name for field in attr.fields(Statement)]
+
+# The HistoryItem attributes which describe how its command ran
+_RUN_INFO_FIELDS = ['start_time', 'elapsed', 'cpu_time', 'succeeded']
+
+
+def _encode_statement(statement: Statement) -> bytes:
+    """Convert a statement to JSON"""
+    fields = {name: getattr(statement, name) for name in _STATEMENT_FIELDS}
+    return json.dumps(fields, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class HistoryJournal:
+    """An append-only file which persists history
+
+    The file begins with a header line and is followed by one JSON record per line. Each command
+    is written as soon as it finishes running, so nothing is lost if the process is killed later.
+    Since commands run by another command finish first, the items are ordered by when their
+    commands started once they are read. When the file holds too many records, it gets compacted by
+    rewriting only the most recent ones.
+
+    Files in the pickle format used by versions 0.9.13 through 0.9.19 are still read. They are
+    converted to the journal format the next time the file is written.
+    """
+    HEADER = b'# cmd2 history journal 1\n'
+
+    def __init__(self, filename: str) -> None:
+        """Initialize an instance of HistoryJournal
+
+        :param filename: path of the file holding the journal
+        """
+        self.filename = filename
+
+        # Number of records in the file
+        self.record_count = 0
+
+        # True if the file must be rewritten before it can be appended to. This is the case
+        # when it is in an older format or its last record was only partially written.
+        self.needs_rewrite = False
+
+    def load(self, max_items: int) -> List[HistoryItem]:
+        """Read the most recent history items from the file
+
+        Only the records which will be kept are decoded, so loading a large file is cheap.
+
+        :param max_items: maximum number of items to return
+        :return: the items in the order they were run
+        :raises OSError if the file can't be read
+        """
+        try:
+            with open(self.filename, 'rb') as fobj:
+                data = fobj.read()
+        except FileNotFoundError:
+            data = b''
+        return self._load_data(data, max_items)
+
+    def _load_data(self, data: bytes, max_items: int) -> List[HistoryItem]:
+        """Read the most recent history items from the contents of the file
+
+        :param data: the contents of the file
+        :param max_items: maximum number of items to return
+        :return: the items in the order they were run
+        """
+        self.record_count = 0
+        self.needs_rewrite = False
+
+        if not data.startswith(self.HEADER):
+            # An empty file can simply be appended to
+            self.needs_rewrite = bool(data)
+            return self._load_pickle(data, max_items) if data else []
+
+        records = data[len(self.HEADER):].split(b'\n')
+
+        # Every complete record ends with a line feed, so the last element is empty unless
+        # the process writing the final record was killed partway through it
+        if records.pop():
+            self.needs_rewrite = True
+        self.record_count = len(records)
+
+        items = []
+        first = max(len(records) - max_items, 0) if max_items > 0 else len(records)
+        for pos in range(first, len(records)):
+            item = self._decode(records[pos], pos + 1)
+            if item is None:
+                self.needs_rewrite = True
+            else:
+                items.append(item)
+
+        # Items written before start times were recorded are older than all the others
+        items.sort(key=lambda item: -math.inf if item.start_time is None else item.start_time)
+        return items
+
+    @staticmethod
+    def _load_pickle(data: bytes, max_items: int) -> List[HistoryItem]:
+        """Read history items from a pickled History"""
+        try:
+            history = pickle.loads(data)
+        except (AttributeError, EOFError, ImportError, IndexError, KeyError, TypeError, ValueError,
+                pickle.UnpicklingError):
+            # This includes the plain text files from versions 0.9.12 and earlier
+            return []
+
+        if not isinstance(history, list) or max_items <= 0:
+            return []
+
+        # Recreate the items since pickled ones don't have the attributes added to HistoryItem since then
+        return [HistoryItem(item.statement, item.idx) for item in history if isinstance(item, HistoryItem)][-max_items:]
+
+    def append(self, item: HistoryItem) -> None:
+        """Add a history item to the end of the file
+
+        :param item: the item being added
+        :raises OSError if the file can't be written
+        """
+        with open(self.filename, 'ab') as fobj:
+            if fobj.tell() == 0:
+                fobj.write(self.HEADER)
+            fobj.write(self._encode(item))
+        self.record_count += 1
+
+    def rewrite(self, items: Iterable[HistoryItem]) -> None:
+        """Replace the contents of the file with the given history items
+
+        The new contents are written to a temporary file which then replaces the original,
+        so the file is never left partially written.
+
+        :param items: the items the file will contain
+        :raises OSError if the file can't be written
+        """
+        self.record_count = self._replace_contents(self._encode(item) for item in items)
+        self.needs_rewrite = False
+
+    def _replace_contents(self, records: Iterable[bytes]) -> int:
+        """Replace the contents of the file with the header and the given records
+
+        :param records: the encoded records
+        :return: the number of records written
+        :raises OSError if the file can't be written
+        """
+        fd, temp_name = tempfile.mkstemp(prefix=os.path.basename(self.filename) + '.',
+                                         dir=os.path.dirname(self.filename))
+        try:
+            count = 0
+            with os.fdopen(fd, 'wb') as fobj:
+                fobj.write(self.HEADER)
+                for record in records:
+                    fobj.write(record)
+                    count += 1
+            os.replace(temp_name, self.filename)
+        except BaseException:
+            try:
+                os.remove(temp_name)
+            except OSError:
+                pass
+            raise
+        return count
+
+    def clear(self) -> None:
+        """Delete the file
+
+        :raises OSError if the file exists and can't be deleted
+        """
+        try:
+            os.remove(self.filename)
+        except FileNotFoundError:
+            pass
+        self.record_count = 0
+        self.needs_rewrite = False
+
+    @staticmethod
+    def _encode(item: HistoryItem) -> bytes:
+        """Convert a history item to a record"""
+        record = '{{"idx":{}'.format(item.idx)
+        for name in _RUN_INFO_FIELDS:
+            value = getattr(item, name)
+            if value is not None:
+                record += ',"{}":{}'.format(name, json.dumps(value))
+        return record.encode() + b',"statement":' + _encode_statement(item.statement) + b'}\n'
+
+    @staticmethod
+    def _decode(record: bytes, default_idx: int) -> Optional[HistoryItem]:
+        """Convert a record to a history item
+
+        :param record: the record being decoded
+        :param default_idx: the index to give the item if the record doesn't have one
+        :return: the item or None if the record is damaged
+        """
+        try:
+            record = json.loads(record.decode('utf-8'))
+            fields = record['statement']
+            args = fields.pop('args')
+            run_info = {name: record[name] for name in _RUN_INFO_FIELDS if name in record}
+            return HistoryItem(Statement(args, **fields), record.get('idx', default_idx), **run_info)
+        except (AttributeError, KeyError, TypeError, ValueError):
+            return None
+
+
+class _FileLock:
+    """An exclusive advisory lock which is held for the duration of a with statement
+
+    The lock is taken on a separate file since the file it protects gets replaced when it is rewritten.
+    """
+    def __init__(self, filename: str) -> None:
+        """Initialize an instance of _FileLock
+
+        :param filename: path of the lock file, which is created if it doesn't exist
+        """
+        self.filename = filename
+        self._fobj = None
+
+    def __enter__(self) -> '_FileLock':
+        self._fobj = open(self.filename, 'ab')
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fobj.fileno(), fcntl.LOCK_EX)
+            else:  # pragma: no cover
+                # Lock the first byte. This retries for 10 seconds before raising an OSError.
+                self._fobj.seek(0)
+                msvcrt.locking(self._fobj.fileno(), msvcrt.LK_LOCK, 1)
+        except BaseException:
+            self._fobj.close()
+            raise
+        return self
+
+    def __exit__(self, *exc_info) -> None:
+        try:
+            if fcntl is not None:
+                fcntl.flock(self._fobj.fileno(), fcntl.LOCK_UN)
+            else:  # pragma: no cover
+                self._fobj.seek(0)
+                msvcrt.locking(self._fobj.fileno(), msvcrt.LK_UNLCK, 1)
+        finally:
+            self._fobj.close()
+            self._fobj = None
+
+
+class SharedHistoryJournal(HistoryJournal):
+    """A HistoryJournal which several processes can use at the same time
+
+    Writes are made while holding an advisory lock on the file with a .lock suffix. The journal keeps
+    track of how much of the file it has read, so the records other processes add can be read with
+    read_new() without reading the whole file again. Items are ordered by when their commands started
+    when the file is loaded, which merges the history of all the processes.
+
+    Compacting keeps the most recent records in the file instead of writing this process's history,
+    so the commands of other processes aren't lost.
+    """
+    def __init__(self, filename: str) -> None:
+        """Initialize an instance of SharedHistoryJournal
+
+        :param filename: path of the file holding the journal
+        """
+        super().__init__(filename)
+        self._lock = _FileLock(filename + '.lock')
+
+        # The file which was read, as a (device, inode) pair, and how many bytes of it have been read
+        self._file_id = None
+        self._offset = 0
+
+        # Hashes of the records which have been read or written. When another process compacts the
+        # file, these tell which of the records in the new file haven't been read yet.
+        self._seen = set()
+
+        # Items added by other processes which were read while writing to the file
+        self._unread = []
+
+    def load(self, max_items: int) -> List[HistoryItem]:
+        """Read the most recent history items from the file
+
+        :param max_items: maximum number of items to return
+        :return: the items in the order they were run
+        :raises OSError if the file can't be read
+        """
+        with self._lock:
+            self._file_id = None
+            self._offset = 0
+            self._seen = set()
+            self._unread = []
+            try:
+                with open(self.filename, 'rb') as fobj:
+                    data = fobj.read()
+                    self._track(fobj, data)
+            except FileNotFoundError:
+                data = b''
+            return self._load_data(data, max_items)
+
+    def read_new(self) -> List[HistoryItem]:
+        """Read the items other processes have added to the file since it was last read
+
+        :return: the new items in the order they were run
+        :raises OSError if the file can't be read
+        """
+        items = self._unread + self._read_new()
+        self._unread = []
+        items.sort(key=lambda item: -math.inf if item.start_time is None else item.start_time)
+        return items
+
+    def append(self, item: HistoryItem) -> None:
+        """Add a history item to the end of the file
+
+        Records other processes added since the file was last read are read first. read_new() returns them.
+
+        :param item: the item being added
+        :raises OSError if the file can't be written
+        """
+        record = self._encode(item)
+        with self._lock:
+            self._unread.extend(self._read_new())
+            with open(self.filename, 'ab') as fobj:
+                if fobj.tell() == 0:
+                    fobj.write(self.HEADER)
+                    self._file_id = None
+                    self._seen = set()
+                fobj.write(record)
+                self._file_id = self._id(os.fstat(fobj.fileno()))
+                self._offset = fobj.tell()
+            self._seen.add(hash(record[:-1]))
+            self.record_count += 1
+
+    def compact(self, max_items: int) -> None:
+        """Rewrite the file with only its most recent records
+
+        :param max_items: the number of records to keep
+        :raises OSError if the file can't be read or written
+        """
+        with self._lock:
+            self._unread.extend(self._read_new())
+            try:
+                with open(self.filename, 'rb') as fobj:
+                    data = fobj.read()
+            except FileNotFoundError:
+                data = b''
+
+            if data.startswith(self.HEADER):
+                # The records are copied as they are, which keeps their hashes the same
+                records = data[len(self.HEADER):].split(b'\n')
+                records.pop()
+                records = records[-max_items:] if max_items > 0 else []
+                self.record_count = self._replace_contents(record + b'\n' for record in records)
+                self.needs_rewrite = False
+            else:
+                super().rewrite(self._load_data(data, max_items))
+
+            with open(self.filename, 'rb') as fobj:
+                self._seen = set()
+                self._track(fobj, fobj.read())
+
+    def rewrite(self, items: Iterable[HistoryItem]) -> None:
+        """Replace the contents of the file with the given history items
+
+        :param items: the items the file will contain
+        :raises OSError if the file can't be written
+        """
+        with self._lock:
+            super().rewrite(items)
+            with open(self.filename, 'rb') as fobj:
+                self._seen = set()
+                self._track(fobj, fobj.read())
+
+    def clear(self) -> None:
+        """Delete the file
+
+        :raises OSError if the file exists and can't be deleted
+        """
+        with self._lock:
+            super().clear()
+            self._file_id = None
+            self._offset = 0
+            self._seen = set()
+            self._unread = []
+
+    @staticmethod
+    def _id(stat_result: os.stat_result) -> Tuple[int, int]:
+        """Identify a file by its device and inode, which change when it is replaced"""
+        return stat_result.st_dev, stat_result.st_ino
+
+    def _track(self, fobj, data: bytes) -> List[bytes]:
+        """Record that the contents of a file were read
+
+        :param fobj: the open file
+        :param data: what was read from the beginning of the file
+        :return: the complete records in data which hadn't been seen
+        """
+        self._file_id = self._id(os.fstat(fobj.fileno()))
+        if not data.startswith(self.HEADER):
+            self._offset = 0
+            return []
+
+        # A record without its line feed is still being written or was left by a killed process
+        end = data.rfind(b'\n') + 1
+        self._offset = end
+        new_records = []
+        for record in data[len(self.HEADER):end].split(b'\n')[:-1]:
+            key = hash(record)
+            if key not in self._seen:
+                self._seen.add(key)
+                new_records.append(record)
+        return new_records
+
+    def _read_new(self) -> List[HistoryItem]:
+        """Read the records added to the file since it was last read
+
+        :return: the items in the order they are in the file
+        """
+        try:
+            fobj = open(self.filename, 'rb')
+        except FileNotFoundError:
+            # Another process cleared the history
+            self._file_id = None
+            self._offset = 0
+            self._seen = set()
+            return []
+
+        with fobj:
+            file_id = self._id(os.fstat(fobj.fileno()))
+            if file_id == self._file_id and self._offset > 0:
+                # Only read what was appended
+                fobj.seek(self._offset)
+                data = fobj.read()
+                end = data.rfind(b'\n') + 1
+                self._offset += end
+                records = data[:end].split(b'\n')[:-1]
+                records = [record for record in records if hash(record) not in self._seen]
+                self._seen.update(hash(record) for record in records)
+                self.record_count += len(records)
+            else:
+                # The file was replaced, so read all of it and skip the records which were already seen
+                data = fobj.read()
+                records = self._track(fobj, data)
+                self.record_count = data.count(b'\n') - 1 if data.startswith(self.HEADER) else 0
+
+        items = []
+        for record in records:
+            item = self._decode(record, 0)
+            if item is not None:
+                items.append(item)
+        return items
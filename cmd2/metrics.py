@@ -0,0 +1,237 @@
+# coding=utf-8
+"""
+Latency metrics for the phases commands go through in onecmd_plus_hooks()
+"""
+
+import json
+import math
+import time
+
+from typing import Dict, Iterable, List, Optional
+
+# The phases of onecmd_plus_hooks() in the order they run
+PHASE_PARSE = 'parse'
+PHASE_POSTPARSING = 'postparsing'
+PHASE_REDIRECT = 'redirect'
+PHASE_PRECMD = 'precmd'
+PHASE_COMMAND = 'command'
+PHASE_POSTCMD = 'postcmd'
+PHASE_RESTORE = 'restore'
+PHASE_FINALIZATION = 'finalization'
+
+# The time from the start of parsing to the end of finalization
+PHASE_TOTAL = 'total'
+
+PHASES = (PHASE_PARSE, PHASE_POSTPARSING, PHASE_REDIRECT, PHASE_PRECMD, PHASE_COMMAND, PHASE_POSTCMD,
+          PHASE_RESTORE, PHASE_FINALIZATION, PHASE_TOTAL)
+
+
+class LatencyHistogram:
+    """Counts latencies in buckets whose bounds grow logarithmically
+
+    The first bucket holds every latency up to MIN_LATENCY seconds. Each following bucket is 2 ** (1 / 8)
+    times as wide as the one before it, so a percentile is never off by more than about 9%.
+    """
+    MIN_LATENCY = 1e-6
+    BUCKETS_PER_DOUBLING = 8
+
+    def __init__(self) -> None:
+        self.counts = []
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    @classmethod
+    def bucket_index(cls, seconds: float) -> int:
+        """Return the index of the bucket a latency is counted in"""
+        if seconds <= cls.MIN_LATENCY:
+            return 0
+        return int(math.ceil(math.log2(seconds / cls.MIN_LATENCY) * cls.BUCKETS_PER_DOUBLING))
+
+    @classmethod
+    def bucket_bound(cls, index: int) -> float:
+        """Return the largest latency counted in a bucket"""
+        return cls.MIN_LATENCY * 2 ** (index / cls.BUCKETS_PER_DOUBLING)
+
+    def add(self, seconds: float) -> None:
+        """Count one latency
+
+        :param seconds: the latency in seconds
+        """
+        index = self.bucket_index(seconds)
+        if index >= len(self.counts):
+            self.counts.extend([0] * (index + 1 - len(self.counts)))
+        self.counts[index] += 1
+
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if self.max is None or seconds > self.max:
+            self.max = seconds
+
+    def merge(self, other: 'LatencyHistogram') -> None:
+        """Add the latencies counted by another histogram to this one"""
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+
+        self.count += other.count
+        self.total += other.total
+        if other.min is not None and (self.min is None or other.min < self.min):
+            self.min = other.min
+        if other.max is not None and (self.max is None or other.max > self.max):
+            self.max = other.max
+
+    @property
+    def mean(self) -> Optional[float]:
+        """The average latency in seconds or None if nothing has been counted"""
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def percentile(self, percent: float) -> Optional[float]:
+        """Return the latency in seconds which the given percent of latencies are at or below
+
+        :param percent: a number from 0 to 100
+        :return: the upper bound of the bucket holding the percentile, limited to the smallest and largest
+                 latencies counted, or None if nothing has been counted
+        :raises ValueError: if percent is out of range
+        """
+        if not 0 <= percent <= 100:
+            raise ValueError("percent must be from 0 to 100")
+        if not self.count:
+            return None
+        if percent == 0:
+            return self.min
+
+        rank = max(1, int(math.ceil(self.count * percent / 100)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank:
+                return max(self.min, min(self.bucket_bound(index), self.max))
+
+    def to_dict(self, percentiles: Iterable[float] = (50, 90, 99)) -> Dict[str, Optional[float]]:
+        """Return the count, total, and the mean, min, max, and percentile latencies in a dictionary
+
+        Percentiles are stored with keys like 'p50'.
+        """
+        result = {'count': self.count, 'total': self.total, 'mean': self.mean, 'min': self.min, 'max': self.max}
+        for percent in percentiles:
+            result['p{:g}'.format(percent)] = self.percentile(percent)
+        return result
+
+
+class PhaseTimer:
+    """Measures how long each phase of one command takes"""
+
+    def __init__(self) -> None:
+        self.start = self._last = time.perf_counter()
+        self.durations = {}
+
+    def lap(self, phase: str) -> None:
+        """Record the time since the last lap as the duration of a phase"""
+        now = time.perf_counter()
+        self.durations[phase] = self.durations.get(phase, 0.0) + now - self._last
+        self._last = now
+
+    def stop(self) -> None:
+        """Record the time since the timer started as the total duration"""
+        self.durations[PHASE_TOTAL] = self._last - self.start
+
+
+class CommandMetrics:
+    """Latency histograms for each phase of each command run by onecmd_plus_hooks()
+
+    Nothing is recorded until enabled is set to True.
+    """
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self._histograms = {}
+
+    def start(self) -> Optional[PhaseTimer]:
+        """Return a PhaseTimer for a command that is about to run or None if metrics are not enabled"""
+        if not self.enabled:
+            return None
+        return PhaseTimer()
+
+    def record(self, command: str, timer: PhaseTimer) -> None:
+        """Add the phase durations measured by a PhaseTimer to the histograms of a command"""
+        timer.stop()
+        phases = self._histograms.setdefault(command, {})
+        for phase, duration in timer.durations.items():
+            histogram = phases.get(phase)
+            if histogram is None:
+                histogram = phases[phase] = LatencyHistogram()
+            histogram.add(duration)
+
+    def commands(self) -> List[str]:
+        """Return the names of the commands which have metrics"""
+        return list(self._histograms)
+
+    def histogram(self, phase: str, command: Optional[str] = None) -> LatencyHistogram:
+        """Return the histogram of a phase
+
+        :param phase: one of PHASES
+        :param command: name of the command or None for the phase of all commands combined
+        :return: a copy of the histogram which is empty if nothing was recorded for it
+        """
+        if phase not in PHASES:
+            raise ValueError("{!r} is not a phase".format(phase))
+
+        result = LatencyHistogram()
+        if command is None:
+            sources = self._histograms.values()
+        else:
+            sources = [self._histograms.get(command, {})]
+
+        for phases in sources:
+            if phase in phases:
+                result.merge(phases[phase])
+        return result
+
+    def percentile(self, percent: float, phase: str = PHASE_TOTAL, command: Optional[str] = None) -> Optional[float]:
+        """Return a percentile latency in seconds of a phase
+
+        :param percent: a number from 0 to 100
+        :param phase: one of PHASES
+        :param command: name of the command or None for the phase of all commands combined
+        :return: the latency or None if nothing was recorded for the phase
+        """
+        return self.histogram(phase, command).percentile(percent)
+
+    def summary(self, percentiles: Iterable[float] = (50, 90, 99)) -> Dict[str, Dict[str, Dict[str, Optional[float]]]]:
+        """Return the statistics of every phase of every command as nested dictionaries
+
+        The dictionaries are keyed by command name, then by phase, and hold the values of LatencyHistogram.to_dict().
+        """
+        percentiles = list(percentiles)
+        result = {}
+        for command, phases in self._histograms.items():
+            result[command] = {phase: phases[phase].to_dict(percentiles) for phase in PHASES if phase in phases}
+        return result
+
+    def export(self, filename: str, percentiles: Iterable[float] = (50, 90, 99)) -> None:
+        """Write the summary of all commands to a JSON file
+
+        :raises OSError: if the file can't be written
+        """
+        data = {'time': time.time(), 'commands': self.summary(percentiles)}
+        with open(filename, 'w') as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+            f.write('\n')
+
+    def clear(self, commands: Optional[Iterable[str]] = None) -> None:
+        """Delete the metrics of some or all commands
+
+        :param commands: names of the commands or None for all of them
+        """
+        if commands is None:
+            self._histograms.clear()
+        else:
+            for command in commands:
+                self._histograms.pop(command, None)
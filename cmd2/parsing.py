@@ -2,9 +2,11 @@
 # -*- coding: utf-8 -*-
 """Statement parsing classes for cmd2"""
 
+import collections
+import itertools
 import re
 import shlex
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+from typing import Any, Callable, Dict, Iterable, List, Optional, Pattern, Tuple, Union
 
 import attr
 
@@ -22,6 +24,63 @@ def shlex_split(str_to_split: str) -> List[str]:
     return shlex.split(str_to_split, comments=False, posix=False)
 
 
+# Characters shlex treats as whitespace
+_SHLEX_WHITESPACE = ' \t\r\n'
+
+# The tokens which end a filter started with |>. This doesn't use constants.REDIRECTION_TOKENS since commands
+# like alias create have extended that list.
+_FILTER_END_TOKENS = (constants.REDIRECTION_PIPE, constants.REDIRECTION_OUTPUT, constants.REDIRECTION_APPEND)
+
+# Statistics of the StatementParser parse cache
+ParseCacheInfo = collections.namedtuple('ParseCacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class _AliasDict(dict):
+    """Dictionary of aliases which calls on_change every time it is modified"""
+    def __init__(self, *args, on_change: Optional[Callable[[], None]] = None, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self._on_change = on_change
+
+    def _changed(self) -> None:
+        if self._on_change is not None:
+            self._on_change()
+
+    def __setitem__(self, key, value) -> None:
+        super().__setitem__(key, value)
+        self._changed()
+
+    def __delitem__(self, key) -> None:
+        super().__delitem__(key)
+        self._changed()
+
+    def clear(self) -> None:
+        super().clear()
+        self._changed()
+
+    def pop(self, *args):
+        result = super().pop(*args)
+        self._changed()
+        return result
+
+    def popitem(self):
+        result = super().popitem()
+        self._changed()
+        return result
+
+    def setdefault(self, key, default=None):
+        result = super().setdefault(key, default)
+        self._changed()
+        return result
+
+    def update(self, *args, **kwargs) -> None:
+        super().update(*args, **kwargs)
+        self._changed()
+
+    def __reduce__(self):
+        # Pickle and copy as a plain dictionary since on_change refers to the parser
+        return dict, (dict(self),)
+
+
 @attr.s(frozen=True)
 class MacroArg:
     """
@@ -70,6 +129,35 @@ class Macro:
     # Used to fill in argument placeholders in the macro
     arg_list = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
 
+    # The value compiled into an ordered tuple of literal strings and the ints of the arguments which go between
+    # them. Escaped arguments are already unescaped in the literals. This is built from value and arg_list when
+    # the macro is created so resolving it is a single join.
+    template = attr.ib(init=False, repr=False)
+
+    def __attrs_post_init__(self) -> None:
+        """Compile the template. object.__setattr__ is needed since this class is frozen."""
+        template = []
+        literal = ''
+        cur_index = 0
+
+        for arg in sorted(self.arg_list, key=lambda ma: ma.start_index):
+            if arg.is_escaped:
+                placeholder_len = len(arg.number_str) + 4
+                literal += self.value[cur_index:arg.start_index] + '{' + arg.number_str + '}'
+            else:
+                placeholder_len = len(arg.number_str) + 2
+                template.append(literal + self.value[cur_index:arg.start_index])
+                template.append(int(arg.number_str))
+                literal = ''
+            cur_index = arg.start_index + placeholder_len
+
+        template.append(literal + self.value[cur_index:])
+        object.__setattr__(self, 'template', tuple(template))
+
+
+# Names of the values Statement computes on first access and stores in its __dict__
+_STATEMENT_CACHED = frozenset(['_argv', '_command_and_args'])
+
 
 @attr.s(frozen=True)
 class Statement(str):
@@ -159,6 +247,9 @@ class Statement(str):
     # characters appearing after the terminator but before output redirection, if any
     suffix = attr.ib(default='', validator=attr.validators.instance_of(str))
 
+    # if output was piped through in-process filters with |>, the command line of each filter (quotes preserved)
+    filters = attr.ib(default=attr.Factory(list), validator=attr.validators.instance_of(list))
+
     # if output was piped to a shell command, the shell command as a string
     pipe_to = attr.ib(default='', validator=attr.validators.instance_of(str))
 
@@ -180,6 +271,39 @@ class Statement(str):
         stmt = super().__new__(cls, value)
         return stmt
 
+    @classmethod
+    def _create(cls, args: str, *, raw: str = '', command: str = '', arg_list: Optional[List[str]] = None,
+                multiline_command: str = '', terminator: str = '', suffix: str = '',
+                filters: Optional[List[str]] = None, pipe_to: str = '', output: str = '',
+                output_to: str = '') -> 'Statement':
+        """Create a Statement without running the attrs generated __init__ and its validators.
+
+        This is for internal code like StatementParser which already guarantees the
+        types of every value. The resulting object is identical to one created normally.
+        """
+        stmt = str.__new__(cls, args)
+        stmt.__dict__.update(args=args,
+                             raw=raw,
+                             command=command,
+                             arg_list=arg_list if arg_list is not None else [],
+                             multiline_command=multiline_command,
+                             terminator=terminator,
+                             suffix=suffix,
+                             filters=filters if filters is not None else [],
+                             pipe_to=pipe_to,
+                             output=output,
+                             output_to=output_to)
+        return stmt
+
+    def __getstate__(self) -> Dict[str, Any]:
+        """Leave lazily computed values out of pickled and copied Statements"""
+        return {key: value for key, value in self.__dict__.items() if key not in _STATEMENT_CACHED}
+
+    def __setstate__(self, state: Dict[str, Any]) -> None:
+        """Give Statements pickled before filters existed an empty list of them"""
+        self.__dict__['filters'] = []
+        self.__dict__.update(state)
+
     @property
     def command_and_args(self) -> str:
         """Combine command and args with a space separating them.
@@ -187,6 +311,13 @@ class Statement(str):
         Quoted arguments remain quoted. Output redirection and piping are
         excluded, as are any command terminators.
         """
+        # Statements are immutable, so this is only built once. Write to __dict__
+        # directly since the frozen class won't allow normal assignment.
+        try:
+            return self.__dict__['_command_and_args']
+        except KeyError:
+            pass
+
         if self.command and self.args:
             rtn = '{} {}'.format(self.command, self.args)
         elif self.command:
@@ -194,6 +325,8 @@ class Statement(str):
             rtn = self.command
         else:
             rtn = ''
+
+        self.__dict__['_command_and_args'] = rtn
         return rtn
 
     @property
@@ -206,6 +339,9 @@ class Statement(str):
         if self.suffix:
             rtn += ' ' + self.suffix
 
+        for filter_line in self.filters:
+            rtn += ' ' + constants.REDIRECTION_FILTER + ' ' + filter_line
+
         if self.pipe_to:
             rtn += ' | ' + self.pipe_to
 
@@ -228,14 +364,18 @@ class Statement(str):
         Quotes, if any, are removed from the elements of the list, and aliases
         and shortcuts are expanded
         """
-        if self.command:
-            rtn = [utils.strip_quotes(self.command)]
-            for cur_token in self.arg_list:
-                rtn.append(utils.strip_quotes(cur_token))
-        else:
-            rtn = []
+        try:
+            argv = self.__dict__['_argv']
+        except KeyError:
+            if self.command:
+                argv = tuple(utils.strip_quotes(cur_token)
+                             for cur_token in itertools.chain([self.command], self.arg_list))
+            else:
+                argv = ()
+            self.__dict__['_argv'] = argv
 
-        return rtn
+        # Return a new list each time so callers can't change the cached value
+        return list(argv)
 
 
 class StatementParser:
@@ -248,7 +388,9 @@ class StatementParser:
                  terminators: Optional[Iterable[str]] = None,
                  multiline_commands: Optional[Iterable[str]] = None,
                  aliases: Optional[Dict[str, str]] = None,
-                 shortcuts: Optional[Dict[str, str]] = None) -> None:
+                 shortcuts: Optional[Dict[str, str]] = None,
+                 native_tokenizer: bool = True,
+                 parse_cache_size: int = 256) -> None:
         """Initialize an instance of StatementParser.
 
         The following will get converted to an immutable tuple before storing internally:
@@ -256,19 +398,41 @@ class StatementParser:
         * multiline commands
         * shortcuts
 
+        aliases is copied into a dictionary which tracks its own changes. Assigning to any of these
+        attributes later on is supported and invalidates previously cached parsing results.
+
         :param terminators: iterable containing strings which should terminate commands
         :param multiline_commands: iterable containing the names of commands that accept multiline input
         :param aliases: dictionary containing aliases
         :param shortcuts: dictionary containing shortcuts
+        :param native_tokenizer: if True, split lines with a single-pass tokenizer instead of shlex_split()
+                                 followed by split_on_punctuation(). Both produce the same tokens.
+        :param parse_cache_size: maximum number of results from parse() and parse_command_only() to cache.
+                                 Set to 0 to disable caching.
         """
+        # Incremented every time something that affects parsing results changes. Cached parsing
+        # results are keyed on it so they are never returned once they may be stale.
+        self._generation = 0
+
+        # Least recently used cache of Statements keyed on (generation, command_only, line)
+        self._parse_cache = collections.OrderedDict()
+        self._parse_cache_hits = 0
+        self._parse_cache_misses = 0
+        self.parse_cache_size = parse_cache_size
+
+        self.native_tokenizer = native_tokenizer
+
+        # Fully expanded prefix of each alias which has been used since the alias table last changed
+        self._alias_expansions = dict()
+
         if terminators is None:
             self.terminators = (constants.MULTILINE_TERMINATOR,)
         else:
-            self.terminators = tuple(terminators)
+            self.terminators = terminators
         if multiline_commands is None:
             self.multiline_commands = tuple()
         else:
-            self.multiline_commands = tuple(multiline_commands)
+            self.multiline_commands = multiline_commands
         if aliases is None:
             self.aliases = dict()
         else:
@@ -276,11 +440,105 @@ class StatementParser:
 
         if shortcuts is None:
             shortcuts = constants.DEFAULT_SHORTCUTS
+        self.shortcuts = shortcuts
+
+    @property
+    def generation(self) -> int:
+        """Counter which increases every time aliases, shortcuts, terminators, or multiline_commands change"""
+        return self._generation
+
+    def _invalidate(self) -> None:
+        """Called when something that affects parsing results changes"""
+        self._generation += 1
+
+    @property
+    def terminators(self) -> Tuple[str, ...]:
+        """Strings which terminate commands"""
+        return self._terminators
+
+    @terminators.setter
+    def terminators(self, terminators: Iterable[str]) -> None:
+        self._terminators = tuple(terminators)
+        self._command_pattern = self._build_command_pattern()
+        self._token_pattern, self._quoted_token_pattern = self._build_token_patterns()
+
+        # Alias expansions depend on the command pattern
+        self._alias_expansions.clear()
+        self._invalidate()
+
+    @property
+    def multiline_commands(self) -> Tuple[str, ...]:
+        """Names of commands that accept multiline input"""
+        return self._multiline_commands
+
+    @multiline_commands.setter
+    def multiline_commands(self, multiline_commands: Iterable[str]) -> None:
+        self._multiline_commands = tuple(multiline_commands)
+        self._invalidate()
+
+    @property
+    def aliases(self) -> Dict[str, str]:
+        """Dictionary of aliases. Changes made to it invalidate cached parsing results."""
+        return self._aliases
+
+    @aliases.setter
+    def aliases(self, aliases: Dict[str, str]) -> None:
+        self._aliases = _AliasDict(aliases, on_change=self._aliases_changed)
+        self._aliases_changed()
+
+    @property
+    def shortcuts(self) -> Tuple[Tuple[str, str], ...]:
+        """Tuple of (shortcut, expansion) tuples sorted by descending shortcut length"""
+        return self._shortcuts
+
+    @shortcuts.setter
+    def shortcuts(self, shortcuts: Union[Dict[str, str], Iterable[Tuple[str, str]]]) -> None:
+        if isinstance(shortcuts, dict):
+            shortcuts = shortcuts.items()
 
         # Sort the shortcuts in descending order by name length because the longest match
         # should take precedence. (e.g., @@file should match '@@' and not '@'.
-        self.shortcuts = tuple(sorted(shortcuts.items(), key=lambda x: len(x[0]), reverse=True))
+        self._shortcuts = tuple(sorted(shortcuts, key=lambda x: len(x[0]), reverse=True))
+
+        # Build a trie of the shortcuts for longest prefix matching. Each node is a dictionary keyed by
+        # character. A node which completes a shortcut stores its (shortcut, expansion) tuple under None.
+        self._shortcut_trie = dict()
+        for shortcut, expansion in self._shortcuts:
+            node = self._shortcut_trie
+            for char in shortcut:
+                node = node.setdefault(char, dict())
+            node[None] = (shortcut, expansion)
+
+        self._invalidate()
 
+    def match_shortcut(self, line: str) -> Optional[Tuple[str, str]]:
+        """Find the longest shortcut which a line starts with.
+
+        :param line: the line being checked
+        :return: the (shortcut, expansion) tuple of the match or None if line doesn't start with a shortcut
+        """
+        node = self._shortcut_trie
+        longest = node.get(None)
+        for char in line:
+            node = node.get(char)
+            if node is None:
+                break
+            longest = node.get(None, longest)
+        return longest
+
+    def cache_info(self) -> ParseCacheInfo:
+        """Report statistics of the cache used by parse() and parse_command_only()"""
+        return ParseCacheInfo(hits=self._parse_cache_hits, misses=self._parse_cache_misses,
+                              maxsize=self.parse_cache_size, currsize=len(self._parse_cache))
+
+    def cache_clear(self) -> None:
+        """Empty the cache used by parse() and parse_command_only() and reset its statistics"""
+        self._parse_cache.clear()
+        self._parse_cache_hits = 0
+        self._parse_cache_misses = 0
+
+    def _build_command_pattern(self) -> Pattern:
+        """Build the regular expression which matches the command in a line"""
         # commands have to be a word, so make a regular expression
         # that matches the first word in the line. This regex has three
         # parts:
@@ -311,7 +569,38 @@ class StatementParser:
         second_group = '|'.join(second_group_items)
         # build the regular expression
         expr = r'\A\s*(\S*?)({})'.format(second_group)
-        self._command_pattern = re.compile(expr)
+        return re.compile(expr)
+
+    def _build_token_patterns(self) -> Tuple[Optional[Pattern], Optional[Pattern]]:
+        """Build the regular expressions used by the native tokenizer.
+
+        The patterns reproduce shlex.split(posix=False) followed by split_on_punctuation() in a single scan:
+            - a quote which begins a token runs to the next matching quote, whitespace included
+            - a quote which begins a token but is never closed consumes the rest of the line
+            - everything else is broken on whitespace and on runs of a single punctuation character
+
+        :return: A tuple containing a pattern without groups, suitable for findall(), and the same pattern with
+                 the unclosed quote alternative in a group named 'unclosed'. Both are None if the punctuation
+                 can't be expressed this way, in which case tokenizing falls back to shlex.
+        """
+        punctuation = [p for p in itertools.chain(self.terminators, constants.REDIRECTION_CHARS) if len(p) == 1]
+        if any(p in constants.QUOTES or p in _SHLEX_WHITESPACE for p in punctuation):
+            return None, None
+
+        # Only whitespace, the start of the line, or the end of a quoted token can start a new shlex token
+        token_start = r'(?<![^{}{}])'.format(_SHLEX_WHITESPACE, ''.join(constants.QUOTES))
+        quoted = '|'.join('{0}[^{0}]*{0}'.format(q) for q in constants.QUOTES)
+        unclosed = '[{}].*'.format(''.join(constants.QUOTES))
+        word = '[^{}{}]+'.format(_SHLEX_WHITESPACE, re.escape(''.join(punctuation)))
+        remaining = [word]
+        remaining.extend('{}+'.format(re.escape(p)) for p in utils.remove_duplicates(punctuation))
+
+        expr = '{0}(?:{1})|{0}{2}|{3}'
+        token_pattern = re.compile(expr.format(token_start, quoted, '(?:{})'.format(unclosed), '|'.join(remaining)),
+                                   re.DOTALL)
+        quoted_token_pattern = re.compile(expr.format(token_start, quoted, '(?P<unclosed>{})'.format(unclosed),
+                                                      '|'.join(remaining)), re.DOTALL)
+        return token_pattern, quoted_token_pattern
 
     def is_valid_command(self, word: str) -> Tuple[bool, str]:
         """Determine whether a word is a valid name for a command.
@@ -336,12 +625,11 @@ class StatementParser:
         if word.startswith(constants.COMMENT_CHAR):
             return False, 'cannot start with the comment character'
 
-        for (shortcut, _) in self.shortcuts:
-            if word.startswith(shortcut):
-                # Build an error string with all shortcuts listed
-                errmsg = 'cannot start with a shortcut: '
-                errmsg += ', '.join(shortcut for (shortcut, _) in self.shortcuts)
-                return False, errmsg
+        if self.match_shortcut(word) is not None:
+            # Build an error string with all shortcuts listed
+            errmsg = 'cannot start with a shortcut: '
+            errmsg += ', '.join(shortcut for (shortcut, _) in self.shortcuts)
+            return False, errmsg
 
         errmsg = 'cannot contain: whitespace, quotes, '
         errchars = []
@@ -372,23 +660,96 @@ class StatementParser:
         if line.lstrip().startswith(constants.COMMENT_CHAR):
             return []
 
-        # split on whitespace
-        tokens = shlex_split(line)
+        return self.split_line(line)
+
+    def split_line(self, line: str) -> List[str]:
+        """
+        Split a line into tokens on whitespace and punctuation without expanding shortcuts and aliases
+        or removing comments. The result is the same as split_on_punctuation(shlex_split(line)).
 
-        # custom lexing
-        tokens = self.split_on_punctuation(tokens)
+        :param line: the line being split
+        :return: A list of tokens
+        :raises ValueError if there are unclosed quotation marks.
+        """
+        if not self.native_tokenizer or self._token_pattern is None:
+            return self.split_on_punctuation(shlex_split(line))
+
+        # Without quotes there can't be an unclosed quotation, so let findall() do all of the work
+        if '"' not in line and "'" not in line:
+            return self._token_pattern.findall(line)
+
+        tokens = []
+        for match in self._quoted_token_pattern.finditer(line):
+            if match.lastgroup == 'unclosed':
+                raise ValueError('No closing quotation')
+            tokens.append(match.group())
         return tokens
 
+    def split_partial_line(self, line: str) -> Tuple[List[str], str]:
+        """
+        Split a line like split_line() does, but allow it to end in an unclosed quotation.
+
+        :param line: the line being split
+        :return: A tuple containing the tokens before the unclosed quotation and the text from the
+                 start of the unclosed quotation to the end of the line. The text is empty if all
+                 quotations were closed.
+        """
+        if not self.native_tokenizer or self._token_pattern is None:
+            # shlex doesn't say where the unclosed quotation began, so the whole line is unfinished
+            try:
+                return self.split_line(line), ''
+            except ValueError:
+                return [], line
+
+        tokens = []
+        for match in self._quoted_token_pattern.finditer(line):
+            if match.lastgroup == 'unclosed':
+                return tokens, line[match.start():]
+            tokens.append(match.group())
+        return tokens, ''
+
+    def _cached(self, line: str, command_only: bool) -> Statement:
+        """Return a Statement from the parse cache, creating and caching it on a miss
+
+        :param line: the line being parsed
+        :param command_only: if True, the line is parsed with parse_command_only() instead of parse()
+        :return: the Statement for line
+        """
+        key = (self._generation, command_only, line)
+        try:
+            statement = self._parse_cache[key]
+        except KeyError:
+            self._parse_cache_misses += 1
+        else:
+            self._parse_cache_hits += 1
+            self._parse_cache.move_to_end(key)
+            return statement
+
+        statement = self._parse_command_only(line) if command_only else self._parse(line)
+
+        if self.parse_cache_size > 0:
+            self._parse_cache[key] = statement
+            while len(self._parse_cache) > self.parse_cache_size:
+                self._parse_cache.popitem(last=False)
+        return statement
+
     def parse(self, line: str) -> Statement:
         """
         Tokenize the input and parse it into a Statement object, stripping
         comments, expanding aliases and shortcuts, and extracting output
         redirection directives.
 
+        Results are cached, so parsing the same line again returns the same Statement
+        until aliases, shortcuts, terminators, or multiline_commands change.
+
         :param line: the command line being parsed
         :return: the created Statement
         :raises ValueError if there are unclosed quotation marks
         """
+        return self._cached(line, False)
+
+    def _parse(self, line: str) -> Statement:
+        """Does the work of parse() when the result isn't cached"""
 
         # handle the special case/hardcoded terminator of a blank line
         # we have to do this before we tokenize because tokenizing
@@ -402,7 +763,7 @@ class StatementParser:
         arg_list = []
 
         # lex the input into a list of tokens
-        tokens = self.tokenize(line)
+        tokens = line_tokens = self.tokenize(line)
 
         # of the valid terminators, find the first one to occur in the input
         terminator_pos = len(tokens) + 1
@@ -447,6 +808,9 @@ class StatementParser:
         output = ''
         output_to = ''
 
+        # Check if output should be piped through in-process filters
+        filters, tokens = self._split_filters(line, line_tokens, tokens)
+
         # Find which redirector character appears first in the command
         try:
             pipe_index = tokens.index(constants.REDIRECTION_PIPE)
@@ -512,16 +876,17 @@ class StatementParser:
             multiline_command = ''
 
         # build the statement
-        statement = Statement(args,
-                              raw=line,
-                              command=command,
-                              arg_list=arg_list,
-                              multiline_command=multiline_command,
-                              terminator=terminator,
-                              suffix=suffix,
-                              pipe_to=pipe_to,
-                              output=output,
-                              output_to=output_to)
+        statement = Statement._create(args,
+                                      raw=line,
+                                      command=command,
+                                      arg_list=arg_list,
+                                      multiline_command=multiline_command,
+                                      terminator=terminator,
+                                      suffix=suffix,
+                                      filters=filters,
+                                      pipe_to=pipe_to,
+                                      output=output,
+                                      output_to=output_to)
         return statement
 
     def parse_command_only(self, rawinput: str) -> Statement:
@@ -548,9 +913,15 @@ class StatementParser:
         within args. However, it does ensure args has no leading or trailing
         whitespace.
 
+        Results are cached the same way they are in parse().
+
         :param rawinput: the command line as entered by the user
         :return: the created Statement
         """
+        return self._cached(rawinput, True)
+
+    def _parse_command_only(self, rawinput: str) -> Statement:
+        """Does the work of parse_command_only() when the result isn't cached"""
         line = rawinput
 
         # expand shortcuts and aliases
@@ -580,10 +951,10 @@ class StatementParser:
             multiline_command = ''
 
         # build the statement
-        statement = Statement(args,
-                              raw=rawinput,
-                              command=command,
-                              multiline_command=multiline_command)
+        statement = Statement._create(args,
+                                      raw=rawinput,
+                                      command=command,
+                                      multiline_command=multiline_command)
         return statement
 
     def get_command_arg_list(self, command_name: str, to_parse: Union[Statement, str],
@@ -610,47 +981,175 @@ class StatementParser:
         if not isinstance(to_parse, Statement):
             to_parse = self.parse(command_name + ' ' + to_parse)
 
+        # Return a copy of arg_list since Statements can be shared through the parse cache
         if preserve_quotes:
-            return to_parse, to_parse.arg_list
+            return to_parse, list(to_parse.arg_list)
         else:
             return to_parse, to_parse.argv[1:]
 
+    def _alias_expansion(self, alias: str) -> Optional[str]:
+        """Get the fully expanded prefix of an alias.
+
+        Expanding an alias replaces it with its value. If the first word of that value is another alias which
+        hasn't been expanded yet, the process repeats. The prefix is everything which ends up in front of the
+        delimiter that followed the alias in the original line. It is computed once and reused until the alias
+        table or the terminators change.
+
+        :param alias: name of the alias being expanded
+        :return: the expanded prefix or None if the expansion depends on the rest of the line because the
+                 final value in the chain is only whitespace
+        """
+        try:
+            return self._alias_expansions[alias]
+        except KeyError:
+            pass
+
+        used_aliases = {alias}
+        value = self.aliases[alias]
+        tail = ''
+
+        while True:
+            match = self._command_pattern.search(value)
+            command = match.group(1)
+
+            # A value which is only whitespace has no command of its own
+            if not command and not match.group(2):
+                expansion = None
+                break
+
+            if command in self.aliases and command not in used_aliases:
+                # Everything from the delimiter following the nested alias onward stays in the line
+                tail = value[match.start(2):] + tail
+                used_aliases.add(command)
+                value = self.aliases[command]
+            else:
+                expansion = value + tail
+                break
+
+        self._alias_expansions[alias] = expansion
+        return expansion
+
+    def _aliases_changed(self) -> None:
+        """Called when the alias table changes"""
+        self._alias_expansions.clear()
+        self._invalidate()
+
     def _expand(self, line: str) -> str:
         """Expand aliases and shortcuts"""
+        match = self._command_pattern.search(line)
+        if match and match.group(1) in self.aliases:
+            expansion = self._alias_expansion(match.group(1))
+            if expansion is None:
+                line = self._expand_aliases_iteratively(line)
+            else:
+                line = expansion + line[match.start(2):]
+
+        # expand shortcuts
+        shortcut_match = self.match_shortcut(line)
+        if shortcut_match is not None:
+            shortcut, expansion = shortcut_match
 
-        # Make a copy of aliases so we can keep track of what aliases have been resolved to avoid an infinite loop
-        remaining_aliases = list(self.aliases.keys())
-        keep_expanding = bool(remaining_aliases)
+            # If the next character after the shortcut isn't a space, then insert one
+            shortcut_len = len(shortcut)
+            if len(line) == shortcut_len or line[shortcut_len] != ' ':
+                expansion += ' '
 
-        while keep_expanding:
-            keep_expanding = False
+            # Expand the shortcut
+            line = line.replace(shortcut, expansion, 1)
+        return line
 
+    def _expand_aliases_iteratively(self, line: str) -> str:
+        """Expand aliases one at a time. This is only needed when an alias expansion depends on the rest of the line."""
+
+        # Keep track of what aliases have been resolved to avoid an infinite loop
+        used_aliases = set()
+
+        while True:
             # apply our regex to line
             match = self._command_pattern.search(line)
-            if match:
-                # we got a match, extract the command
-                command = match.group(1)
-
-                # Check if this command matches an alias that wasn't already processed
-                if command in remaining_aliases:
-                    # rebuild line with the expanded alias
-                    line = self.aliases[command] + match.group(2) + line[match.end(2):]
-                    remaining_aliases.remove(command)
-                    keep_expanding = bool(remaining_aliases)
+            if not match:
+                break
 
-        # expand shortcuts
-        for (shortcut, expansion) in self.shortcuts:
-            if line.startswith(shortcut):
-                # If the next character after the shortcut isn't a space, then insert one
-                shortcut_len = len(shortcut)
-                if len(line) == shortcut_len or line[shortcut_len] != ' ':
-                    expansion += ' '
-
-                # Expand the shortcut
-                line = line.replace(shortcut, expansion, 1)
+            # Check if this command matches an alias that wasn't already processed
+            command = match.group(1)
+            if command not in self.aliases or command in used_aliases:
                 break
+
+            # rebuild line with the expanded alias
+            line = self.aliases[command] + line[match.start(2):]
+            used_aliases.add(command)
+
         return line
 
+    def _split_filters(self, line: str, line_tokens: List[str], tokens: List[str]) -> Tuple[List[str], List[str]]:
+        """Split the filters started with |> from the tokens which follow the command and its arguments.
+        This only happens if |> comes before any other redirection.
+
+        :param line: the command line being parsed
+        :param line_tokens: all of the tokens of the line
+        :param tokens: the tokens at the end of line_tokens which follow the command and its arguments
+        :return: A tuple containing the command line of each filter and the tokens left to handle like redirection
+        """
+        if constants.REDIRECTION_PIPE not in tokens or constants.REDIRECTION_OUTPUT not in tokens:
+            return [], tokens
+
+        # The tokenizer splits |> in two, so where the tokens start in the line tells if they were adjacent
+        offsets = self._token_offsets(self._expand(line), line_tokens)[len(line_tokens) - len(tokens):]
+        filter_index = self._filter_index(tokens, offsets)
+        if filter_index is None:
+            return [], tokens
+
+        filters = []
+        filter_tokens = tokens[filter_index + 2:]
+        filter_offsets = offsets[filter_index + 2:]
+
+        # Each |> starts another filter and the last one ends where a shell pipe or output redirection begins
+        filter_start = 0
+        while True:
+            filter_end = filter_start
+            while filter_end < len(filter_tokens) and filter_tokens[filter_end] not in _FILTER_END_TOKENS:
+                filter_end += 1
+            filters.append(' '.join(filter_tokens[filter_start:filter_end]))
+
+            if self._filter_index(filter_tokens[filter_end:], filter_offsets[filter_end:]) != 0:
+                break
+            filter_start = filter_end + 2
+
+        # Leave the rest to be handled like redirection of the command
+        return filters, tokens[:filter_index] + filter_tokens[filter_end:]
+
+    @staticmethod
+    def _filter_index(tokens: List[str], offsets: List[int]) -> Optional[int]:
+        """Find where the tokens of |> are if it comes before any other redirection
+
+        :param tokens: the tokens being searched
+        :param offsets: where each of the tokens starts in the line, used to tell |> from | >
+        :return: the index of the | token of |> or None
+        """
+        for index, token in enumerate(tokens):
+            if token in _FILTER_END_TOKENS:
+                if (token == constants.REDIRECTION_PIPE and tokens[index + 1:index + 2] == [constants.REDIRECTION_OUTPUT]
+                        and offsets[index + 1] == offsets[index] + 1):
+                    return index
+                return None
+        return None
+
+    @staticmethod
+    def _token_offsets(line: str, tokens: List[str]) -> List[int]:
+        """Find where each token starts in the line it was split from
+
+        :param line: the line after shortcuts and aliases were expanded
+        :param tokens: the tokens split from line, which appear in it in order with only whitespace between them
+        :return: the index in line of the first character of each token
+        """
+        offsets = []
+        pos = 0
+        for token in tokens:
+            pos = line.index(token, pos)
+            offsets.append(pos)
+            pos += len(token)
+        return offsets
+
     @staticmethod
     def _command_and_args(tokens: List[str]) -> Tuple[str, str]:
         """Given a list of tokens, return a tuple of the command
@@ -730,3 +1229,61 @@ class StatementParser:
                     break
 
         return punctuated_tokens
+
+
+class MultilineLexer:
+    """Track the lines of a multiline command as they are entered to know when the command is complete.
+
+    Each line is tokenized once as it arrives and only its tokens are checked for a terminator. This
+    avoids parsing all of the accumulated input again after every line. Once `complete` is True, the
+    accumulated input can be parsed by `StatementParser.parse()` a single time.
+    """
+    def __init__(self, statement_parser: StatementParser, line: str) -> None:
+        """Initialize an instance of MultilineLexer
+
+        :param statement_parser: the StatementParser which will parse the completed command
+        :param line: the first line of the command. Shortcuts and aliases are expanded.
+        """
+        self._statement_parser = statement_parser
+
+        # Text from the start of an unclosed quotation to the end of the input. It is tokenized
+        # again with the next line since the quotation may be closed there.
+        self._unfinished = ''
+
+        # The first token of the input, which parse() will use as the command
+        self._command = None
+        self._found_terminator = False
+
+        # A line feed at the end of the input is a terminator which tokenizing would discard
+        self._ends_with_line_feed = line[-1:] == constants.LINE_FEED
+        self._scan(statement_parser._expand(line))
+
+    @property
+    def complete(self) -> bool:
+        """True when parse() would no longer treat the input so far as an unterminated multiline command"""
+        if self._unfinished:
+            return False
+        if self._found_terminator or self._ends_with_line_feed:
+            return True
+        return self._command not in self._statement_parser.multiline_commands
+
+    def add_line(self, line: str) -> None:
+        """Add the next line of input. It is joined to the previous input with a line feed.
+
+        :param line: the line being added
+        """
+        self._ends_with_line_feed = not line or line[-1] == constants.LINE_FEED
+        if self._unfinished:
+            line = self._unfinished + constants.LINE_FEED + line
+        self._scan(line)
+
+    def _scan(self, line: str) -> None:
+        """Tokenize a line and look for a terminator in its tokens"""
+        tokens, self._unfinished = self._statement_parser.split_partial_line(line)
+        if tokens and self._command is None:
+            self._command = tokens[0]
+
+        if not self._found_terminator:
+            terminators = self._statement_parser.terminators
+            self._found_terminator = any(token.startswith(terminator)
+                                         for token in tokens for terminator in terminators)
@@ -10,7 +10,7 @@ import subprocess
 import sys
 import threading
 import unicodedata
-from typing import Any, Iterable, List, Optional, TextIO, Union
+from typing import Any, BinaryIO, Iterable, List, Optional, TextIO, Tuple, Union
 
 from . import constants
 
@@ -136,6 +136,106 @@ def which(exe_name: str) -> Optional[str]:
     return exe_path
 
 
+# Characters which make a POSIX shell do more with a command line than split it into words. Between single quotes
+# every character is literal and between double quotes only the ones in _SHELL_DOUBLE_QUOTE_SPECIAL_CHARS are special.
+_SHELL_SPECIAL_CHARS = frozenset('|&;<>()$`\\*?[]{}~#!\n')
+_SHELL_DOUBLE_QUOTE_SPECIAL_CHARS = frozenset('$`\\')
+
+# Words a POSIX shell runs itself or treats as part of its grammar instead of looking for a program
+_SHELL_WORDS = frozenset(['.', ':', '[', '[[', 'alias', 'bg', 'break', 'case', 'cd', 'command', 'continue', 'do',
+                          'done', 'echo', 'elif', 'else', 'esac', 'eval', 'exec', 'exit', 'export', 'false', 'fc',
+                          'fg', 'fi', 'for', 'function', 'getopts', 'hash', 'if', 'in', 'jobs', 'kill', 'local',
+                          'newgrp', 'printf', 'pwd', 'read', 'readonly', 'return', 'select', 'set', 'shift',
+                          'source', 'test', 'then', 'time', 'times', 'trap', 'true', 'type', 'ulimit', 'umask',
+                          'unalias', 'unset', 'until', 'wait', 'while'])
+
+# Full paths of programs found by find_program() keyed by name and PATH
+_program_paths = {}
+
+
+def find_program(name: str, path: Optional[str] = None) -> Optional[str]:
+    """Find the full path of a program the way a shell would, remembering what was found
+
+    Only names without a directory are remembered, since those are the only ones that don't depend on the
+    current working directory.
+
+    :param name: name of the program, ie 'grep' or 'ls'
+    :param path: the directories to search as formatted in PATH. Defaults to the value of PATH.
+    :return: the full path or None if the program was not found
+    """
+    if path is None:
+        path = os.environ.get('PATH', os.defpath)
+
+    if os.sep in name or (os.altsep and os.altsep in name):
+        return shutil.which(name, path=path)
+
+    key = (name, path)
+    try:
+        return _program_paths[key]
+    except KeyError:
+        program_path = _program_paths[key] = shutil.which(name, path=path)
+        return program_path
+
+
+def split_simple_command(command: str) -> Optional[List[str]]:
+    """Split a command line into the program and arguments to run it without a shell, if the shell
+    would do nothing more than split it into words
+
+    :param command: the command line
+    :return: the program and its arguments or None if the command line needs a shell. Command lines with pipes,
+             redirection, variables, wildcards, escapes or shell builtins need one, as does every command on Windows.
+    """
+    if sys.platform.startswith('win'):
+        return None
+
+    quote = None
+    for char in command:
+        if quote is None:
+            if char in _SHELL_SPECIAL_CHARS:
+                return None
+            if char in constants.QUOTES:
+                quote = char
+        elif char == quote:
+            quote = None
+        elif quote == '"' and char in _SHELL_DOUBLE_QUOTE_SPECIAL_CHARS:
+            return None
+
+    import shlex
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        # Unclosed quotes
+        return None
+
+    # Leading words with an = assign variables
+    if not args or args[0] in _SHELL_WORDS or '=' in args[0]:
+        return None
+    return args
+
+
+def popen_shell_command(command: str, **kwargs) -> subprocess.Popen:
+    """Start a command line like subprocess.Popen(command, shell=True) does, but run a program directly instead of
+    starting a shell first when split_simple_command() says the shell isn't needed
+
+    :param command: the command line
+    :param kwargs: any other arguments for subprocess.Popen except shell
+    :return: the process that was started
+    """
+    args = split_simple_command(command)
+    if args is not None:
+        env = kwargs.get('env')
+        program_path = find_program(args[0], None if env is None else env.get('PATH', os.defpath))
+        if program_path is not None:
+            try:
+                return subprocess.Popen(args, executable=program_path, **kwargs)
+            except OSError:
+                # The program may have been removed or may be a script the shell has to run. Forget the
+                # paths found so far and let the shell run the command or report what's wrong.
+                _program_paths.clear()
+
+    return subprocess.Popen(command, shell=True, **kwargs)
+
+
 def is_text_file(file_path: str) -> bool:
     """Returns if a file contains only ASCII or UTF-8 encoded text.
 
@@ -491,7 +591,15 @@ class ProcReader(object):
     """
     Used to capture stdout and stderr from a Popen process if any of those were set to subprocess.PIPE.
     If neither are pipes, then the process will run normally and no output will be captured.
+
+    One thread waits on both pipes with a selector and copies whatever can be read, up to READ_SIZE bytes at
+    a time, to the matching stream. Since the thread blocks while waiting for output and while writing it,
+    a slow consumer of the output slows the process down instead of output piling up in memory. On Windows,
+    where pipes can't be used with selectors, each pipe gets its own thread which blocks on reads.
     """
+    # The most bytes read from a pipe at once
+    READ_SIZE = 64 * 1024
+
     def __init__(self, proc: subprocess.Popen, stdout: Union[StdSim, TextIO],
                  stderr: Union[StdSim, TextIO]) -> None:
         """
@@ -504,17 +612,24 @@ class ProcReader(object):
         self._stdout = stdout
         self._stderr = stderr
 
-        self._out_thread = threading.Thread(name='out_thread', target=self._reader_thread_func,
-                                            kwargs={'read_stdout': True})
-
-        self._err_thread = threading.Thread(name='out_thread', target=self._reader_thread_func,
-                                            kwargs={'read_stdout': False})
-
-        # Start the reader threads for pipes only
+        # Map each pipe being read to the stream its output is written to
+        pipes = []
         if self._proc.stdout is not None:
-            self._out_thread.start()
+            pipes.append((self._proc.stdout, self._stdout))
         if self._proc.stderr is not None:
-            self._err_thread.start()
+            pipes.append((self._proc.stderr, self._stderr))
+
+        # Start the reader threads for pipes only
+        if sys.platform.startswith('win'):
+            self._threads = [threading.Thread(name='proc_reader', target=self._reader_thread_func, args=[[pipe]])
+                             for pipe in pipes]
+        elif pipes:
+            self._threads = [threading.Thread(name='proc_reader', target=self._reader_thread_func, args=[pipes])]
+        else:
+            self._threads = []
+
+        for thread in self._threads:
+            thread.start()
 
     def send_sigint(self) -> None:
         """Send a SIGINT to the process similar to if <Ctrl>+C were pressed."""
@@ -529,44 +644,48 @@ class ProcReader(object):
         """Terminate the process"""
         self._proc.terminate()
 
-    def wait(self) -> None:
-        """Wait for the process to finish"""
-        if self._out_thread.is_alive():
-            self._out_thread.join()
-        if self._err_thread.is_alive():
-            self._err_thread.join()
+    def wait(self) -> int:
+        """Wait for the process to finish
 
-        # Handle case where the process ended before the last read could be done.
-        # This will return None for the streams that weren't pipes.
-        out, err = self._proc.communicate()
+        :return: the exit code of the process
+        """
+        # The reader threads finish once they have read all of the output
+        for thread in self._threads:
+            if thread.is_alive():
+                thread.join()
 
-        if out:
-            self._write_bytes(self._stdout, out)
-        if err:
-            self._write_bytes(self._stderr, err)
+        return self._proc.wait()
 
-    def _reader_thread_func(self, read_stdout: bool) -> None:
+    def _reader_thread_func(self, pipes: List[Tuple[BinaryIO, Union[StdSim, TextIO]]]) -> None:
         """
-        Thread function that reads a stream from the process
-        :param read_stdout: if True, then this thread deals with stdout. Otherwise it deals with stderr.
+        Thread function that reads pipes from the process until they are closed
+        :param pipes: tuples of a pipe and the stream its output is written to
         """
-        if read_stdout:
-            read_stream = self._proc.stdout
-            write_stream = self._stdout
-        else:
-            read_stream = self._proc.stderr
-            write_stream = self._stderr
-
-        # The thread should have been started only if this stream was a pipe
-        assert read_stream is not None
-
-        # Run until process completes
-        while self._proc.poll() is None:
-            # noinspection PyUnresolvedReferences
-            available = read_stream.peek()
-            if available:
-                read_stream.read(len(available))
-                self._write_bytes(write_stream, available)
+        if len(pipes) == 1:
+            # Blocking reads work the same as waiting with a selector when there is only one pipe
+            read_stream, write_stream = pipes[0]
+            fd = read_stream.fileno()
+            while True:
+                data = os.read(fd, self.READ_SIZE)
+                if not data:
+                    break
+                self._write_bytes(write_stream, data)
+            read_stream.close()
+            return
+
+        import selectors
+        with selectors.DefaultSelector() as selector:
+            for read_stream, write_stream in pipes:
+                selector.register(read_stream, selectors.EVENT_READ, write_stream)
+
+            while selector.get_map():
+                for key, _ in selector.select():
+                    data = os.read(key.fd, self.READ_SIZE)
+                    if data:
+                        self._write_bytes(key.data, data)
+                    else:
+                        selector.unregister(key.fileobj)
+                        key.fileobj.close()
 
     @staticmethod
     def _write_bytes(stream: Union[StdSim, TextIO], to_write: bytes) -> None:
@@ -622,6 +741,12 @@ class RedirectionSavedState(object):
         # If the command created a process to pipe to, then then is its reader
         self.pipe_proc_reader = None
 
+        # Whether the program of a pipe command without shell syntax couldn't be found, so the shell ran it instead
+        self.pipe_program_missing = False
+
+        # If the command's output is piped through in-process filters, then this is their FilterPipeline
+        self.pipe_filter = None
+
 
 # noinspection PyUnusedLocal
 def basic_complete(text: str, line: str, begidx: int, endidx: int, match_against: Iterable) -> List[str]:
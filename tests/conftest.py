@@ -44,8 +44,10 @@ def verify_help_text(cmd2_app: cmd2.Cmd, help_output: Union[str, List[str]]) ->
 
 
 # Help text for the history command
-HELP_HISTORY = """Usage: history [-h] [-r | -e | -o FILE | -t TRANSCRIPT_FILE | -c] [-s] [-x]
-               [-v] [-a]
+HELP_HISTORY = """Usage: history [-h] [-r | -e | -o FILE | -t TRANSCRIPT_FILE | -c] [-b] [-s]
+               [-x] [-v] [-a] [-T] [--since TIME] [--until TIME]
+               [--slower-than SECONDS] [--failed] [--sort {elapsed, cpu}]
+               [--limit N]
                [arg]
 
 View, run, edit, save, or clear previously entered commands
@@ -67,6 +69,8 @@ optional arguments:
                         output commands and results to a transcript file,
                         implies -s
   -c, --clear           clear all history
+  -b, --batch           run the items selected with -r or -e in batch mode,
+                        see the -b option of run_script
 
 formatting:
   -s, --script          output commands in script format, i.e. without command
@@ -77,6 +81,21 @@ formatting:
                         differ from the typed command
   -a, --all             display all commands, including ones persisted from
                         previous sessions
+  -T, --timing          display when each command started, its elapsed and CPU
+                        time, and whether it succeeded
+
+filtering and sorting by how commands ran:
+  --since TIME          only commands started at or after TIME, which is a
+                        date like 2019-10-30, a date and time like
+                        "2019-10-30 14:00", or an age like 90s, 30m, 12h, 7d
+                        or 2w
+  --until TIME          only commands started before TIME
+  --slower-than SECONDS
+                        only commands which took at least SECONDS
+  --failed              only commands which raised an exception
+  --sort {elapsed, cpu}
+                        sort by elapsed or CPU time, slowest first
+  --limit N             only the first N commands after filtering and sorting
 """
 
 # Output from the shortcuts command with default built-in shortcuts
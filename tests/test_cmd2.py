@@ -236,6 +236,8 @@ You changed quiet
 
 def test_base_shell(base_app, monkeypatch):
     m = mock.Mock()
+    # The fake process has no pipes to read output from
+    m.return_value.stdout = m.return_value.stderr = None
     monkeypatch.setattr("{}.Popen".format('subprocess'), m)
     out, err = run_cmd(base_app, 'shell echo a')
     assert out == []
@@ -404,6 +406,125 @@ set allow_ansi Never""" % (prefilepath, postfilepath)
     out, err = run_cmd(base_app, 'history -s')
     assert out == normalize(expected)
 
+@pytest.fixture
+def say_app(base_app):
+    base_app.do_say = lambda statement: base_app.poutput(statement)
+    return base_app
+
+def _open_count(open_mock, filename):
+    return len([call for call in open_mock.call_args_list if call[0][0] == filename])
+
+def test_runcmds_plus_hooks_batch_reuses_output(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    with mock.patch('builtins.open', wraps=open) as open_mock:
+        say_app.runcmds_plus_hooks(['say one >> {}'.format(filename),
+                                    'say two >> {}'.format(filename),
+                                    'say three >> {}'.format(filename)], batch=True)
+    assert _open_count(open_mock, filename) == 1
+    assert say_app._batch_output is None
+    assert not say_app._in_batch
+    with open(filename) as f:
+        assert f.read() == 'one\ntwo\nthree\n'
+
+def test_runcmds_plus_hooks_batch_overwrite(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    with mock.patch('builtins.open', wraps=open) as open_mock:
+        say_app.runcmds_plus_hooks(['say first line > {}'.format(filename),
+                                    'say second > {}'.format(filename)], batch=True)
+    assert _open_count(open_mock, filename) == 1
+    with open(filename) as f:
+        assert f.read() == 'second\n'
+
+def test_runcmds_plus_hooks_batch_different_output(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    other = os.path.join(str(tmpdir), 'other.txt')
+    with mock.patch('builtins.open', wraps=open) as open_mock:
+        say_app.runcmds_plus_hooks(['say one >> {}'.format(filename),
+                                    'say two',
+                                    'say three >> {}'.format(filename),
+                                    'say four > {}'.format(filename),
+                                    'say five >> {}'.format(other),
+                                    'say six >> {}'.format(filename)], batch=True)
+
+    # Output is only reused by the next command if it redirects the same way
+    assert _open_count(open_mock, filename) == 4
+    with open(filename) as f:
+        assert f.read() == 'four\nsix\n'
+    with open(other) as f:
+        assert f.read() == 'five\n'
+
+def test_runcmds_plus_hooks_batch_output_file_replaced(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    say_app.do_remove = lambda _: os.remove(filename)
+    say_app.runcmds_plus_hooks(['say one >> {}'.format(filename),
+                                'remove >> {}'.format(filename),
+                                'say two >> {}'.format(filename)], batch=True)
+    with open(filename) as f:
+        assert f.read() == 'two\n'
+
+def test_runcmds_plus_hooks_batch_nested(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    script = os.path.join(str(tmpdir), 'script.txt')
+    with open(script, 'w') as f:
+        f.write('say two >> {}\nsay three >> {}\n'.format(filename, filename))
+
+    say_app.runcmds_plus_hooks(['say one >> {}'.format(filename),
+                                'run_script {}'.format(script),
+                                'say four >> {}'.format(filename)], batch=True)
+    with open(filename) as f:
+        assert f.read() == 'one\ntwo\nthree\nfour\n'
+
+def test_run_script_not_batch(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    script = os.path.join(str(tmpdir), 'script.txt')
+    with open(script, 'w') as f:
+        f.write('say one >> {}\nsay two >> {}\n'.format(filename, filename))
+
+    say_app._terminal_state = (1, [])
+    with mock.patch('builtins.open', wraps=open) as open_mock, \
+            mock.patch.object(say_app, '_restore_terminal_state') as restore_mock:
+        run_cmd(say_app, 'run_script {}'.format(script))
+    say_app._terminal_state = None
+
+    # Each command opens the file and restores the terminal itself
+    assert _open_count(open_mock, filename) == 2
+    assert restore_mock.call_count == 3
+    with open(filename) as f:
+        assert f.read() == 'one\ntwo\n'
+
+def test_run_script_batch(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    script = os.path.join(str(tmpdir), 'script.txt')
+    with open(script, 'w') as f:
+        f.write('say one >> {}\nsay two >> {}\n'.format(filename, filename))
+
+    with mock.patch('builtins.open', wraps=open) as open_mock:
+        run_cmd(say_app, 'run_script --batch {}'.format(script))
+    assert _open_count(open_mock, filename) == 1
+    assert not say_app._in_batch
+    with open(filename) as f:
+        assert f.read() == 'one\ntwo\n'
+
+def test_runcmds_plus_hooks_batch_stop(say_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    stop = say_app.runcmds_plus_hooks(['say one >> {}'.format(filename), 'quit', 'say two'], batch=True)
+    assert stop
+    assert say_app._batch_output is None
+    assert not say_app._in_batch
+    with open(filename) as f:
+        assert f.read() == 'one\n'
+
+def test_runcmds_plus_hooks_batch_terminal_restored_once(say_app):
+    say_app._terminal_state = (1, [])
+    with mock.patch.object(say_app, '_restore_terminal_state') as restore_mock:
+        say_app.runcmds_plus_hooks(['say one', 'say two'], batch=True)
+    restore_mock.assert_called_once_with()
+
+    with mock.patch.object(say_app, '_restore_terminal_state') as restore_mock:
+        say_app.runcmds_plus_hooks(['say one', 'say two'])
+    assert restore_mock.call_count == 2
+    say_app._terminal_state = None
+
 def test_relative_run_script(base_app, request):
     test_dir = os.path.dirname(request.module.__file__)
     filename = os.path.join(test_dir, 'script.txt')
@@ -622,7 +743,30 @@ def test_pipe_to_shell_error(base_app):
     # Try to pipe command output to a shell command that doesn't exist in order to produce an error
     out, err = run_cmd(base_app, 'help | foobarbaz.this_does_not_exist')
     assert not out
-    assert "Pipe process exited with code" in err[0]
+    assert "Pipe process exited with code" in err[-1]
+
+def test_pipe_to_shell_nonzero_exit_not_an_error(base_app):
+    # Exit codes of a program that ran are not reported, even ones the shell uses for a command it couldn't run
+    for code in (1, 126, 127):
+        command = 'help | {} -c "import sys; sys.stdin.read(); sys.exit({})"'.format(sys.executable, code)
+        out, err = run_cmd(base_app, command)
+        assert not out and not err
+
+def test_pipe_to_shell_does_not_wait_for_pipe_process(base_app, monkeypatch):
+    import subprocess
+    timeouts = []
+    real_wait = subprocess.Popen.wait
+
+    def wait(proc, timeout=None):
+        timeouts.append(timeout)
+        return real_wait(proc, timeout)
+
+    monkeypatch.setattr(subprocess.Popen, 'wait', wait)
+    out, err = run_cmd(base_app, 'help | {} -c "import sys; sys.stdin.read()"'.format(sys.executable))
+    assert not err
+
+    # The only wait is the one without a timeout done once the command has finished
+    assert timeouts == [None]
 
 @pytest.mark.skipif(not clipboard.can_clip,
                     reason="Pyperclip could not find a copy/paste mechanism for your system")
@@ -705,6 +849,7 @@ def test_edit_file(base_app, request, monkeypatch):
 
     # Mock out the subprocess.Popen call so we don't actually open an editor
     m = mock.MagicMock(name='Popen')
+    m.return_value.stdout = m.return_value.stderr = None
     monkeypatch.setattr("subprocess.Popen", m)
 
     test_dir = os.path.dirname(request.module.__file__)
@@ -751,6 +896,7 @@ def test_edit_file_with_spaces(base_app, request, monkeypatch):
 
     # Mock out the subprocess.Popen call so we don't actually open an editor
     m = mock.MagicMock(name='Popen')
+    m.return_value.stdout = m.return_value.stderr = None
     monkeypatch.setattr("subprocess.Popen", m)
 
     test_dir = os.path.dirname(request.module.__file__)
@@ -767,6 +913,7 @@ def test_edit_blank(base_app, monkeypatch):
 
     # Mock out the subprocess.Popen call so we don't actually open an editor
     m = mock.MagicMock(name='Popen')
+    m.return_value.stdout = m.return_value.stderr = None
     monkeypatch.setattr("subprocess.Popen", m)
 
     run_cmd(base_app, 'edit')
@@ -847,6 +994,65 @@ def test_cmdloop_without_rawinput():
     out = app.stdout.getvalue()
     assert out == expected
 
+@pytest.fixture
+def tty_app():
+    pty = pytest.importorskip('pty')
+    termios = pytest.importorskip('termios')
+    master, slave = pty.openpty()
+    app = cmd2.Cmd()
+    app.stdout = open(slave, 'w')
+    yield app, termios, slave
+    app.stdout.close()
+    os.close(master)
+
+def test_terminal_state_restored_after_command(tty_app):
+    app, termios, fd = tty_app
+    app._save_terminal_state()
+    saved_attrs = termios.tcgetattr(fd)
+
+    # Have a command turn off echo like a program that exited without cleaning up
+    def do_noecho(_):
+        attrs = termios.tcgetattr(fd)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+    app.do_noecho = do_noecho
+    app.onecmd_plus_hooks('noecho')
+    assert termios.tcgetattr(fd) == saved_attrs
+
+def test_terminal_state_restored_outside_cmdloop(tty_app):
+    app, termios, fd = tty_app
+    saved_attrs = termios.tcgetattr(fd)
+
+    def do_noecho(_):
+        attrs = termios.tcgetattr(fd)
+        attrs[3] &= ~termios.ECHO
+        termios.tcsetattr(fd, termios.TCSANOW, attrs)
+
+    # No state was saved by cmdloop(), so the command saves and restores it itself
+    app.do_noecho = do_noecho
+    app.onecmd_plus_hooks('noecho')
+    assert termios.tcgetattr(fd) == saved_attrs
+    assert app._terminal_state is None
+
+    app.runcmds_plus_hooks(['noecho', 'noecho'], batch=True)
+    assert termios.tcgetattr(fd) == saved_attrs
+    assert app._terminal_state is None
+
+def test_terminal_state_unchanged_not_set(tty_app):
+    app, termios, fd = tty_app
+    app._save_terminal_state()
+    with mock.patch('termios.tcsetattr') as m:
+        app.onecmd_plus_hooks('help')
+    m.assert_not_called()
+
+def test_terminal_state_not_saved_without_tty(base_app):
+    base_app._save_terminal_state()
+    assert base_app._terminal_state is None
+    with mock.patch('subprocess.Popen') as m:
+        base_app.onecmd_plus_hooks('help')
+    m.assert_not_called()
+
 class HookFailureApp(cmd2.Cmd):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -934,6 +1140,7 @@ def test_default_to_shell(base_app, monkeypatch):
 
     base_app.default_to_shell = True
     m = mock.Mock()
+    m.return_value.stdout = m.return_value.stderr = None
     monkeypatch.setattr("{}.Popen".format('subprocess'), m)
     out, err = run_cmd(base_app, line)
     assert out == []
@@ -1325,6 +1532,31 @@ def test_multiline_complete_statement_with_unclosed_quotes(multiline_app):
     assert statement.multiline_command == 'orate'
     assert statement.terminator == ';'
 
+def test_multiline_complete_statement_parses_once_complete(multiline_app, mocker):
+    # The accumulated input should not be parsed again after every continuation line
+    lines = ['line {}'.format(i) for i in range(50)]
+    lines.append('done;')
+    m = mock.MagicMock(name='input', side_effect=lines)
+    builtins.input = m
+    parse_spy = mocker.spy(multiline_app.statement_parser, '_parse')
+
+    statement = multiline_app._complete_statement('orate start')
+    assert statement.command == 'orate'
+    assert statement.terminator == ';'
+    assert statement.arg_list[-1] == 'done'
+    assert len(statement.arg_list) == 1 + 2 * 50 + 1
+    assert parse_spy.call_count == 2
+
+def test_multiline_complete_statement_quoted_terminator(multiline_app):
+    # Terminators in a quotation which spans lines don't end the command
+    m = mock.MagicMock(name='input', side_effect=['still; quoted', 'closed" now;'])
+    builtins.input = m
+
+    statement = multiline_app._complete_statement('orate "open')
+    assert statement == '"open\nstill; quoted\nclosed" now'
+    assert statement.terminator == ';'
+    assert m.call_count == 2
+
 def test_multiline_input_line_to_statement(multiline_app):
     # Verify _input_line_to_statement saves the fully entered input line for multiline commands
 
@@ -1795,6 +2027,14 @@ def test_macro_create_with_escaped_args(base_app):
     out, err = run_cmd(base_app, 'fake')
     assert err[0].startswith('No help on {1}')
 
+def test_macro_resolve_with_mixed_args(base_app):
+    run_cmd(base_app, 'macro create fake !echo {1} {{1}} {2} {1}')
+    macro = base_app.macros['fake']
+    assert macro.template == ('!echo ', 1, ' {1} ', 2, ' ', 1, '')
+
+    statement = base_app.statement_parser.parse('fake one "two words" extra > out.txt')
+    assert base_app._resolve_macro(statement) == '!echo one {1} two words one extra > out.txt'
+
 def test_macro_usage_with_missing_args(base_app):
     # Create the macro
     out, err = run_cmd(base_app, 'macro create fake help {1} {2}')
@@ -1894,6 +2134,127 @@ def test_nonexistent_macro(base_app):
 
     assert exception is not None
 
+def test_profile_no_subcommand(base_app):
+    out, err = run_cmd(base_app, 'profile')
+    assert "Usage: profile [-h]" in err[0]
+
+def test_profile_run(base_app):
+    out, err = run_cmd(base_app, 'profile run shortcuts')
+    assert 'Shortcuts for other commands:' in out
+    assert not err
+    assert list(base_app._profile_stats) == ['shortcuts']
+    assert base_app._profile_runs['shortcuts'] == 1
+    assert not base_app._profiling
+
+    # Only the profile command is added to history
+    assert [item.raw for item in base_app.history] == ['profile run shortcuts']
+
+def test_profile_run_quoted_redirection(base_app, request):
+    test_dir = os.path.dirname(request.module.__file__)
+    filename = os.path.join(test_dir, 'profile_run_out.txt')
+    try:
+        out, err = run_cmd(base_app, 'profile run shortcuts ">" {}'.format(filename))
+        assert not out
+        with open(filename) as f:
+            assert 'Shortcuts for other commands:' in f.read()
+    finally:
+        os.remove(filename)
+    assert base_app._profile_runs['shortcuts'] == 1
+
+def test_unquoting_keeps_redirection_tokens(base_app):
+    tokens = list(constants.REDIRECTION_TOKENS)
+    run_cmd(base_app, 'alias create fake help ">"')
+    run_cmd(base_app, 'macro create fake_macro help ">"')
+    run_cmd(base_app, 'profile run shortcuts')
+    assert constants.REDIRECTION_TOKENS == tokens
+
+def test_profile_on_off(base_app):
+    out, err = run_cmd(base_app, 'profile on')
+    assert out == ['Profiling enabled']
+    run_cmd(base_app, 'shortcuts')
+    run_cmd(base_app, 'shortcuts')
+    run_cmd(base_app, 'alias list')
+    out, err = run_cmd(base_app, 'profile off')
+    assert out == ['Profiling disabled']
+    run_cmd(base_app, 'shortcuts')
+
+    # The profile command itself is never profiled
+    assert base_app._profile_runs == {'shortcuts': 2, 'alias': 1}
+
+def test_profile_nested_commands(base_app, request):
+    test_dir = os.path.dirname(request.module.__file__)
+    filename = os.path.join(test_dir, 'script.txt')
+    run_cmd(base_app, 'profile on')
+    run_cmd(base_app, 'run_script {}'.format(filename))
+
+    # Commands run by the script are part of the profile of run_script
+    assert list(base_app._profile_stats) == ['run_script']
+
+def test_profile_report(base_app):
+    out, err = run_cmd(base_app, 'profile report')
+    assert out == ['No commands have been profiled']
+
+    run_cmd(base_app, 'profile run shortcuts')
+    run_cmd(base_app, 'profile run shortcuts')
+    run_cmd(base_app, 'profile run alias list')
+    out, err = run_cmd(base_app, 'profile report -n 3 -s tottime')
+    assert not err
+    assert out[0] == 'Profile of alias (1 run)'
+    assert '   Ordered by: internal time' in out
+    assert 'Profile of shortcuts (2 runs)' in out
+    assert 'due to restriction <3>' in '\n'.join(out)
+
+    out, err = run_cmd(base_app, 'profile report shortcuts fake')
+    assert out[0] == 'Profile of shortcuts (2 runs)'
+    assert 'Profile of alias (1 run)' not in out
+    assert err == ["No profile stats for command 'fake'"]
+
+def test_profile_report_redirect(base_app, request):
+    test_dir = os.path.dirname(request.module.__file__)
+    filename = os.path.join(test_dir, 'profile_report.txt')
+    run_cmd(base_app, 'profile run shortcuts')
+    try:
+        out, err = run_cmd(base_app, 'profile report > {}'.format(filename))
+        assert not out
+        with open(filename) as f:
+            assert f.readline() == 'Profile of shortcuts (1 run)\n'
+    finally:
+        os.remove(filename)
+
+def test_profile_dump(base_app, tmpdir):
+    import pstats
+    run_cmd(base_app, 'profile run shortcuts')
+    run_cmd(base_app, 'profile run alias list')
+
+    directory = os.path.join(str(tmpdir), 'stats')
+    out, err = run_cmd(base_app, 'profile dump {} shortcuts'.format(directory))
+    filename = os.path.join(directory, 'shortcuts.prof')
+    assert out == ['Profile of shortcuts saved to {}'.format(filename)]
+    assert os.listdir(directory) == ['shortcuts.prof']
+    assert pstats.Stats(filename).total_calls > 0
+
+    run_cmd(base_app, 'profile dump {}'.format(directory))
+    assert sorted(os.listdir(directory)) == ['alias.prof', 'shortcuts.prof']
+
+def test_profile_dump_error(base_app, tmpdir):
+    run_cmd(base_app, 'profile run shortcuts')
+    filename = os.path.join(str(tmpdir), 'file')
+    open(filename, 'w').close()
+    out, err = run_cmd(base_app, 'profile dump {}'.format(filename))
+    assert err[0].startswith('Failed to save profile stats')
+
+def test_profile_clear(base_app):
+    run_cmd(base_app, 'profile run shortcuts')
+    run_cmd(base_app, 'profile run alias list')
+    out, err = run_cmd(base_app, 'profile clear alias')
+    assert out == ["Profile stats for 'alias' deleted"]
+    assert list(base_app._profile_stats) == ['shortcuts']
+
+    out, err = run_cmd(base_app, 'profile clear')
+    assert out == ['All profile stats deleted']
+    assert not base_app._profile_stats
+    assert not base_app._profile_runs
+
 def test_ppaged(outsim_app):
     msg = 'testing...'
     end = '\n'
@@ -1972,8 +2333,9 @@ def test_onecmd_add_to_history(outsim_app):
 def test_get_all_commands(base_app):
     # Verify that the base app has the expected commands
     commands = base_app.get_all_commands()
-    expected_commands = ['_relative_run_script', 'alias', 'edit', 'eof', 'help', 'history', 'macro',
-                         'py', 'quit', 'run_pyscript', 'run_script', 'set', 'shell', 'shortcuts']
+    expected_commands = ['_relative_run_script', 'alias', 'edit', 'eof', 'help', 'history', 'macro', 'profile',
+                         'py', 'quit', 'run_pyscript', 'run_script', 'set', 'shell', 'shortcuts',
+                         'stats']
     assert commands == expected_commands
 
 def test_get_help_topics(base_app):
@@ -1999,6 +2361,87 @@ def test_get_help_topics_hidden():
     app.hidden_commands.append('my_cmd')
     assert 'my_cmd' not in app.get_help_topics()
 
+def test_commands_added_to_instance(base_app):
+    base_app.do_added = lambda _: None
+    base_app.help_added = lambda: None
+    assert 'added' in base_app.get_all_commands()
+    assert base_app.get_help_topics() == ['added']
+    out, err = run_cmd(base_app, 'added')
+    assert not err
+
+    # Attributes which aren't callable hide commands
+    base_app.do_shortcuts = None
+    assert 'shortcuts' not in base_app.get_all_commands()
+
+    del base_app.do_added
+    del base_app.help_added
+    del base_app.do_shortcuts
+    assert 'added' not in base_app.get_all_commands()
+    assert 'shortcuts' in base_app.get_all_commands()
+    assert base_app.get_help_topics() == []
+
+def test_commands_added_to_class():
+    class TestApp(cmd2.Cmd):
+        pass
+
+    app = TestApp()
+    assert 'added' not in app.get_all_commands()
+
+    TestApp.do_added = lambda self, _: None
+    assert 'added' in app.get_all_commands()
+    assert app._is_command('added')
+
+    del TestApp.do_added
+    assert 'added' not in app.get_all_commands()
+    assert not app._is_command('added')
+
+def test_commands_replaced_in_class():
+    class TestApp(cmd2.Cmd):
+        def do_foo(self, _):
+            pass
+
+        def help_foo(self):
+            pass
+
+    app = TestApp()
+    assert 'foo' in app.get_all_commands()
+
+    # Changes which keep the size of the namespace the same
+    TestApp.do_foo = None
+    assert 'foo' not in app.get_all_commands()
+    assert not app._is_command('foo')
+
+    TestApp.do_foo = lambda self, _: self.poutput('replaced')
+    assert 'foo' in app.get_all_commands()
+    out, err = run_cmd(app, 'foo')
+    assert out == ['replaced']
+
+    TestApp.help_foo = 'not callable'
+    assert 'foo' not in app.get_help_topics()
+
+def test_commands_replaced_in_instance(base_app):
+    base_app.do_added = lambda _: None
+    assert 'added' in base_app.get_all_commands()
+    base_app.do_added = None
+    assert 'added' not in base_app.get_all_commands()
+    base_app.__dict__['do_added'] = lambda _: None
+    assert 'added' in base_app.get_all_commands()
+
+def test_get_all_commands_returns_copy(base_app):
+    commands = base_app.get_all_commands()
+    commands.append('fake')
+    assert 'fake' not in base_app.get_all_commands()
+
+def test_get_names_override():
+    class TestApp(cmd2.Cmd):
+        def get_names(self):
+            return [name for name in super().get_names() if name != 'do_shortcuts']
+
+    app = TestApp()
+    assert 'shortcuts' not in app.get_all_commands()
+    assert not app._is_command('shortcuts')
+    assert 'help' in app.get_all_commands()
+
 class ReplWithExitCode(cmd2.Cmd):
     """ Example cmd2 application where we can specify an exit code when existing."""
 
@@ -0,0 +1,175 @@
+# coding=utf-8
+# flake8: noqa E302
+"""
+Test running shell commands in a long-running shell
+"""
+import io
+import os
+import sys
+
+import pytest
+
+from cmd2.coprocess import ShellCoprocess
+from cmd2.utils import StdSim
+from .conftest import run_cmd
+
+pytestmark = pytest.mark.skipif(sys.platform.startswith('win'), reason="Requires a POSIX shell")
+
+
+@pytest.fixture
+def coprocess():
+    shell = ShellCoprocess()
+    yield shell
+    shell.close()
+
+@pytest.fixture
+def outputs():
+    return StdSim(io.StringIO()), StdSim(io.StringIO())
+
+
+def test_coprocess_run(coprocess, outputs):
+    stdout, stderr = outputs
+    assert not coprocess.running
+    assert coprocess.run('echo out; echo err >&2', stdout, stderr) == 0
+    assert stdout.getvalue() == 'out\n'
+    assert stderr.getvalue() == 'err\n'
+    assert coprocess.running
+
+def test_coprocess_reuses_shell(coprocess, outputs):
+    stdout, stderr = outputs
+    coprocess.run('true', stdout, stderr)
+    pid = coprocess.pid
+    coprocess.run('true', stdout, stderr)
+    assert coprocess.pid == pid
+
+def test_coprocess_exit_code(coprocess, outputs):
+    stdout, stderr = outputs
+    assert coprocess.run('echo before; exit 3', stdout, stderr) == 3
+    assert stdout.getvalue() == 'before\n'
+
+    # exit only ends the subshell the command ran in
+    assert coprocess.running
+    assert coprocess.run('foobarbaz.this_does_not_exist', stdout, stderr) == 127
+
+def test_coprocess_syntax_error(coprocess, outputs):
+    stdout, stderr = outputs
+    assert coprocess.run('if', stdout, stderr) != 0
+    assert stderr.getvalue()
+    assert coprocess.run('echo ok', stdout, stderr) == 0
+    assert stdout.getvalue() == 'ok\n'
+
+def test_coprocess_output_without_newline(coprocess, outputs):
+    stdout, stderr = outputs
+    coprocess.run('printf abc', stdout, stderr)
+    coprocess.run('printf def', stdout, stderr)
+    assert stdout.getvalue() == 'abcdef'
+    assert stderr.getvalue() == ''
+
+def test_coprocess_large_output(coprocess, outputs):
+    stdout, stderr = outputs
+    code = "import sys; sys.stdout.write('x' * {})".format(ShellCoprocess.READ_SIZE * 3 + 7)
+    assert coprocess.run('"{}" -c "{}"'.format(sys.executable, code), stdout, stderr) == 0
+    assert len(stdout.getbytes()) == ShellCoprocess.READ_SIZE * 3 + 7
+
+def test_coprocess_state_not_kept(coprocess, outputs, tmpdir, monkeypatch):
+    stdout, stderr = outputs
+    coprocess.run('cd /; FOO=bar', stdout, stderr)
+    coprocess.run('pwd; echo "[$FOO]"', stdout, stderr)
+    assert stdout.getvalue() == '{}\n[]\n'.format(os.getcwd())
+
+    # Commands run in the current working directory of this process
+    stdout.clear()
+    monkeypatch.chdir(str(tmpdir))
+    coprocess.run('pwd', stdout, stderr)
+    assert os.path.samefile(stdout.getvalue().strip(), str(tmpdir))
+
+def test_coprocess_environment_change(coprocess, outputs, monkeypatch):
+    stdout, stderr = outputs
+    coprocess.run('true', stdout, stderr)
+    pid = coprocess.pid
+
+    monkeypatch.setenv('CMD2_COPROCESS_TEST', 'changed')
+    coprocess.run('echo $CMD2_COPROCESS_TEST', stdout, stderr)
+    assert stdout.getvalue() == 'changed\n'
+    assert coprocess.pid != pid
+
+def test_coprocess_shell_dies(coprocess, outputs):
+    stdout, stderr = outputs
+    assert coprocess.run('kill -9 $$', stdout, stderr) == -9
+    assert not coprocess.running
+
+    assert coprocess.run('echo back', stdout, stderr) == 0
+    assert stdout.getvalue() == 'back\n'
+
+def test_coprocess_close(coprocess, outputs):
+    stdout, stderr = outputs
+    coprocess.run('true', stdout, stderr)
+    coprocess.close()
+    assert not coprocess.running
+    assert coprocess.pid is None
+    coprocess.close()
+
+
+#
+# test do_shell with persistent_shell
+#
+def test_persistent_shell(base_app):
+    base_app.persistent_shell = True
+    out, err = run_cmd(base_app, 'shell echo hi')
+    assert out == ['hi']
+    out, err = run_cmd(base_app, 'shell ls foobarbaz.this_does_not_exist')
+    assert 'foobarbaz.this_does_not_exist' in err[0]
+    shell = base_app._shell_coprocess
+    assert shell.running
+
+    run_cmd(base_app, 'shell true')
+    assert base_app._shell_coprocess is shell
+
+    # Turning the setting off stops the shell the next time a shell command runs
+    base_app.persistent_shell = False
+    out, err = run_cmd(base_app, 'shell echo new')
+    assert out == ['new']
+    assert base_app._shell_coprocess is None
+    assert not shell.running
+
+def test_persistent_shell_redirect(base_app, tmpdir):
+    base_app.persistent_shell = True
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    run_cmd(base_app, 'shell echo hi > {}'.format(filename))
+    with open(filename) as f:
+        assert f.read() == 'hi\n'
+
+    out, err = run_cmd(base_app, 'shell echo one two | wc -w')
+    assert out[0].strip() == '2'
+    base_app._shell_coprocess.close()
+
+def test_persistent_shell_default_to_shell(base_app):
+    base_app.default_to_shell = True
+    base_app.persistent_shell = True
+    out, err = run_cmd(base_app, 'echo hi')
+    assert out == ['hi']
+    base_app._shell_coprocess.close()
+
+def test_coprocess_partial_marker():
+    marker = b'0123abcd '
+    assert ShellCoprocess._partial_marker_start(bytearray(b'out'), marker) == 3
+    assert ShellCoprocess._partial_marker_start(bytearray(b'out\n'), marker) == 3
+    assert ShellCoprocess._partial_marker_start(bytearray(b'out\n0123'), marker) == 3
+    assert ShellCoprocess._partial_marker_start(bytearray(b'out\n0123abcd 12'), marker) == 3
+    assert ShellCoprocess._partial_marker_start(bytearray(b'out\n0124'), marker) == 8
+    assert ShellCoprocess._partial_marker_start(bytearray(b'out\n0123abcd x'), marker) == 14
+
+def test_coprocess_interrupted(coprocess, outputs, monkeypatch):
+    stdout, stderr = outputs
+
+    def interrupt(*args):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(coprocess, '_write_bytes', interrupt)
+    with pytest.raises(KeyboardInterrupt):
+        coprocess.run('echo hi; sleep 5', stdout, stderr)
+    assert not coprocess.running
+    monkeypatch.undo()
+
+    assert coprocess.run('echo next', stdout, stderr) == 0
+    assert stdout.getvalue() == 'next\n'
@@ -0,0 +1,202 @@
+# coding=utf-8
+# flake8: noqa E302
+"""
+Test piping command output through in-process filters with |>
+"""
+import io
+import os
+
+import pytest
+
+import cmd2
+from cmd2 import filters
+from cmd2.utils import StdSim
+from .conftest import run_cmd
+
+
+def run_filter(name, argv, text):
+    """Run a built-in filter over text and return its output"""
+    line_filter = filters.BUILTIN_FILTERS[name].prepare(argv)
+    return ''.join(line_filter(iter(io.StringIO(text))))
+
+
+#
+# test the built-in filters
+#
+LINES = 'banana 3\nApple 10\ncherry 2\napple 1\n'
+
+def test_grep():
+    assert run_filter('grep', ['an'], LINES) == 'banana 3\n'
+    assert run_filter('grep', ['-i', '^apple'], LINES) == 'Apple 10\napple 1\n'
+    assert run_filter('grep', ['-v', 'a'], LINES) == 'Apple 10\ncherry 2\n'
+    assert run_filter('grep', ['-n', 'pp'], LINES) == '2:Apple 10\n4:apple 1\n'
+    assert run_filter('grep', ['-c', 'pp'], LINES) == '2\n'
+
+def test_grep_end_of_line():
+    # $ matches before the newline of a line
+    assert run_filter('grep', ['1$'], LINES) == 'apple 1\n'
+
+def test_grep_invalid_pattern(capsys):
+    with pytest.raises(SystemExit):
+        filters.BUILTIN_FILTERS['grep'].prepare(['('])
+    out, err = capsys.readouterr()
+    assert 'invalid regular expression' in err
+
+def test_head():
+    assert run_filter('head', ['-n', '2'], LINES) == 'banana 3\nApple 10\n'
+    assert run_filter('head', [], 'x\n' * 20) == 'x\n' * 10
+    assert run_filter('head', ['-n', '0'], LINES) == ''
+
+def test_head_stops_reading():
+    lines = iter(['{}\n'.format(i) for i in range(100)])
+    line_filter = filters.BUILTIN_FILTERS['head'].prepare(['-n', '3'])
+    assert list(line_filter(lines)) == ['0\n', '1\n', '2\n']
+    assert next(lines) == '4\n'
+
+def test_tail():
+    assert run_filter('tail', ['-n', '2'], LINES) == 'cherry 2\napple 1\n'
+    assert run_filter('tail', ['-n', '0'], LINES) == ''
+
+def test_wc():
+    assert run_filter('wc', [], LINES) == '4 8 {}\n'.format(len(LINES))
+    assert run_filter('wc', ['-l'], LINES) == '4\n'
+    assert run_filter('wc', ['-w', '-c'], 'one two') == '2 7\n'
+
+def test_sort():
+    assert run_filter('sort', [], LINES) == 'Apple 10\napple 1\nbanana 3\ncherry 2\n'
+    assert run_filter('sort', ['-f'], LINES) == 'apple 1\nApple 10\nbanana 3\ncherry 2\n'
+    assert run_filter('sort', ['-r'], 'a\nc\nb') == 'c\nb\na\n'
+    assert run_filter('sort', ['-n'], '10 x\n9 y\nz\n-1.5 w\n') == '-1.5 w\nz\n9 y\n10 x\n'
+    assert run_filter('sort', ['-u'], 'b\na\nb\n') == 'a\nb\n'
+    assert run_filter('sort', ['-f', '-u'], 'b\nA\na\n') == 'A\nb\n'
+
+
+#
+# test FilterPipeline
+#
+def test_pipeline():
+    output = StdSim(io.StringIO())
+    head = filters.BUILTIN_FILTERS['head'].prepare(['-n', '2'])
+    sort = filters.BUILTIN_FILTERS['sort'].prepare(['-r'])
+    pipeline = filters.FilterPipeline([head, sort], output)
+    pipeline.input.write('a\nb\nc\n')
+    assert pipeline.wait() is None
+    assert output.getvalue() == 'b\na\n'
+
+def test_pipeline_closes_early():
+    output = StdSim(io.StringIO())
+    pipeline = filters.FilterPipeline([filters.BUILTIN_FILTERS['head'].prepare(['-n', '1'])], output)
+    with pytest.raises(BrokenPipeError):
+        # Write more than a pipe holds so the writer finds out the filters stopped reading
+        for _ in range(100):
+            pipeline.input.write('x' * 64 * 1024 + '\n')
+            pipeline.input.flush()
+    assert pipeline.wait() is None
+    assert output.getvalue() == 'x' * 64 * 1024 + '\n'
+
+def test_pipeline_error():
+    def fail(lines):
+        for _ in lines:
+            raise ValueError('bad line')
+        yield ''
+
+    output = StdSim(io.StringIO())
+    pipeline = filters.FilterPipeline([fail], output)
+    pipeline.input.write('line\n')
+    assert isinstance(pipeline.wait(), ValueError)
+
+
+#
+# test |> in commands
+#
+class FilterApp(cmd2.Cmd):
+    def do_count(self, arg):
+        """Print numbers from 0 up to arg"""
+        for i in range(int(arg)):
+            self.poutput(i)
+
+    def do_shout(self, arg):
+        """Print to sys.stdout instead of self.stdout"""
+        print(arg.upper())
+
+@pytest.fixture
+def filter_app():
+    return FilterApp()
+
+def test_filter_command(filter_app):
+    out, err = run_cmd(filter_app, 'count 20 |> grep 1')
+    assert out == ['1', '10', '11', '12', '13', '14', '15', '16', '17', '18', '19']
+    assert err == []
+
+def test_filter_chain(filter_app):
+    out, err = run_cmd(filter_app, 'count 20|>grep 1|>tail -n 2|> sort -r')
+    assert out == ['19', '18']
+
+def test_filter_sys_stdout(filter_app):
+    out, err = run_cmd(filter_app, 'shout hello |> wc -c')
+    assert out == ['6']
+
+def test_filter_stops_command_output(filter_app):
+    out, err = run_cmd(filter_app, 'count 200000 |> head -n 2')
+    assert out == ['0', '1']
+    assert err == []
+
+def test_filter_then_redirect(filter_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    out, err = run_cmd(filter_app, 'count 5 |> tail -n 2 > {}'.format(filename))
+    assert out == []
+    with open(filename) as f:
+        assert f.read() == '3\n4\n'
+
+def test_filter_then_pipe(filter_app):
+    out, err = run_cmd(filter_app, 'count 50 |> grep 3 | wc -l')
+    assert out[0].strip() == '14'
+
+def test_filter_macro(filter_app):
+    run_cmd(filter_app, 'macro create count_to count {1}')
+    out, err = run_cmd(filter_app, 'count_to 20 |> head -n 2')
+    assert out == ['0', '1']
+    assert err == []
+
+def test_filter_unknown(filter_app):
+    out, err = run_cmd(filter_app, 'count 5 |> fake')
+    assert out == []
+    assert err == ["'fake' is not a filter. Filters: grep, head, sort, tail, wc"]
+
+def test_filter_command(filter_app):
+    # Only filters can follow |>, not commands
+    out, err = run_cmd(filter_app, 'count 5 |> count 2')
+    assert out == []
+    assert err == ["'count' is not a filter. Filters: grep, head, sort, tail, wc", "Commands can't follow |>"]
+
+def test_filter_missing(filter_app):
+    out, err = run_cmd(filter_app, 'count 5 |>')
+    assert out == []
+    assert err == ['Missing filter after |>']
+
+def test_filter_bad_arguments(filter_app):
+    out, err = run_cmd(filter_app, 'count 5 |> head -n x')
+    assert out == []
+    assert 'Usage: head' in err[0]
+
+def test_filter_custom(filter_app):
+    def _upper(args, lines):
+        for line in lines:
+            yield line.upper()
+
+    filter_app.pipe_filters['upper'] = filters.PipeFilter(cmd2.Cmd2ArgumentParser(prog='upper'), _upper)
+    out, err = run_cmd(filter_app, 'shout hi |> upper')
+    assert out == ['HI']
+
+def test_filter_failure(filter_app):
+    def _fail(args, lines):
+        raise ValueError('bad line')
+
+    filter_app.pipe_filters['fail'] = filters.PipeFilter(cmd2.Cmd2ArgumentParser(prog='fail'), _fail)
+    out, err = run_cmd(filter_app, 'count 5 |> fail')
+    assert err == ['Filter failed: bad line']
+
+def test_filter_redirection_disallowed(filter_app):
+    filter_app.allow_redirection = False
+    out, err = run_cmd(filter_app, 'count 2 |> head -n 1')
+    assert out == ['0', '1']
@@ -5,7 +5,10 @@ Test history functions of cmd2
 """
 import tempfile
 import os
+import sys
+import threading
 
+import attr
 import pytest
 
 # Python 3.5 had some regressions in the unitest.mock module, so use
@@ -35,24 +38,29 @@ def test_readline_remove_history_item(base_app):
 #
 # test History() class
 #
+@pytest.fixture(params=['History', 'MappedHistory'])
+def hist_class(request):
+    import cmd2.history
+    return getattr(cmd2.history, request.param)
+
 @pytest.fixture
-def hist():
+def hist(hist_class):
     from cmd2.parsing import Statement
-    from cmd2.cmd2 import History, HistoryItem
-    h = History([HistoryItem(Statement('', raw='first'), 1),
-                 HistoryItem(Statement('', raw='second'), 2),
-                 HistoryItem(Statement('', raw='third'), 3),
-                 HistoryItem(Statement('', raw='fourth'),4)])
+    from cmd2.cmd2 import HistoryItem
+    h = hist_class([HistoryItem(Statement('', raw='first'), 1),
+                    HistoryItem(Statement('', raw='second'), 2),
+                    HistoryItem(Statement('', raw='third'), 3),
+                    HistoryItem(Statement('', raw='fourth'),4)])
     return h
 
 @pytest.fixture
-def persisted_hist():
+def persisted_hist(hist_class):
     from cmd2.parsing import Statement
-    from cmd2.cmd2 import History, HistoryItem
-    h = History([HistoryItem(Statement('', raw='first'), 1),
-                 HistoryItem(Statement('', raw='second'), 2),
-                 HistoryItem(Statement('', raw='third'), 3),
-                 HistoryItem(Statement('', raw='fourth'),4)])
+    from cmd2.cmd2 import HistoryItem
+    h = hist_class([HistoryItem(Statement('', raw='first'), 1),
+                    HistoryItem(Statement('', raw='second'), 2),
+                    HistoryItem(Statement('', raw='third'), 3),
+                    HistoryItem(Statement('', raw='fourth'),4)])
     h.start_session()
     h.append(Statement('', raw='fifth'))
     h.append(Statement('', raw='sixth'))
@@ -235,6 +243,97 @@ def test_history_regex_search(hist):
     assert len(items) == 1
     assert items[0].statement.raw == 'second'
 
+def test_history_search_index_updated(hist):
+    from cmd2.parsing import Statement
+    assert hist.str_search('fifth') == []
+    assert hist._trigram_index.count == len(hist)
+
+    # Appended items are added to the existing index
+    index = hist._trigram_index
+    hist.append(Statement('', raw='fifth'))
+    assert hist._trigram_index is index
+    assert [item.raw for item in hist.str_search('FIFTH')] == ['fifth']
+    assert [item.raw for item in hist.regex_search('if+th$')] == ['fifth']
+
+    # Removing items throws the index away
+    hist.truncate(2)
+    assert hist._trigram_index is None
+    assert [item.raw for item in hist.str_search('fifth')] == ['fifth']
+    assert [item.raw for item in hist.str_search('second')] == []
+
+def test_history_search_after_list_changes(hist):
+    from cmd2.history import HistoryItem
+    from cmd2.parsing import Statement
+    assert [item.raw for item in hist.str_search('first')] == ['first']
+
+    # Changes which keep the length the same
+    hist[0] = HistoryItem(Statement('', raw='replaced'), 1)
+    assert hist.str_search('first') == []
+    assert [item.raw for item in hist.str_search('replaced')] == ['replaced']
+
+    hist.sort(key=lambda item: item.raw)
+    assert [item.raw for item in hist.str_search('replaced')] == ['replaced']
+    hist.reverse()
+    assert [item.raw for item in hist.str_search('fourth')] == ['fourth']
+
+    hist.insert(0, hist.pop())
+    assert [item.raw for item in hist.str_search('fourth')] == ['fourth']
+
+def test_history_search_skips_non_matches(hist_class, mocker):
+    from cmd2.parsing import Statement
+    hist = hist_class()
+    for raw in ['alpha beta', 'gamma delta', 'alpha gamma', 'beta delta']:
+        hist.append(Statement('', raw=raw))
+    text_spy = mocker.spy(hist, '_text')
+
+    assert [item.raw for item in hist.str_search('alpha', True)] == ['alpha beta', 'alpha gamma']
+    assert text_spy.call_count == 2 + len(hist)
+
+    text_spy.reset_mock()
+    assert [item.raw for item in hist.regex_search('^gamma del', True)] == ['gamma delta']
+    assert text_spy.call_count == 1
+
+@pytest.mark.parametrize('raw,search', [
+    ('CAF\u00c9 order', 'caf\u00e9'),
+    ('cafe\u0301 order', 'caf\u00e9'),
+    ('Stra\u00dfe', 'STRASSE'),
+])
+def test_history_str_search_normalized(hist_class, raw, search):
+    from cmd2.parsing import Statement
+    hist = hist_class()
+    hist.append(Statement('', raw='other'))
+    hist.append(Statement('', raw=raw))
+    assert [item.raw for item in hist.str_search(search)] == [raw]
+
+def test_history_regex_search_not_normalized(hist_class):
+    from cmd2.parsing import Statement
+    hist = hist_class()
+    hist.append(Statement('', raw='other'))
+    hist.append(Statement('', raw='cafe\u0301 order'))
+    assert [item.raw for item in hist.regex_search('cafe')] == ['cafe\u0301 order']
+
+@pytest.mark.parametrize('regex,literals', [
+    ('abc', ['abc']),
+    ('ABc.*def', ['abc', 'def']),
+    ('a[bc]d(ef)gh$', ['a', 'd', 'gh']),
+    ('abc|def', []),
+    ('(?i)abc', []),
+    ('^$', []),
+])
+def test_history_regex_literals(regex, literals):
+    import re
+    from cmd2.history import _regex_literals
+    assert _regex_literals(re.compile(regex)) == literals
+
+def test_history_regex_search_without_re_parser(hist, monkeypatch):
+    import re
+    import cmd2.history
+    monkeypatch.setattr(cmd2.history, 'sre_parse', None)
+    assert cmd2.history._regex_literals(re.compile('abc')) == []
+
+    # Every item is checked instead
+    assert [item.raw for item in hist.regex_search('s[a-z]+ond', True)] == ['second']
+
 def test_history_max_length_zero(hist):
     hist.truncate(0)
     assert len(hist) == 0
@@ -249,6 +348,335 @@ def test_history_max_length(hist):
     assert hist.get(1).statement.raw == 'third'
     assert hist.get(2).statement.raw == 'fourth'
 
+def test_history_clear_class(hist):
+    hist.clear()
+    assert len(hist) == 0
+    assert hist.session_start_index == 0
+    hist.append(cmd2.Statement('', raw='new'))
+    assert hist.get(1).raw == 'new'
+    assert hist.get(1).idx == 1
+
+def test_mapped_history_search_creates_only_matches(mocker):
+    from cmd2.history import MappedHistory
+    parser = StatementParser()
+    hist = MappedHistory()
+    for i in range(20):
+        hist.append(parser.parse('command{} arg{}'.format(i, i)))
+
+    item_spy = mocker.spy(hist, '_item')
+    items = hist.str_search('COMMAND1', include_persisted=True)
+    assert [item.idx for item in items] == [2] + list(range(11, 21))
+    assert item_spy.call_count == len(items)
+
+    item_spy.reset_mock()
+    items = hist.regex_search('/arg1[35]$/', include_persisted=True)
+    assert [item.raw for item in items] == ['command13 arg13', 'command15 arg15']
+    assert item_spy.call_count == 2
+
+def test_mapped_history_items():
+    from cmd2.history import MappedHistory
+    parser = StatementParser(aliases={'al': 'help -v'}, shortcuts={'!': 'shell'})
+    mapped = MappedHistory()
+    for line in ['al', '!ls -al | less', 'help "quoted arg" > file', 'unicode \u00e9']:
+        mapped.append(parser.parse(line))
+
+    # Items are created from the file each time they are retrieved
+    assert mapped.get(1) == mapped.get(1)
+    assert mapped.get(1) is not mapped.get(1)
+    assert mapped.get(1).expanded == 'help -v'
+    assert mapped.get(2).statement.pipe_to == 'less'
+    assert mapped.get(-2).statement.argv == ['help', 'quoted arg']
+    assert mapped.get(4).raw == 'unicode \u00e9'
+    assert [item.idx for item in mapped] == [1, 2, 3, 4]
+    assert mapped[1:3] == [mapped.get(2), mapped.get(3)]
+    with pytest.raises(IndexError):
+        mapped.get(5)
+
+    mapped.close()
+
+@pytest.fixture(params=['MappedHistory', 'RingHistory'])
+def storage_hist(request):
+    """A history which doesn't keep its items in the list it inherits from"""
+    import cmd2.history
+    from cmd2.parsing import Statement
+    if request.param == 'RingHistory':
+        h = cmd2.history.RingHistory(max_items=100)
+    else:
+        h = cmd2.history.MappedHistory()
+    for raw in ['first', 'second', 'third']:
+        h.append(Statement('', raw=raw))
+    yield h
+    if request.param == 'MappedHistory':
+        h.close()
+
+def test_custom_storage_history_read_methods(storage_hist):
+    items = list(storage_hist)
+    assert [item.raw for item in reversed(storage_hist)] == ['third', 'second', 'first']
+    assert items[1] in storage_hist
+    assert 'fake' not in storage_hist
+    assert storage_hist.index(items[2]) == 2
+    assert storage_hist.count(items[0]) == 1
+    assert storage_hist.copy() == items
+    assert type(storage_hist.copy()) is list
+    assert repr(storage_hist) == repr(items)
+    assert storage_hist + items[:1] == items + items[:1]
+    assert items[:1] + storage_hist == items[:1] + items
+    assert storage_hist * 2 == items * 2
+    assert storage_hist[:1] < storage_hist
+    assert storage_hist >= items
+    assert bool(storage_hist)
+
+def test_custom_storage_history_write_methods(storage_hist):
+    from cmd2.history import HistoryItem
+    from cmd2.parsing import Statement
+
+    def raws():
+        return [item.raw for item in storage_hist]
+
+    storage_hist.extend([HistoryItem(Statement('', raw='fourth'), 4)])
+    storage_hist += [HistoryItem(Statement('', raw='fifth'), 5)]
+    assert raws() == ['first', 'second', 'third', 'fourth', 'fifth']
+
+    assert storage_hist.pop().raw == 'fifth'
+    assert storage_hist.pop(0).raw == 'first'
+    assert raws() == ['second', 'third', 'fourth']
+
+    storage_hist.remove(storage_hist[-1])
+    assert raws() == ['second', 'third']
+
+    storage_hist.insert(5, HistoryItem(Statement('', raw='last'), 4))
+    assert raws() == ['second', 'third', 'last']
+
+    storage_hist.sort(key=lambda item: item.raw)
+    assert raws() == ['last', 'second', 'third']
+    storage_hist.reverse()
+    assert raws() == ['third', 'second', 'last']
+    storage_hist.extend(storage_hist)
+    assert raws() == ['third', 'second', 'last'] * 2
+
+    # Searches see the new contents
+    assert [item.raw for item in storage_hist.str_search('second', True)] == ['second', 'second']
+    with pytest.raises(IndexError):
+        storage_hist.pop(10)
+    with pytest.raises(ValueError):
+        storage_hist.index('fake')
+
+def test_mapped_history_list_methods():
+    from cmd2.history import HistoryItem, MappedHistory
+    from cmd2.parsing import Statement
+    hist = MappedHistory([HistoryItem(Statement('', raw=raw), idx) for idx, raw in enumerate('abc', start=1)])
+    hist.insert(0, HistoryItem(Statement('', raw='z'), 9))
+    hist[1] = HistoryItem(Statement('', raw='y'), 8)
+    assert [(item.idx, item.raw) for item in hist] == [(9, 'z'), (8, 'y'), (2, 'b'), (3, 'c')]
+    hist *= 2
+    assert len(hist) == 8
+    hist.close()
+
+def test_mapped_history_reclaims_space(monkeypatch):
+    from cmd2.history import MappedHistory
+    from cmd2.parsing import Statement
+    monkeypatch.setattr(MappedHistory, 'COMPACT_MIN_BYTES', 0)
+    hist = MappedHistory()
+    for i in range(100):
+        hist.append(Statement('', raw='command {}'.format(i)))
+    full_size = os.fstat(hist._file.fileno()).st_size
+
+    hist.truncate(10)
+    assert os.fstat(hist._file.fileno()).st_size < full_size / 5
+    assert [item.raw for item in hist] == ['command {}'.format(i) for i in range(90, 100)]
+    assert [item.idx for item in hist.str_search('command 95', True)] == [96]
+
+    # Removing a few items at a time compacts once more than half of the file is unused
+    for _ in range(5):
+        del hist[0]
+    assert hist._size > hist._used_size
+    del hist[0]
+    assert hist._size == hist._used_size
+    hist.append(Statement('', raw='next'))
+    assert [item.raw for item in hist] == ['command 96', 'command 97', 'command 98', 'command 99', 'next']
+
+    del hist[:]
+    assert os.fstat(hist._file.fileno()).st_size == 0
+    hist.close()
+
+def test_memory_mapped_history_app():
+    from cmd2.history import MappedHistory
+    app = cmd2.Cmd(memory_mapped_history=True)
+    assert isinstance(app.history, MappedHistory)
+    run_cmd(app, 'help')
+    run_cmd(app, 'shortcuts')
+    run_cmd(app, 'help history')
+
+    out, err = run_cmd(app, 'history')
+    assert out == normalize("""
+    1  help
+    2  shortcuts
+    3  help history
+""")
+    out, err = run_cmd(app, 'history help')
+    assert out == normalize("""
+    1  help
+    3  help history
+""")
+    out, err = run_cmd(app, 'history -s 2')
+    assert out == ['shortcuts']
+
+@pytest.fixture
+def ring_hist():
+    from cmd2.history import RingHistory
+    from cmd2.parsing import Statement
+    h = RingHistory(max_items=3)
+    for raw in ['first', 'second', 'third', 'fourth', 'fifth']:
+        h.append(Statement('', raw=raw))
+    return h
+
+def test_ring_history_drops_oldest(ring_hist):
+    assert len(ring_hist) == 3
+    assert ring_hist.first_idx == 3
+    assert [(item.idx, item.raw) for item in ring_hist] == [(3, 'third'), (4, 'fourth'), (5, 'fifth')]
+    assert ring_hist[0].raw == 'third'
+    assert ring_hist[-1].raw == 'fifth'
+
+def test_ring_history_get(ring_hist):
+    assert ring_hist.get(3).raw == 'third'
+    assert ring_hist.get(5).raw == 'fifth'
+    assert ring_hist.get(-1).raw == 'fifth'
+    assert ring_hist.get(-3).raw == 'third'
+    for index in [0, 1, 2, 6]:
+        with pytest.raises(IndexError):
+            ring_hist.get(index)
+
+@pytest.mark.parametrize('span,numbers', [
+    (':', [3, 4, 5]),
+    ('4', [4]),
+    ('-1', [5]),
+    ('1..4', [3, 4]),
+    ('4:', [4, 5]),
+    (':3', [3]),
+    (':2', []),
+    ('1:2', []),
+    ('-2:', [4, 5]),
+    ('3:-2', [3, 4]),
+    ('4:10', [4, 5]),
+])
+def test_ring_history_span(ring_hist, span, numbers):
+    assert [item.idx for item in ring_hist.span(span, include_persisted=True)] == numbers
+
+def test_ring_history_span_dropped(ring_hist):
+    with pytest.raises(IndexError):
+        ring_hist.span('2')
+
+def test_ring_history_session(ring_hist):
+    from cmd2.parsing import Statement
+    ring_hist.start_session()
+    ring_hist.append(Statement('', raw='sixth'))
+    assert [item.raw for item in ring_hist.span(':')] == ['sixth']
+    assert ring_hist.session_start_index == 2
+
+    # The session start moves as older items are dropped
+    ring_hist.append(Statement('', raw='seventh'))
+    assert ring_hist.session_start_index == 1
+    ring_hist.append(Statement('', raw='eighth'))
+    ring_hist.append(Statement('', raw='ninth'))
+    assert ring_hist.session_start_index == 0
+    assert [item.raw for item in ring_hist.span(':')] == ['seventh', 'eighth', 'ninth']
+
+def test_ring_history_search(ring_hist):
+    from cmd2.parsing import Statement
+    assert [item.idx for item in ring_hist.str_search('fifth', True)] == [5]
+    assert ring_hist.str_search('second', True) == []
+
+    for i in range(10):
+        ring_hist.append(Statement('', raw='fifth again {}'.format(i)))
+    assert [item.idx for item in ring_hist.str_search('fifth', True)] == [13, 14, 15]
+    assert [item.idx for item in ring_hist.regex_search('again [0-8]', True)] == [13, 14]
+
+def test_ring_history_truncate(ring_hist):
+    from cmd2.parsing import Statement
+    ring_hist.truncate(1)
+    assert [item.idx for item in ring_hist] == [5]
+    ring_hist.truncate(0)
+    assert len(ring_hist) == 0
+
+    # Numbering continues after truncating
+    ring_hist.append(Statement('', raw='sixth'))
+    assert ring_hist.get(6).raw == 'sixth'
+
+def test_ring_history_clear(ring_hist):
+    from cmd2.parsing import Statement
+    ring_hist.clear()
+    assert len(ring_hist) == 0
+    ring_hist.append(Statement('', raw='new'))
+    assert ring_hist.get(1).raw == 'new'
+
+def test_ring_history_del(ring_hist):
+    with pytest.raises(ValueError):
+        del ring_hist[1]
+    del ring_hist[0]
+    assert [item.idx for item in ring_hist] == [4, 5]
+    del ring_hist[:]
+    assert len(ring_hist) == 0
+
+def test_ring_history_del_newest(ring_hist):
+    from cmd2.parsing import Statement
+    assert ring_hist.pop().idx == 5
+    assert [item.idx for item in ring_hist] == [3, 4]
+
+    # The number of the removed item is reused
+    assert ring_hist.append(Statement('', raw='new')).idx == 5
+    assert ring_hist.get(5).raw == 'new'
+
+def test_ring_history_list_methods_renumber(ring_hist):
+    from cmd2.history import HistoryItem
+    from cmd2.parsing import Statement
+    ring_hist.extend([HistoryItem(Statement('', raw='extra'), 1)])
+    assert [(item.idx, item.raw) for item in ring_hist] == [(4, 'fourth'), (5, 'fifth'), (6, 'extra')]
+
+    ring_hist.sort(key=lambda item: item.raw)
+    assert [(item.idx, item.raw) for item in ring_hist] == [(4, 'extra'), (5, 'fifth'), (6, 'fourth')]
+    assert ring_hist.get(6).raw == 'fourth'
+
+def test_ring_history_seq(ring_hist):
+    from cmd2.history import RingHistory
+    from cmd2.parsing import Statement
+    items = list(ring_hist)
+    items.append(attr.evolve(items[0], idx=100))
+    hist = RingHistory(items, max_items=10)
+    assert [item.idx for item in hist] == [3, 4, 5, 6]
+    assert hist.append(Statement('', raw='next')).idx == 7
+
+    with pytest.raises(ValueError):
+        RingHistory(max_items=0)
+
+def test_ring_history_app(journal_file):
+    from cmd2.history import RingHistory
+    app = cmd2.Cmd(persistent_history_file=journal_file, history_max_items=2)
+    assert isinstance(app.history, RingHistory)
+    for i in range(3):
+        run_cmd(app, 'help {}'.format(i))
+    out, err = run_cmd(app, 'history')
+    assert out == normalize("""
+    2  help 1
+    3  help 2
+""")
+
+    # Numbers stay the same in the next session
+    app = cmd2.Cmd(persistent_history_file=journal_file, history_max_items=2)
+    run_cmd(app, 'shortcuts')
+    out, err = run_cmd(app, 'history -a')
+    assert out == normalize("""
+    3  help 2
+    4  shortcuts
+""")
+    out, err = run_cmd(app, 'history 3')
+    assert out == normalize("""
+    3  help 2
+""")
+
+def test_ring_history_with_mapped_history():
+    with pytest.raises(ValueError):
+        cmd2.Cmd(memory_mapped_history=True, history_max_items=10)
+
 #
 # test HistoryItem()
 #
@@ -325,6 +753,27 @@ def test_history_item_properties(histitem):
     assert histitem.raw == 'help history'
     assert histitem.expanded == 'help history'
     assert str(histitem) == 'help history'
+    assert histitem.finished
+    assert histitem.start_time is None
+    assert histitem.succeeded is None
+
+def test_history_item_timing(histitem):
+    import time
+    start_time = time.mktime((2019, 10, 30, 14, 5, 9, 0, 0, -1))
+    running = attr.evolve(histitem, start_time=start_time)
+    assert not running.finished
+    assert running.timing_summary() == '2019-10-30 14:05:09          -          -  -     '
+
+    item = attr.evolve(running, elapsed=1.5, cpu_time=0.25, succeeded=False)
+    assert item.finished
+    assert item.timing_summary() == '2019-10-30 14:05:09     1.500s     0.250s  failed'
+    assert item.pr(timing=True) == '    1  2019-10-30 14:05:09     1.500s     0.250s  failed  help history'
+    assert item.pr(script=True, timing=True) == 'help history'
+
+    assert histitem.pr(timing=True) == '    1  -                            -          -  -       help history'
+
+    with pytest.raises(TypeError):
+        attr.evolve(histitem, elapsed='slow')
 
 #
 # test history command
@@ -507,6 +956,24 @@ def test_history_run_one_command(base_app):
     out2, err2 = run_cmd(base_app, 'history -r 1')
     assert out1 == out2
 
+def test_history_run_batch(base_app, tmpdir):
+    filename = os.path.join(str(tmpdir), 'out.txt')
+    run_cmd(base_app, 'shortcuts >> {}'.format(filename))
+    run_cmd(base_app, 'shortcuts >> {}'.format(filename))
+    with open(filename) as f:
+        before = f.read()
+
+    with mock.patch.object(base_app, 'runcmds_plus_hooks', wraps=base_app.runcmds_plus_hooks) as runcmds_mock:
+        run_cmd(base_app, 'history -r -b 1:2')
+    assert runcmds_mock.call_args_list[0][1]['batch']
+    with open(filename) as f:
+        assert f.read() == before * 2
+
+def test_history_batch_without_run(base_app):
+    out, err = run_cmd(base_app, 'history -b')
+    assert out[0] == '-b can only be used with -r or -e'
+    assert out[1].startswith('Usage:')
+
 def test_history_clear(hist_file):
     # Add commands to history
     app = cmd2.Cmd(persistent_history_file=hist_file)
@@ -530,7 +997,7 @@ def test_history_verbose_with_other_options(base_app):
     options_to_test = ['-r', '-e', '-o file', '-t file', '-c', '-x']
     for opt in options_to_test:
         out, err = run_cmd(base_app, 'history -v ' + opt)
-        assert len(out) == 4
+        assert len(out) == 6
         assert out[0] == '-v can not be used with any other options'
         assert out[1].startswith('Usage:')
 
@@ -547,7 +1014,7 @@ def test_history_script_with_invalid_options(base_app):
     options_to_test = ['-r', '-e', '-o file', '-t file', '-c']
     for opt in options_to_test:
         out, err = run_cmd(base_app, 'history -s ' + opt)
-        assert len(out) == 4
+        assert len(out) == 6
         assert out[0] == '-s and -x can not be used with -c, -r, -e, -o, or -t'
         assert out[1].startswith('Usage:')
 
@@ -563,7 +1030,7 @@ def test_history_expanded_with_invalid_options(base_app):
     options_to_test = ['-r', '-e', '-o file', '-t file', '-c']
     for opt in options_to_test:
         out, err = run_cmd(base_app, 'history -x ' + opt)
-        assert len(out) == 4
+        assert len(out) == 6
         assert out[0] == '-s and -x can not be used with -c, -r, -e, -o, or -t'
         assert out[1].startswith('Usage:')
 
@@ -716,6 +1183,69 @@ def test_history_populates_readline(hist_file):
     assert readline.get_history_item(2) == 'shortcuts'
     assert readline.get_history_item(3) == 'alias'
 
+def _readline_history():
+    from cmd2.rl_utils import readline
+    return [readline.get_history_item(i) for i in range(1, readline.get_current_history_length() + 1)]
+
+def test_history_preloads_readline(journal_file):
+    from cmd2.rl_utils import readline
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    for command in ['help', 'shortcuts', 'shortcuts', 'alias', 'macro', 'set']:
+        run_cmd(app, command)
+
+    readline.clear_history()
+    app = cmd2.Cmd(persistent_history_file=journal_file, readline_history_preload=2)
+    assert _readline_history() == ['macro', 'set']
+
+    # The older commands are added by a thread which waits for cmdloop() to display a prompt
+    def do_check(_):
+        assert _readline_history() == ['macro', 'set']
+        readline.add_history('check')
+    app.do_check = do_check
+
+    def wait_for_backfill(prompt):
+        app._readline_backfill_thread.join()
+        return 'quit'
+
+    app._startup_commands = ['check']
+    with mock.patch('sys.stdin.isatty', return_value=True), mock.patch('builtins.input', wait_for_backfill):
+        app.cmdloop()
+    assert _readline_history() == ['help', 'shortcuts', 'alias', 'macro', 'set', 'check']
+
+def test_history_preload_all(journal_file):
+    from cmd2.rl_utils import readline
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    run_cmd(app, 'help')
+    run_cmd(app, 'alias')
+
+    readline.clear_history()
+    app = cmd2.Cmd(persistent_history_file=journal_file, readline_history_preload=2)
+    assert not app._readline_backfill_items
+    assert _readline_history() == ['help', 'alias']
+
+def test_history_preload_merges_duplicate(journal_file):
+    from cmd2.rl_utils import readline
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    for command in ['help', 'alias', 'alias']:
+        run_cmd(app, command)
+
+    readline.clear_history()
+    app = cmd2.Cmd(persistent_history_file=journal_file, readline_history_preload=1)
+    app._backfill_readline_history()
+    assert _readline_history() == ['help', 'alias']
+
+def test_history_clear_cancels_preload(journal_file):
+    from cmd2.rl_utils import readline
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    for command in ['help', 'shortcuts', 'alias']:
+        run_cmd(app, command)
+
+    readline.clear_history()
+    app = cmd2.Cmd(persistent_history_file=journal_file, readline_history_preload=1)
+    run_cmd(app, 'history -c')
+    app._backfill_readline_history()
+    assert _readline_history() == []
+
 #
 # test cmd2's ability to write out history on exit
 # we are testing the _persist_history_on_exit() method, and
@@ -732,10 +1262,470 @@ def test_persist_history_ensure_no_error_if_no_histfile(base_app, capsys):
 
 def test_persist_history_permission_error(hist_file, mocker, capsys):
     app = cmd2.Cmd(persistent_history_file=hist_file)
-    run_cmd(app, 'help')
     mock_open = mocker.patch('builtins.open')
     mock_open.side_effect = PermissionError
+    out, err = run_cmd(app, 'help')
+    assert 'Can not write' in err[0]
+
+    # Writing history is abandoned after an error
+    assert app._history_journal is None
+    out, err = run_cmd(app, 'help')
+    assert not err
+    app._persist_history()
+    out, err = capsys.readouterr()
+    assert not err
+
+def test_persist_history_compact_permission_error(hist_file, mocker, capsys):
+    app = cmd2.Cmd(persistent_history_file=hist_file)
+    app._history_journal.needs_rewrite = True
+    mocker.patch('os.replace', side_effect=PermissionError)
     app._persist_history()
     out, err = capsys.readouterr()
     assert not out
     assert 'Can not write' in err
+
+#
+# test the history journal
+#
+@pytest.fixture
+def journal_file():
+    with tempfile.TemporaryDirectory() as test_dir:
+        yield os.path.join(test_dir, 'history')
+
+def _journal_item(raw, idx=1):
+    from cmd2.history import HistoryItem
+    from cmd2.parsing import Statement
+    return HistoryItem(Statement('arg', raw=raw, command='cmd', arg_list=['arg']), idx)
+
+def test_history_written_as_commands_run(journal_file):
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    run_cmd(app, 'help')
+    run_cmd(app, 'alias create s shortcuts')
+
+    # The commands are on disk without _persist_history() having been called
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    assert [item.raw for item in app.history] == ['help', 'alias create s shortcuts']
+    assert app.history.get(2).statement.command == 'alias'
+    assert app.history.get(2).statement.arg_list == ['create', 's', 'shortcuts']
+
+def test_history_journal_round_trip(journal_file):
+    from cmd2.history import HistoryItem, HistoryJournal
+    from cmd2.parsing import Statement
+    statement = Statement('"quoted arg"', raw='cmd "quoted arg"; sfx | less\nmore', command='cmd',
+                          arg_list=['"quoted arg"'], multiline_command='cmd', terminator=';',
+                          suffix='sfx', pipe_to='less', output='', output_to='')
+    journal = HistoryJournal(journal_file)
+    journal.append(HistoryItem(statement, 7))
+    journal.append(_journal_item('unicode \u00e9', 8))
+    assert journal.record_count == 2
+
+    journal = HistoryJournal(journal_file)
+    loaded = journal.load(10)
+    assert journal.record_count == 2
+    assert not journal.needs_rewrite
+    assert loaded[0] == HistoryItem(statement, 7)
+    assert loaded[0].raw == statement.raw
+    assert loaded[1].raw == 'unicode \u00e9'
+    assert loaded[1].idx == 8
+
+def test_history_journal_record_without_idx(journal_file):
+    from cmd2.history import HistoryJournal
+    with open(journal_file, 'wb') as fobj:
+        fobj.write(HistoryJournal.HEADER)
+        for raw in ['first', 'second', 'third']:
+            fobj.write(b'{"statement":{"args":"","raw":"' + raw.encode() + b'"}}\n')
+
+    # Records are numbered by their position in the file when they don't have an index
+    items = HistoryJournal(journal_file).load(2)
+    assert [(item.idx, item.raw) for item in items] == [(2, 'second'), (3, 'third')]
+
+def test_history_journal_load_most_recent(journal_file):
+    from cmd2.history import HistoryJournal
+    journal = HistoryJournal(journal_file)
+    for i in range(10):
+        journal.append(_journal_item(str(i), i + 1))
+
+    assert [s.raw for s in journal.load(3)] == ['7', '8', '9']
+    assert journal.record_count == 10
+    assert journal.load(0) == []
+
+def test_history_journal_partial_record(journal_file):
+    from cmd2.history import HistoryJournal
+    journal = HistoryJournal(journal_file)
+    journal.append(_journal_item('first'))
+    with open(journal_file, 'ab') as fobj:
+        fobj.write(b'{"statement":{"args"')
+
+    journal = HistoryJournal(journal_file)
+    assert [s.raw for s in journal.load(10)] == ['first']
+    assert journal.needs_rewrite
+
+def test_history_journal_damaged_record(journal_file):
+    from cmd2.history import HistoryJournal
+    journal = HistoryJournal(journal_file)
+    journal.append(_journal_item('first'))
+    with open(journal_file, 'ab') as fobj:
+        fobj.write(b'{"statement":{"args":5}}\n')
+    journal.append(_journal_item('third'))
+
+    journal = HistoryJournal(journal_file)
+    assert [s.raw for s in journal.load(10)] == ['first', 'third']
+    assert journal.needs_rewrite
+
+def test_history_compacted(journal_file):
+    from cmd2.history import HistoryJournal
+    app = cmd2.Cmd(persistent_history_file=journal_file, persistent_history_length=2)
+    for i in range(4):
+        run_cmd(app, 'help {}'.format(i))
+    assert app._history_journal.record_count == 4
+
+    # The file is compacted once it holds more than twice the history length
+    run_cmd(app, 'help 4')
+    assert app._history_journal.record_count == 2
+    assert len(app.history) == 5
+
+    journal = HistoryJournal(journal_file)
+    assert [s.raw for s in journal.load(10)] == ['help 3', 'help 4']
+
+def test_history_converted_from_pickle(journal_file):
+    import pickle
+    from cmd2.history import History
+    from cmd2.parsing import Statement
+    old_history = History()
+    old_history.append(_journal_item('first').statement)
+    old_history.append(_journal_item('second').statement)
+    with open(journal_file, 'wb') as fobj:
+        pickle.dump(old_history, fobj)
+
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    assert [item.raw for item in app.history] == ['first', 'second']
+
+    # The file isn't converted until history is written
+    with open(journal_file, 'rb') as fobj:
+        assert pickle.load(fobj) == old_history
+
+    run_cmd(app, 'help')
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    assert [item.raw for item in app.history] == ['first', 'second', 'help']
+    assert not app._history_journal.needs_rewrite
+    assert app._history_journal.record_count == 3
+
+#
+# test recording how commands ran
+#
+def test_history_records_command_timing(base_app):
+    import time
+    before = time.time()
+    run_cmd(base_app, 'help')
+    item = base_app.history.get(1)
+    assert before <= item.start_time <= time.time()
+    assert item.elapsed >= 0
+    assert item.cpu_time >= 0
+    assert item.succeeded is True
+
+def test_history_records_command_failure(base_app):
+    def do_fail(_):
+        raise ValueError('broken')
+    base_app.do_fail = do_fail
+    out, err = run_cmd(base_app, 'fail')
+    assert 'broken' in err[0]
+    item = base_app.history.get(1)
+    assert item.succeeded is False
+    assert item.elapsed >= 0
+
+def test_history_records_default_to_shell(base_app):
+    base_app.default_to_shell = True
+    run_cmd(base_app, 'true')
+    item = base_app.history.get(1)
+    assert item.raw == 'true'
+    assert item.succeeded is True
+
+def test_history_timing_in_running_command(base_app):
+    # While a command runs, its item has a start time but isn't finished
+    items = []
+    def do_check(_):
+        items.append(base_app.history.get(-1))
+    base_app.do_check = do_check
+    run_cmd(base_app, 'check')
+    assert items[0].start_time is not None
+    assert not items[0].finished
+    assert base_app.history.get(1).finished
+
+@pytest.mark.parametrize('hist_class_name', ['History', 'MappedHistory', 'RingHistory'])
+def test_history_update(hist_class_name):
+    from cmd2 import history
+    from cmd2.parsing import Statement
+    if hist_class_name == 'RingHistory':
+        hist = history.RingHistory(max_items=2)
+    else:
+        hist = getattr(history, hist_class_name)()
+    first = hist.append(Statement('', raw='first'), start_time=5.0)
+    assert hist.get(1).start_time == 5.0
+    assert not hist.get(1).finished
+
+    finished = attr.evolve(first, elapsed=2.0, cpu_time=1.0, succeeded=True)
+    assert hist.update(finished)
+    assert hist.get(1) == finished
+
+    # Items which are gone or were replaced by other commands aren't updated
+    hist.clear()
+    hist.append(Statement('', raw='other'))
+    assert not hist.update(finished)
+    assert hist.get(1).raw == 'other'
+    assert hist.get(1).elapsed is None
+    assert not hist.update(attr.evolve(finished, idx=2))
+
+def test_history_timing_persisted(journal_file):
+    from cmd2.history import HistoryJournal
+    item = attr.evolve(_journal_item('timed', 3), start_time=1572444309.25, elapsed=0.5, cpu_time=0.125,
+                       succeeded=False)
+    journal = HistoryJournal(journal_file)
+    journal.append(_journal_item('untimed', 2))
+    journal.append(item)
+    assert HistoryJournal(journal_file).load(10) == [_journal_item('untimed', 2), item]
+
+    with open(journal_file, 'rb') as fobj:
+        assert b'"start_time":1572444309.25,"elapsed":0.5,"cpu_time":0.125,"succeeded":false' in fobj.read()
+
+def test_history_timing_kept_across_sessions(journal_file):
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    run_cmd(app, 'help')
+    expected = app.history.get(1)
+
+    for kwargs in [{}, {'memory_mapped_history': True}, {'history_max_items': 5}]:
+        app = cmd2.Cmd(persistent_history_file=journal_file, **kwargs)
+        assert app.history.get(1) == expected
+
+def test_history_nested_commands_order(journal_file, request):
+    # A script finishes after the commands in it, but is still loaded before them
+    test_dir = os.path.dirname(request.module.__file__)
+    script = os.path.join(test_dir, 'scripts', 'help.txt')
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    run_cmd(app, 'run_script {}'.format(script))
+    raws = [item.raw for item in app.history]
+    assert raws[0].startswith('run_script')
+
+    app = cmd2.Cmd(persistent_history_file=journal_file)
+    assert [item.raw for item in app.history] == raws
+
+def test_history_compaction_skips_running_command(journal_file):
+    app = cmd2.Cmd(persistent_history_file=journal_file, persistent_history_length=1)
+    def do_nested(_):
+        app.onecmd_plus_hooks('help')
+        app.onecmd_plus_hooks('shortcuts')
+        app.onecmd_plus_hooks('alias')
+    app.do_nested = do_nested
+    run_cmd(app, 'nested')
+
+    # nested was written once when it finished, even though the file was compacted while it ran
+    app = cmd2.Cmd(persistent_history_file=journal_file, persistent_history_length=10)
+    assert [item.raw for item in app.history] == ['nested', 'alias']
+
+@pytest.fixture
+def timed_app():
+    import time
+    from cmd2.history import History
+    app = cmd2.Cmd()
+    hour = 60 * 60
+    now = time.time()
+    history = History()
+    for raw, age, elapsed, cpu_time, succeeded in [('old', 30 * 24, 4.0, 0.5, True),
+                                                   ('slow', 3 * 24, 9.0, 1.0, True),
+                                                   ('fast', 2 * 24, 0.1, 0.1, True),
+                                                   ('broken', 24, 1.0, 2.0, False),
+                                                   ('recent', 1, 3.0, 0.2, True)]:
+        item = history.append(cmd2.Statement('', raw=raw), start_time=now - age * hour)
+        history.update(attr.evolve(item, elapsed=elapsed, cpu_time=cpu_time, succeeded=succeeded))
+    history.append(cmd2.Statement('', raw='untimed'))
+    history.start_session()
+    app.history = history
+    app.exclude_from_history.append('help')
+    return app
+
+@pytest.mark.parametrize('options,expected', [
+    ('--since 7d', ['slow', 'fast', 'broken', 'recent']),
+    ('--since 1w --until 30h', ['slow', 'fast']),
+    ('--slower-than 3', ['old', 'slow', 'recent']),
+    ('--failed', ['broken']),
+    ('--sort elapsed', ['slow', 'old', 'recent', 'broken', 'fast', 'untimed']),
+    ('--sort cpu --limit 2', ['broken', 'slow']),
+    ('--since 7d --sort elapsed --limit 2', ['slow', 'recent']),
+    ('--limit 0', []),
+    ('--sort elapsed e', ['recent', 'broken', 'untimed']),
+])
+def test_history_filter_and_sort(timed_app, options, expected):
+    out, err = run_cmd(timed_app, 'history -a -s ' + options)
+    assert out == expected
+
+def test_history_filter_dates(timed_app):
+    import datetime
+    old_start = timed_app.history.get(1).start_time
+    day = datetime.datetime.fromtimestamp(old_start).strftime('%Y-%m-%d')
+    out, err = run_cmd(timed_app, 'history -a -s --until {}'.format(day))
+    assert out == []
+    out, err = run_cmd(timed_app, 'history -a -s --since {} --until "{}"'.format(
+        day, datetime.datetime.fromtimestamp(old_start + 1).strftime('%Y-%m-%d %H:%M:%S')))
+    assert out == ['old']
+
+def test_history_filter_by_session(timed_app):
+    # Without -a, only the current session is searched
+    out, err = run_cmd(timed_app, 'history --sort elapsed')
+    assert out == []
+
+def test_history_timing_option(timed_app):
+    out, err = run_cmd(timed_app, 'history -a -T --failed')
+    assert len(out) == 1
+    assert out[0].startswith('    4  ')
+    assert out[0].endswith('     1.000s     2.000s  failed  broken')
+
+def test_history_invalid_time(timed_app):
+    out, err = run_cmd(timed_app, 'history --since yesterday')
+    assert "invalid time: 'yesterday'" in err[-1]
+
+@pytest.mark.parametrize('value,age', [
+    ('90s', 90),
+    ('1.5m', 90),
+    ('2h', 2 * 60 * 60),
+    ('1d', 24 * 60 * 60),
+    ('2w', 14 * 24 * 60 * 60),
+])
+def test_history_time_ages(value, age):
+    import time
+    from cmd2.cmd2 import _history_time
+    assert abs(time.time() - age - _history_time(value)) < 5
+
+#
+# test sharing a history file between processes
+#
+def test_shared_history_merge(journal_file):
+    from cmd2.history import SharedHistoryJournal
+    first = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True)
+    second = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True)
+    assert isinstance(first._history_journal, SharedHistoryJournal)
+
+    run_cmd(first, 'help')
+    run_cmd(second, 'shortcuts')
+    run_cmd(first, 'alias')
+
+    # The history command shows what the other app ran after the app's own commands
+    out, err = run_cmd(first, 'history')
+    assert out == normalize("""
+    1  help
+    2  alias
+    3  shortcuts
+""")
+    out, err = run_cmd(second, 'history')
+    assert out == normalize("""
+    1  shortcuts
+    2  help
+    3  alias
+""")
+
+    # Nothing new
+    out, err = run_cmd(first, 'history')
+    assert len(out) == 3
+    assert first.history.get(3) == attr.evolve(second.history.get(1), idx=3)
+
+    # A new session has all the commands ordered by when they started
+    third = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True)
+    assert [item.raw for item in third.history] == ['help', 'shortcuts', 'alias']
+
+def test_shared_history_merge_readline(journal_file):
+    from cmd2.rl_utils import readline
+    first = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True)
+    second = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True)
+    readline.clear_history()
+    readline.add_history('help')
+    run_cmd(second, 'help')
+    run_cmd(second, 'alias')
+    run_cmd(first, 'history')
+    assert _readline_history() == ['help', 'alias']
+
+def test_shared_history_compaction_keeps_other_commands(journal_file):
+    first = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True, persistent_history_length=3)
+    second = cmd2.Cmd(persistent_history_file=journal_file, shared_history=True, persistent_history_length=3)
+    for i in range(4):
+        run_cmd(first, 'help {}'.format(i))
+        run_cmd(second, 'shortcuts {}'.format(i))
+    first._persist_history()
+    second._persist_history()
+
+    app = cmd2.Cmd(persistent_history_file=journal_file, persistent_history_length=10)
+    assert [item.raw for item in app.history] == ['shortcuts 2', 'help 3', 'shortcuts 3']
+
+def test_shared_history_compacted_by_other_process(journal_file):
+    from cmd2.history import SharedHistoryJournal
+    journal = SharedHistoryJournal(journal_file)
+    journal.load(10)
+    other = SharedHistoryJournal(journal_file)
+    other.load(10)
+
+    for i in range(4):
+        other.append(_journal_item('other {}'.format(i), i + 1))
+    assert [item.raw for item in journal.read_new()] == ['other 0', 'other 1', 'other 2', 'other 3']
+
+    # After the file is replaced, only the records which weren't read yet are returned
+    other.append(_journal_item('other 4', 5))
+    other.compact(2)
+    assert [item.raw for item in journal.read_new()] == ['other 4']
+    assert journal.record_count == 2
+    assert journal.read_new() == []
+
+    other.clear()
+    assert journal.read_new() == []
+    other.append(_journal_item('after clear', 1))
+    assert [item.raw for item in journal.read_new()] == ['after clear']
+
+def test_shared_history_partial_record(journal_file):
+    from cmd2.history import SharedHistoryJournal
+    journal = SharedHistoryJournal(journal_file)
+    journal.append(_journal_item('first', 1))
+    record = journal._encode(_journal_item('second', 2))
+
+    # A record which is still being written isn't read until it is complete
+    reader = SharedHistoryJournal(journal_file)
+    reader.load(10)
+    with open(journal_file, 'ab') as fobj:
+        fobj.write(record[:5])
+    assert reader.read_new() == []
+    with open(journal_file, 'ab') as fobj:
+        fobj.write(record[5:])
+    assert [item.raw for item in reader.read_new()] == ['second']
+
+def test_shared_history_waits_for_lock(journal_file):
+    from cmd2.history import SharedHistoryJournal, _FileLock
+    journal = SharedHistoryJournal(journal_file)
+    with _FileLock(journal_file + '.lock'):
+        writer = threading.Thread(target=journal.append, args=[_journal_item('waited')])
+        writer.start()
+        writer.join(0.2)
+        assert writer.is_alive()
+        assert not os.path.exists(journal_file)
+    writer.join()
+    assert [item.raw for item in SharedHistoryJournal(journal_file).load(10)] == ['waited']
+
+def _append_shared_items(journal_file, name, count):
+    from cmd2.history import SharedHistoryJournal
+    journal = SharedHistoryJournal(journal_file)
+    for i in range(count):
+        journal.append(_journal_item('{} {}'.format(name, i), i + 1))
+        if i % 10 == 9:
+            journal.compact(1000)
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="fork isn't available on Windows")
+def test_shared_history_processes(journal_file):
+    import multiprocessing
+    context = multiprocessing.get_context('fork')
+    processes = [context.Process(target=_append_shared_items, args=(journal_file, 'proc{}'.format(n), 50))
+                 for n in range(4)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+        assert process.exitcode == 0
+
+    from cmd2.history import SharedHistoryJournal
+    journal = SharedHistoryJournal(journal_file)
+    raws = sorted(item.raw for item in journal.load(1000))
+    assert raws == sorted('proc{} {}'.format(n, i) for n in range(4) for i in range(50))
+    assert not journal.needs_rewrite
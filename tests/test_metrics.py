@@ -0,0 +1,252 @@
+# coding=utf-8
+# flake8: noqa E302
+"""
+Test latency metrics of cmd2
+"""
+import json
+import os
+
+import pytest
+
+from cmd2 import metrics, plugin
+from cmd2.metrics import CommandMetrics, LatencyHistogram
+from .conftest import run_cmd
+
+
+#
+# test LatencyHistogram
+#
+def test_histogram_empty():
+    histogram = LatencyHistogram()
+    assert histogram.count == 0
+    assert histogram.mean is None
+    assert histogram.percentile(50) is None
+    assert histogram.to_dict((50,)) == {'count': 0, 'total': 0.0, 'mean': None, 'min': None, 'max': None,
+                                        'p50': None}
+
+def test_histogram_percentiles():
+    histogram = LatencyHistogram()
+    for ms in range(1, 101):
+        histogram.add(ms / 1000)
+
+    assert histogram.count == 100
+    assert histogram.min == 0.001
+    assert histogram.max == 0.1
+    assert histogram.mean == pytest.approx(0.0505)
+
+    # Percentiles are the bound of a bucket, which is at most 2 ** (1 / 8) times the real value
+    for percent in (1, 50, 90, 99):
+        assert percent / 1000 <= histogram.percentile(percent) <= percent / 1000 * 2 ** (1 / 8)
+
+    # The extremes are limited to the smallest and largest values
+    assert histogram.percentile(0) == 0.001
+    assert histogram.percentile(100) == 0.1
+
+def test_histogram_percentile_out_of_range():
+    histogram = LatencyHistogram()
+    with pytest.raises(ValueError):
+        histogram.percentile(101)
+    with pytest.raises(ValueError):
+        histogram.percentile(-1)
+
+def test_histogram_tiny_latency():
+    histogram = LatencyHistogram()
+    histogram.add(0.0)
+    histogram.add(LatencyHistogram.MIN_LATENCY / 2)
+    assert histogram.counts == [2]
+    assert histogram.percentile(100) == LatencyHistogram.MIN_LATENCY / 2
+
+def test_histogram_bucket_bounds():
+    for seconds in (2e-6, 1e-3, 0.5, 30.0):
+        index = LatencyHistogram.bucket_index(seconds)
+        assert LatencyHistogram.bucket_bound(index - 1) < seconds <= LatencyHistogram.bucket_bound(index) * (1 + 1e-9)
+
+def test_histogram_merge():
+    first = LatencyHistogram()
+    second = LatencyHistogram()
+    first.add(0.001)
+    second.add(0.5)
+    second.add(0.0001)
+    first.merge(second)
+    assert first.count == 3
+    assert first.total == pytest.approx(0.5011)
+    assert first.min == 0.0001
+    assert first.max == 0.5
+    assert sum(first.counts) == 3
+
+
+#
+# test CommandMetrics
+#
+def test_metrics_disabled():
+    command_metrics = CommandMetrics()
+    assert not command_metrics.enabled
+    assert command_metrics.start() is None
+
+def test_metrics_record():
+    command_metrics = CommandMetrics()
+    command_metrics.enabled = True
+    for _ in range(2):
+        timer = command_metrics.start()
+        timer.lap(metrics.PHASE_PARSE)
+        timer.lap(metrics.PHASE_COMMAND)
+        command_metrics.record('first', timer)
+    timer = command_metrics.start()
+    timer.lap(metrics.PHASE_PARSE)
+    command_metrics.record('second', timer)
+
+    assert sorted(command_metrics.commands()) == ['first', 'second']
+    assert command_metrics.histogram(metrics.PHASE_PARSE, 'first').count == 2
+    assert command_metrics.histogram(metrics.PHASE_PARSE).count == 3
+    assert command_metrics.histogram(metrics.PHASE_COMMAND).count == 2
+    assert command_metrics.histogram(metrics.PHASE_COMMAND, 'fake').count == 0
+    assert command_metrics.percentile(50, metrics.PHASE_TOTAL, 'second') is not None
+    assert command_metrics.percentile(50, metrics.PHASE_REDIRECT) is None
+
+    # Histograms returned are copies
+    command_metrics.histogram(metrics.PHASE_PARSE, 'first').add(1.0)
+    assert command_metrics.histogram(metrics.PHASE_PARSE, 'first').count == 2
+
+    summary = command_metrics.summary([50, 99.9])
+    assert list(summary['first']) == [metrics.PHASE_PARSE, metrics.PHASE_COMMAND, metrics.PHASE_TOTAL]
+    assert summary['first'][metrics.PHASE_PARSE]['count'] == 2
+    assert 'p99.9' in summary['second'][metrics.PHASE_TOTAL]
+
+    command_metrics.clear(['first', 'fake'])
+    assert command_metrics.commands() == ['second']
+    command_metrics.clear()
+    assert command_metrics.commands() == []
+
+def test_metrics_bad_phase():
+    with pytest.raises(ValueError):
+        CommandMetrics().histogram('fake')
+
+def test_metrics_export(tmpdir):
+    command_metrics = CommandMetrics()
+    command_metrics.enabled = True
+    timer = command_metrics.start()
+    timer.lap(metrics.PHASE_PARSE)
+    command_metrics.record('cmd', timer)
+
+    filename = os.path.join(str(tmpdir), 'metrics.json')
+    command_metrics.export(filename)
+    with open(filename) as f:
+        data = json.load(f)
+    assert data['time'] > 0
+    assert data['commands'] == command_metrics.summary()
+
+
+#
+# test recording metrics in onecmd_plus_hooks
+#
+ALL_PHASES = list(metrics.PHASES)
+
+def test_onecmd_plus_hooks_phases(base_app):
+    run_cmd(base_app, 'help')
+    assert base_app.metrics.commands() == []
+
+    base_app.metrics.enabled = True
+    run_cmd(base_app, 'help')
+    run_cmd(base_app, 'help')
+    summary = base_app.metrics.summary()
+    assert list(summary) == ['help']
+    assert list(summary['help']) == ALL_PHASES
+    for phase in ALL_PHASES:
+        assert summary['help'][phase]['count'] == 2
+
+    # The total is the sum of the phases
+    durations = summary['help']
+    phase_sum = sum(durations[phase]['total'] for phase in ALL_PHASES if phase != metrics.PHASE_TOTAL)
+    assert durations[metrics.PHASE_TOTAL]['total'] == pytest.approx(phase_sum)
+
+def test_onecmd_plus_hooks_alias_recorded_as_command(base_app):
+    base_app.metrics.enabled = True
+    run_cmd(base_app, 'alias create fake help')
+    run_cmd(base_app, 'fake')
+    assert sorted(base_app.metrics.commands()) == ['alias', 'help']
+
+def test_onecmd_plus_hooks_postparsing_stop(base_app):
+    def stop_hook(data: plugin.PostparsingData) -> plugin.PostparsingData:
+        data.stop = True
+        return data
+
+    base_app.register_postparsing_hook(stop_hook)
+    base_app.metrics.enabled = True
+    run_cmd(base_app, 'help')
+    phases = base_app.metrics.summary()['help']
+    assert list(phases) == [metrics.PHASE_PARSE, metrics.PHASE_POSTPARSING, metrics.PHASE_FINALIZATION,
+                            metrics.PHASE_TOTAL]
+
+def test_onecmd_plus_hooks_empty_line(base_app):
+    base_app.metrics.enabled = True
+    run_cmd(base_app, '')
+    assert base_app.metrics.commands() == []
+
+
+#
+# test stats command
+#
+def test_stats_no_subcommand(base_app):
+    out, err = run_cmd(base_app, 'stats')
+    assert "Usage: stats [-h]" in err[0]
+
+def test_stats_on_off(base_app):
+    out, err = run_cmd(base_app, 'stats on')
+    assert out == ['Metrics enabled']
+    assert base_app.metrics.enabled
+    out, err = run_cmd(base_app, 'stats off')
+    assert out == ['Metrics disabled']
+    assert not base_app.metrics.enabled
+
+    # stats off was the only command run while enabled
+    assert base_app.metrics.commands() == ['stats']
+
+def test_stats_show(base_app):
+    out, err = run_cmd(base_app, 'stats show')
+    assert out == ['No metrics have been recorded']
+
+    base_app.metrics.enabled = True
+    run_cmd(base_app, 'help')
+    base_app.metrics.enabled = False
+
+    out, err = run_cmd(base_app, 'stats show')
+    assert out[0].split() == ['Command', 'Phase', 'Count', 'p50', 'ms', 'p90', 'ms', 'p99', 'ms', 'max', 'ms']
+    assert [line.split()[:3] for line in out[1:]] == [['help', phase, '1'] for phase in ALL_PHASES]
+
+    out, err = run_cmd(base_app, 'stats show -p command -p total help fake')
+    assert [line.split()[:3] for line in out[1:]] == [['help', 'command', '1'], ['help', 'total', '1']]
+    assert err == ["No metrics for command 'fake'"]
+
+    out, err = run_cmd(base_app, 'stats show -c -p parse')
+    assert [line.split()[:3] for line in out[1:]] == [['(all)', 'parse', '1']]
+
+def test_stats_export(base_app, tmpdir):
+    base_app.metrics.enabled = True
+    run_cmd(base_app, 'help')
+    base_app.metrics.enabled = False
+
+    filename = os.path.join(str(tmpdir), 'metrics.json')
+    out, err = run_cmd(base_app, 'stats export {}'.format(filename))
+    assert out == ['Metrics saved to {}'.format(filename)]
+    with open(filename) as f:
+        data = json.load(f)
+    assert list(data['commands']) == ['help']
+
+def test_stats_export_error(base_app, tmpdir):
+    out, err = run_cmd(base_app, 'stats export {}'.format(str(tmpdir)))
+    assert err[0].startswith('Failed to export metrics')
+
+def test_stats_clear(base_app):
+    base_app.metrics.enabled = True
+    run_cmd(base_app, 'help')
+    run_cmd(base_app, 'shortcuts')
+    base_app.metrics.enabled = False
+
+    out, err = run_cmd(base_app, 'stats clear help fake')
+    assert out == ["Metrics for 'help' deleted"]
+    assert err == ["No metrics for command 'fake'"]
+    assert base_app.metrics.commands() == ['shortcuts']
+
+    out, err = run_cmd(base_app, 'stats clear')
+    assert out == ['All metrics deleted']
+    assert base_app.metrics.commands() == []
@@ -99,6 +99,88 @@ def test_tokenize_unclosed_quotes(parser):
     with pytest.raises(ValueError):
         _ = parser.tokenize('command with "unclosed quotes')
 
+@pytest.mark.parametrize('line', [
+    '',
+    '   ',
+    'command',
+    'command "quoted arg" \'single\' unquoted',
+    '"quoted command"arg',
+    '"one""two"',
+    'word"with quote" inside',
+    'termbare;;; && | ||| >> > >>>',
+    'multiline "with; quoted" terminators;suffix|pipe >out',
+    'mixed;"quote after" punctuation',
+    '"multiple\nlines" \t tabs\r\nand newlines',
+    'trailing ;',
+])
+def test_split_line_native_matches_shlex(parser, line):
+    native = parser.split_line(line)
+    parser.native_tokenizer = False
+    assert native == parser.split_line(line)
+    assert native == parser.split_on_punctuation(shlex_split(line))
+
+@pytest.mark.parametrize('line', [
+    '"unclosed',
+    'command "unclosed quotes',
+    "command 'unclosed quotes",
+    '"closed"\'unclosed',
+])
+def test_split_line_native_unclosed_quotes(parser, line):
+    with pytest.raises(ValueError) as excinfo:
+        parser.split_line(line)
+    assert str(excinfo.value) == 'No closing quotation'
+
+def test_split_line_native_quote_terminator():
+    # Quotes as terminators can't be handled natively, so shlex is used
+    parser = StatementParser(terminators=["'"])
+    assert parser._token_pattern is None
+    assert parser.split_line("cmd arg'") == ['cmd', 'arg', "'"]
+
+@pytest.mark.parametrize('line,tokens,unfinished', [
+    ('command arg', ['command', 'arg'], ''),
+    ('command "arg; with" > out', ['command', '"arg; with"', '>', 'out'], ''),
+    ('command arg "open; quote', ['command', 'arg'], '"open; quote'),
+    ("command 'open\nquote", ['command'], "'open\nquote"),
+])
+def test_split_partial_line(parser, line, tokens, unfinished):
+    assert parser.split_partial_line(line) == (tokens, unfinished)
+
+def test_split_partial_line_shlex(parser):
+    parser.native_tokenizer = False
+    assert parser.split_partial_line('command arg;') == (['command', 'arg', ';'], '')
+    assert parser.split_partial_line('command "open') == ([], 'command "open')
+
+@pytest.mark.parametrize('native', [True, False])
+@pytest.mark.parametrize('first_line,lines,complete', [
+    ('multiline arg', [], False),
+    ('multiline arg', ['more args'], False),
+    ('multiline arg', ['more args;'], True),
+    ('multiline arg', ['more args', ''], True),
+    ('multiline arg', ['more args&suffix'], True),
+    ('multiline "open', ['still; open'], False),
+    ('multiline "open', ['still; open', 'closed"'], False),
+    ('multiline "open', ['still; open', 'closed";'], True),
+    ('multiline "open', [''], False),
+    ('multiline arg; "open', ['closed"'], True),
+    ('anothermultiline arg', ['more'], False),
+    ('anothermultiline arg', ['more;'], True),
+])
+def test_multiline_lexer(parser, native, first_line, lines, complete):
+    parser.native_tokenizer = native
+    lexer = cmd2.parsing.MultilineLexer(parser, first_line)
+    for line in lines:
+        lexer.add_line(line)
+    assert lexer.complete == complete
+
+    # Completeness must agree with parsing all of the input
+    buffer = '\n'.join([first_line] + lines)
+    try:
+        statement = parser.parse(buffer)
+    except ValueError:
+        assert not complete
+    else:
+        assert complete == bool(statement.terminator or not statement.multiline_command)
+
 @pytest.mark.parametrize('tokens,command,args', [
     ([], '', ''),
     (['command'], 'command', ''),
@@ -306,6 +388,64 @@ def test_parse_pipe_then_redirect(parser):
     assert statement.output == ''
     assert statement.output_to == ''
 
+def test_parse_filters(parser):
+    line = 'output into;sufx |> grep "a b" |>head -n 3 > afile.txt'
+    statement = parser.parse(line)
+    assert statement.command == 'output'
+    assert statement == 'into'
+    assert statement.argv == ['output', 'into']
+    assert statement.terminator == ';'
+    assert statement.suffix == 'sufx'
+    assert statement.filters == ['grep "a b"', 'head -n 3']
+    assert statement.pipe_to == ''
+    assert statement.output == '>'
+    assert statement.output_to == 'afile.txt'
+    assert statement.post_command == '; sufx |> grep "a b" |> head -n 3 > afile.txt'
+
+def test_parse_filter_then_pipe(parser):
+    statement = parser.parse('output into|>sort | wc -l')
+    assert statement == 'into'
+    assert statement.filters == ['sort']
+    assert statement.pipe_to == 'wc -l'
+
+def test_parse_pipe_then_filter(parser):
+    # Once output goes to a shell command, |> is part of that command
+    statement = parser.parse('output into | grep x |> head')
+    assert statement.filters == []
+    assert statement.pipe_to == 'grep x | > head'
+
+def test_parse_separated_filter_is_pipe(parser):
+    # The characters of |> must be adjacent, otherwise output is piped to a shell command as before
+    statement = parser.parse('output into | > afile.txt')
+    assert statement.filters == []
+    assert statement.pipe_to == '> afile.txt'
+
+    statement = parser.parse('output into |> sort | > afile.txt')
+    assert statement.filters == ['sort']
+    assert statement.pipe_to == '> afile.txt'
+
+def test_parse_filter_in_alias(parser):
+    parser.aliases['sorted'] = 'output into |>sort'
+    statement = parser.parse('sorted |> head')
+    assert statement.command == 'output'
+    assert statement.filters == ['sort', 'head']
+
+def test_parse_filter_quoted(parser):
+    statement = parser.parse('output "|>" into')
+    assert statement.filters == []
+    assert statement.argv == ['output', '|>', 'into']
+
+def test_parse_missing_filter(parser):
+    statement = parser.parse('output into |>')
+    assert statement.filters == ['']
+
+def test_parse_filter_ignores_extended_redirection_tokens(parser, monkeypatch):
+    # Only the redirection characters end a filter, even if the list of redirection tokens was extended
+    monkeypatch.setattr(constants, 'REDIRECTION_TOKENS', constants.REDIRECTION_TOKENS + ['x'])
+    statement = parser.parse('output into |> grep x |> head')
+    assert statement.filters == ['grep x', 'head']
+    assert statement.output == ''
+
 def test_parse_multiple_pipes(parser):
     line = 'output into;sufx | pipethrume plz | grep blah'
     statement = parser.parse(line)
@@ -823,6 +963,130 @@ def test_statement_initialization():
     assert statement.output_to == ''
 
 
+def test_parse_cache_hits_and_misses(parser):
+    parser.cache_clear()
+    first = parser.parse('command arg')
+    assert parser.parse('command arg') is first
+    assert parser.parse_command_only('command arg') is not first
+    assert parser.parse_command_only('command arg') is parser.parse_command_only('command arg')
+
+    info = parser.cache_info()
+    assert info.hits == 3
+    assert info.misses == 2
+    assert info.currsize == 2
+
+def test_parse_cache_is_bounded():
+    parser = StatementParser(parse_cache_size=2)
+    first = parser.parse('one')
+    parser.parse('two')
+    parser.parse('three')
+    assert parser.cache_info().currsize == 2
+    assert parser.parse('one') is not first
+
+def test_parse_cache_disabled():
+    parser = StatementParser(parse_cache_size=0)
+    assert parser.parse('command') is not parser.parse('command')
+    assert parser.cache_info().currsize == 0
+
+def test_parse_cache_alias_change(parser):
+    generation = parser.generation
+    assert parser.parse('newalias arg').command == 'newalias'
+
+    parser.aliases['newalias'] = 'help'
+    assert parser.generation > generation
+    assert parser.parse('newalias arg').command == 'help'
+
+    del parser.aliases['newalias']
+    assert parser.parse('newalias arg').command == 'newalias'
+
+    parser.aliases = {'newalias': 'history'}
+    assert parser.parse('newalias arg').command == 'history'
+
+def test_parse_cache_shortcut_change(parser):
+    assert parser.parse('$arg').command == '$arg'
+    parser.shortcuts = {'$': 'set'}
+    assert parser.parse('$arg').command == 'set'
+    assert parser.shortcuts == (('$', 'set'),)
+
+def test_parse_cache_terminator_change(parser):
+    assert parser.parse('command arg%').terminator == ''
+    parser.terminators = ['%']
+    statement = parser.parse('command arg%')
+    assert statement.terminator == '%'
+    assert statement.args == 'arg'
+
+def test_parse_cache_multiline_change(parser):
+    assert not parser.parse_command_only('newmulti arg').multiline_command
+    parser.multiline_commands = ['newmulti']
+    assert parser.parse_command_only('newmulti arg').multiline_command == 'newmulti'
+
+@pytest.mark.parametrize('aliases,line,expanded', [
+    ({'one': 'two x', 'two': 'three y'}, 'one z', 'three y x z'),
+    ({'one': 'two', 'two': 'one'}, 'one z', 'one z'),
+    ({'one': 'two;', 'two': 'three'}, 'one|z', 'three;|z'),
+    ({'one': '"quoted" x'}, 'one z', '"quoted" x z'),
+    ({'one': ' ', 'two': 'three'}, 'one two z', 'three z'),
+    ({'one': 'one more'}, 'one', 'one more'),
+])
+def test_expand_alias_chains(aliases, line, expanded):
+    parser = StatementParser(aliases=aliases, shortcuts={})
+    assert parser._expand(line) == expanded
+
+def test_alias_expansions_invalidated(parser):
+    parser.aliases['one'] = 'two x'
+    assert parser._expand('one') == 'two x'
+    assert 'one' in parser._alias_expansions
+
+    parser.aliases['two'] = 'three'
+    assert not parser._alias_expansions
+    assert parser._expand('one') == 'three x'
+
+    del parser.aliases['two']
+    assert parser._expand('one') == 'two x'
+
+@pytest.mark.parametrize('line,match', [
+    ('', None),
+    ('help', None),
+    ('!ls', ('!', 'shell')),
+    ('!!ls', ('!!', 'last')),
+    ('!!!ls', ('!!!', 'lastlast')),
+    ('!!!!ls', ('!!!', 'lastlast')),
+    ('@file', ('@', 'run_script')),
+    ('@@file', ('@@', '_relative_run_script')),
+])
+def test_match_shortcut(line, match):
+    shortcuts = dict(constants.DEFAULT_SHORTCUTS)
+    shortcuts.update({'!': 'shell', '!!': 'last', '!!!': 'lastlast'})
+    parser = StatementParser(shortcuts=shortcuts)
+    assert parser.match_shortcut(line) == match
+
+def test_match_shortcut_after_change(parser):
+    assert parser.match_shortcut('$x') is None
+    parser.shortcuts = {'$': 'set'}
+    assert parser.match_shortcut('$x') == ('$', 'set')
+    assert parser.match_shortcut('!x') is None
+
+def test_get_command_arg_list_copies_cached_arg_list(parser):
+    statement = parser.parse('command arg1 arg2')
+    _, arg_list = parser.get_command_arg_list('command', statement, preserve_quotes=True)
+    arg_list.append('arg3')
+    assert parser.parse('command arg1 arg2').arg_list == ['arg1', 'arg2']
+
+
+def test_macro_template():
+    from cmd2.parsing import Macro, MacroArg
+    value = 'help {1} {{2}} x {1}'
+    arg_list = [MacroArg(start_index=5, number_str='1', is_escaped=False),
+                MacroArg(start_index=9, number_str='2', is_escaped=True),
+                MacroArg(start_index=17, number_str='1', is_escaped=False)]
+    macro = Macro(name='fake', value=value, minimum_arg_count=1, arg_list=arg_list)
+    assert macro.template == ('help ', 1, ' {2} x ', 1, '')
+
+def test_macro_template_no_args():
+    from cmd2.parsing import Macro
+    macro = Macro(name='fake', value='help -v', minimum_arg_count=0)
+    assert macro.template == ('help -v',)
+
 def test_statement_is_immutable():
     string = 'foo'
     statement = cmd2.Statement(string)
@@ -834,6 +1098,55 @@ def test_statement_is_immutable():
     with pytest.raises(attr.exceptions.FrozenInstanceError):
         statement.raw = 'baz'
 
+def test_statement_create_matches_init():
+    kwargs = dict(raw='cmd "arg one" two; suffix | less', command='cmd', arg_list=['"arg one"', 'two'],
+                  multiline_command='cmd', terminator=';', suffix='suffix', pipe_to='less')
+    created = cmd2.Statement._create('"arg one" two', **kwargs)
+    expected = cmd2.Statement('"arg one" two', **kwargs)
+    assert type(created) is cmd2.Statement
+    assert created == expected
+    assert attr.astuple(created) == attr.astuple(expected)
+    assert str(created) == str(expected)
+    assert created.expanded_command_line == expected.expanded_command_line
+    assert cmd2.Statement._create('').arg_list == []
+
+def test_statement_argv_cached(parser):
+    statement = parser.parse('command "quoted arg" other')
+    argv = statement.argv
+    assert argv == ['command', 'quoted arg', 'other']
+    assert statement.command_and_args is statement.command_and_args
+
+    # Changing a returned list doesn't affect later results
+    argv.append('extra')
+    assert statement.argv == ['command', 'quoted arg', 'other']
+
+def test_statement_pickle_excludes_cached_values(parser):
+    import pickle
+    statement = parser.parse('command arg > out.txt')
+    assert statement.argv == ['command', 'arg']
+    assert statement.command_and_args == 'command arg'
+
+    restored = pickle.loads(pickle.dumps(statement))
+    assert '_argv' not in restored.__dict__
+    assert '_command_and_args' not in restored.__dict__
+    assert restored == statement
+    assert attr.astuple(restored) == attr.astuple(statement)
+    assert restored.argv == statement.argv
+
+
+def test_statement_unpickle_without_filters(parser):
+    import pickle
+    statement = parser.parse('command arg | wc')
+    state = statement.__getstate__()
+    del state['filters']
+
+    # A Statement pickled before filters existed
+    restored = cmd2.Statement.__new__(cmd2.Statement, str(statement))
+    restored.__setstate__(state)
+    assert restored.filters == []
+    assert restored.pipe_to == 'wc'
+    assert pickle.loads(pickle.dumps(restored)) == statement
+
 
 def test_is_valid_command_invalid(parser):
     # Empty command
@@ -836,3 +836,79 @@ def test_cmdfinalization_hook_exception(capsys):
     assert out == 'hello\n'
     assert err
     assert app.called_cmdfinalization == 1
+
+###
+#
+# command hooks together
+#
+###
+def test_no_hooks_no_data_objects(capsys):
+    app = PluggedApp()
+    hooked_app = PluggedApp()
+    hooked_app.register_precmd_hook(hooked_app.precmd_hook)
+
+    data_types = ['PostparsingData', 'PrecommandData', 'PostcommandData', 'CommandFinalizationData']
+    patchers = [mock.patch.object(plugin, name, wraps=getattr(plugin, name)) for name in data_types]
+    patched = dict(zip(data_types, [patcher.start() for patcher in patchers]))
+    try:
+        stop = app.onecmd_plus_hooks('say hello')
+        out, err = capsys.readouterr()
+        assert not stop
+        assert out == 'hello\n'
+        assert not err
+        for data_type in patched.values():
+            data_type.assert_not_called()
+
+        # only the data object for the registered hook is created
+        hooked_app.onecmd_plus_hooks('say hello')
+        patched['PrecommandData'].assert_called_once()
+        for name in ['PostparsingData', 'PostcommandData', 'CommandFinalizationData']:
+            patched[name].assert_not_called()
+    finally:
+        for patcher in patchers:
+            patcher.stop()
+
+def test_all_hooks_run_in_order(capsys):
+    app = PluggedApp()
+    calls = []
+
+    def postparsing(data: plugin.PostparsingData) -> plugin.PostparsingData:
+        calls.append('postparsing')
+        return data
+
+    def precmd(data: plugin.PrecommandData) -> plugin.PrecommandData:
+        calls.append('precmd')
+        return data
+
+    def postcmd(data: plugin.PostcommandData) -> plugin.PostcommandData:
+        calls.append('postcmd')
+        return data
+
+    def cmdfinalization(data: plugin.CommandFinalizationData) -> plugin.CommandFinalizationData:
+        calls.append('cmdfinalization')
+        return data
+
+    app.register_cmdfinalization_hook(cmdfinalization)
+    app.register_postcmd_hook(postcmd)
+    app.register_precmd_hook(precmd)
+    app.register_postparsing_hook(postparsing)
+    stop = app.onecmd_plus_hooks('say hello')
+    out, err = capsys.readouterr()
+    assert not stop
+    assert out == 'hello\n'
+    assert calls == ['postparsing', 'precmd', 'postcmd', 'cmdfinalization']
+
+def test_hooks_appended_to_lists_run(capsys):
+    app = PluggedApp()
+    app._postparsing_hooks.append(app.postparse_hook)
+    app._precmd_hooks.append(app.precmd_hook)
+    app._postcmd_hooks.append(app.postcmd_hook)
+    app._cmdfinalization_hooks.append(app.cmdfinalization_hook)
+    stop = app.onecmd_plus_hooks('say hello')
+    out, err = capsys.readouterr()
+    assert not stop
+    assert out == 'hello\n'
+    assert app.called_postparsing == 1
+    assert app.called_precmd == 2
+    assert app.called_postcmd == 2
+    assert app.called_cmdfinalization == 1
@@ -3,11 +3,18 @@
 """
 Unit testing for cmd2/utils.py module.
 """
+import io
+import os
 import signal
 import sys
 
 import pytest
 
+try:
+    import mock
+except ImportError:
+    from unittest import mock
+
 import cmd2.utils as cu
 
 HELLO_WORLD = 'Hello, world!'
@@ -264,6 +271,123 @@ def test_proc_reader_wait(pr_none):
     assert pr_none._proc.poll() == 0
 
 
+def _python_proc(code, **kwargs):
+    import subprocess
+    return subprocess.Popen([sys.executable, '-c', code], **kwargs)
+
+def test_proc_reader_captures_output():
+    import subprocess
+    code = ("import sys\n"
+            "for i in range(2000):\n"
+            "    sys.stdout.write('out %d ' % i * 20 + '\\n')\n"
+            "    sys.stderr.write('err %d\\n' % i)\n")
+    proc = _python_proc(code, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    stdout = cu.StdSim(io.StringIO())
+    stderr = cu.StdSim(io.StringIO())
+    pr = cu.ProcReader(proc, stdout, stderr)
+    pr.wait()
+
+    assert proc.returncode == 0
+    out_lines = stdout.getvalue().splitlines()
+    assert len(out_lines) == 2000
+    assert len(stdout.getbytes()) > cu.ProcReader.READ_SIZE
+    assert out_lines[-1] == 'out 1999 ' * 20
+    assert stderr.getvalue().splitlines() == ['err {}'.format(i) for i in range(2000)]
+    assert proc.stdout.closed
+    assert proc.stderr.closed
+
+def test_proc_reader_one_pipe():
+    import subprocess
+    proc = _python_proc("print('hello')", stdout=subprocess.PIPE)
+    stdout = cu.StdSim(io.StringIO())
+    pr = cu.ProcReader(proc, stdout, None)
+    pr.wait()
+    assert stdout.getvalue() == 'hello\n'
+
+def test_proc_reader_reads_after_process_exits():
+    import subprocess
+    # The grandchild holds the pipe open and keeps writing after the shell exits
+    code = ("import subprocess, sys\n"
+            "subprocess.Popen([sys.executable, '-c', 'import time; time.sleep(0.2); print(\\'late\\')'])\n")
+    proc = _python_proc(code, stdout=subprocess.PIPE)
+    stdout = cu.StdSim(io.StringIO())
+    pr = cu.ProcReader(proc, stdout, None)
+    pr.wait()
+    assert stdout.getvalue() == 'late\n'
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Commands always run in a shell on Windows")
+@pytest.mark.parametrize('command, args', [
+    ('grep foo', ['grep', 'foo']),
+    ('  ls -l  /tmp ', ['ls', '-l', '/tmp']),
+    ('grep "foo bar" \'it is\'', ['grep', 'foo bar', 'it is']),
+    ('grep a=b', ['grep', 'a=b']),
+    ('grep "(a|b)*" \'$x\'', ['grep', '(a|b)*', '$x']),
+    ('', None),
+    ('grep foo | wc -l', None),
+    ('sort > out.txt', None),
+    ('echo $HOME', None),
+    ('ls *.py', None),
+    ('ls ~', None),
+    ('grep \\n', None),
+    ('grep "$x"', None),
+    ('cd /tmp', None),
+    ('if true', None),
+    ('LANG=C sort', None),
+    ('grep "unclosed', None),
+])
+def test_split_simple_command(command, args):
+    assert cu.split_simple_command(command) == args
+
+def test_split_simple_command_windows(monkeypatch):
+    monkeypatch.setattr(sys, 'platform', 'win32')
+    assert cu.split_simple_command('grep foo') is None
+
+def test_find_program_remembers_path(monkeypatch):
+    import shutil
+    which_mock = mock.Mock(wraps=shutil.which)
+    monkeypatch.setattr(shutil, 'which', which_mock)
+    monkeypatch.setattr(cu, '_program_paths', {})
+
+    found = cu.find_program('python', path=os.path.dirname(sys.executable))
+    assert found == cu.find_program('python', path=os.path.dirname(sys.executable))
+    assert which_mock.call_count == 1
+
+    # Paths are found again when PATH changes
+    assert cu.find_program('python', path='') is None
+    assert which_mock.call_count == 2
+
+    # Names with a directory are not remembered
+    assert cu.find_program(sys.executable) == sys.executable
+    assert cu.find_program(sys.executable) == sys.executable
+    assert which_mock.call_count == 4
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Commands always run in a shell on Windows")
+def test_popen_shell_command_without_shell():
+    import subprocess
+    proc = cu.popen_shell_command('"{}" -c "print(1)"'.format(sys.executable), stdout=subprocess.PIPE)
+    out, _ = proc.communicate()
+    assert proc.args == [sys.executable, '-c', 'print(1)']
+    assert out.strip() == b'1'
+
+def test_popen_shell_command_with_shell():
+    import subprocess
+    proc = cu.popen_shell_command('echo one && echo two', stdout=subprocess.PIPE)
+    out, _ = proc.communicate()
+    assert proc.args == 'echo one && echo two'
+    assert out.split() == [b'one', b'two']
+
+@pytest.mark.skipif(sys.platform.startswith('win'), reason="Commands always run in a shell on Windows")
+def test_popen_shell_command_program_removed(monkeypatch):
+    import subprocess
+    monkeypatch.setattr(cu, '_program_paths', {})
+    monkeypatch.setattr(cu, 'find_program', lambda name, path=None: '/nonexistent/program')
+    proc = cu.popen_shell_command('"{}" -c "print(1)"'.format(sys.executable), stdout=subprocess.PIPE)
+    out, _ = proc.communicate()
+
+    # The shell ran the command instead
+    assert isinstance(proc.args, str)
+    assert out.strip() == b'1'
+
 @pytest.fixture
 def context_flag():
     return cu.ContextFlag()